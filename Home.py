@@ -1,5 +1,5 @@
 import streamlit as st
-from core.database import get_db_connection, authenticate_user, get_user_by_id
+from core.database import db_connection, authenticate_user, get_user_by_id
 from streamlit_cookies_manager import CookieManager
 
 st.set_page_config(
@@ -15,8 +15,6 @@ if 'user_nickname' not in st.session_state: st.session_state.user_nickname = Non
 if 'user_login' not in st.session_state: st.session_state.user_login = None
 if 'user_id' not in st.session_state: st.session_state.user_id = None
 
-conn = get_db_connection()
-conn.set_client_encoding("UTF8")
 cookies = CookieManager()
 
 if not cookies.ready():
@@ -37,7 +35,8 @@ if not st.session_state.logged_in:
             user_id_to_check = int(query_params["user_id"][0])
 
     if user_id_to_check:
-        user = get_user_by_id(conn, user_id_to_check)
+        with db_connection() as conn:
+            user = get_user_by_id(conn, user_id_to_check)
         if user and user['status'] == 'active':
             st.session_state.logged_in = True
             st.session_state.user_role = user['role']
@@ -58,7 +57,8 @@ if not st.session_state.logged_in:
                 del st.query_params["user_id"]
 
 def login_user(username, password, remember_me):
-    user = authenticate_user(conn, username, password)
+    with db_connection() as conn:
+        user = authenticate_user(conn, username, password)
     if user:
         if user['status'] == 'active':
             st.session_state.logged_in = True
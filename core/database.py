@@ -1,6 +1,12 @@
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool as pg_pool
+import hashlib
 import json
 import os
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import uuid
 import bcrypt
@@ -19,16 +25,161 @@ COLUMN_MAPPING = {
     'token': 'tokens', 'lemma': 'lemmas', 'morph': 'morph'
 }
 
+# Параметры общего пула подключений процесса
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Подключение, простоявшее без дела дольше этого интервала (сек), перед выдачей проверяется SELECT 1
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "60"))
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Подключение из пула: хранит служебные отметки о выдаче и последнем использовании."""
+    borrowed = False
+    last_used = 0.0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Имена подготовленных на этом подключении запросов -> число параметров
+        self.prepared_statements = {}
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    """Лениво создает общий для всего процесса пул подключений."""
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                port_int = int(DB_PORT) if DB_PORT else 5432
+                _pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE,
+                    host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD, port=port_int,
+                    client_encoding="UTF8", connection_factory=PooledConnection
+                )
+                # ThreadedConnectionPool сразу падает с PoolError при исчерпании,
+                # семафор позволяет вместо этого подождать освобождения подключения.
+                _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+    return _pool
+
+def _is_connection_healthy(conn, force=False):
+    """Проверяет подключение запросом SELECT 1, если оно простаивало дольше DB_POOL_HEALTHCHECK_INTERVAL (или force)."""
+    if conn.closed:
+        return False
+    if not force and time.monotonic() - conn.last_used < DB_POOL_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    """Создает и возвращает новое подключение к базе данных."""
+    """
+    Берет подключение из общего пула процесса.
+    Подключение нужно вернуть через release_db_connection() или использовать db_connection().
+    None — подключиться не удалось или пул исчерпан за DB_POOL_TIMEOUT; кэшируемые функции
+    в этом случае поднимают QueryFailedError, а не кэшируют пустой результат.
+    """
     try:
-        port_int = int(DB_PORT) if DB_PORT else 5432 # Добавим дефолтное значение на всякий случай
-        conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD, port=port_int)
-        return conn
+        db_pool = _get_pool()
     except psycopg2.OperationalError as e:
         print(f"Ошибка подключения к БД: {e}")
         return None
 
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        print(f"Ошибка подключения к БД: нет свободных подключений в пуле за {DB_POOL_TIMEOUT} с")
+        return None
+
+    try:
+        conn = db_pool.getconn()
+        if not _is_connection_healthy(conn):
+            # Сервер мог разорвать простаивающее соединение — заменяем его новым. Замену тоже проверяем:
+            # пул может отдать другое простаивавшее подключение, а не открыть новое
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+            if not _is_connection_healthy(conn, force=True):
+                db_pool.putconn(conn, close=True)
+                _pool_slots.release()
+                print("Ошибка подключения к БД: подключение из пула не отвечает")
+                return None
+        conn.borrowed = True
+        return conn
+    except (psycopg2.Error, pg_pool.PoolError) as e:
+        _pool_slots.release()
+        print(f"Ошибка подключения к БД: {e}")
+        return None
+
+def release_db_connection(conn):
+    """Возвращает подключение в пул, откатывая незавершенную транзакцию."""
+    if conn is None or not getattr(conn, 'borrowed', False):
+        return
+    conn.borrowed = False
+    try:
+        broken = bool(conn.closed)
+        if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        conn.last_used = time.monotonic()
+        _pool.putconn(conn, close=broken)
+    except pg_pool.PoolError as e:
+        print(f"Ошибка возврата подключения в пул: {e}")
+    finally:
+        _pool_slots.release()
+
+@contextmanager
+def db_connection():
+    """Контекстный менеджер: берет подключение из пула и гарантированно возвращает его."""
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        release_db_connection(conn)
+
+class QueryFailedError(Exception):
+    """
+    Запрос не дал результата: в пуле нет свободного подключения, запрос отменен или прерван
+    по statement_timeout. Кэшируемые обертки поднимают эту ошибку вместо пустого значения,
+    чтобы сбой не сохранился в кэше как настоящий ответ.
+    """
+
+# Бюджет времени одного запроса фоновых задач страниц (мс); 0 — без ограничения
+QUERY_STATEMENT_TIMEOUT_MS = int(os.getenv("QUERY_STATEMENT_TIMEOUT_MS", "60000"))
+
+@contextmanager
+def tagged_session(conn, tag, statement_timeout_ms=QUERY_STATEMENT_TIMEOUT_MS):
+    """
+    Помечает запросы подключения тегом в application_name (виден в pg_stat_activity) и ограничивает
+    каждый из них statement_timeout. По выходе настройки сбрасываются, чтобы не уйти в пул с подключением.
+    """
+    if conn is None:
+        yield conn
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT set_config('application_name', %s, false), set_config('statement_timeout', %s, false);",
+            (tag[:63], str(int(statement_timeout_ms)))
+        )
+    conn.commit()
+    try:
+        yield conn
+    finally:
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("RESET application_name; RESET statement_timeout;")
+            conn.commit()
+        except psycopg2.Error as e:
+            # Подключение с несброшенными настройками не должно вернуться в пул
+            print(f"Ошибка сброса настроек подключения: {e}")
+            conn.close()
+
 # --- Функции для работы с пользователями ---
 def add_user(conn, login, nickname, password, role, status):
     if not conn: return False
@@ -163,7 +314,7 @@ def get_relaxed_signature(full_signature, length):
 def get_pattern_by_id(pattern_id):
     """
     Получает полную информацию о паттерне по его ID, включая категории.
-    Создает собственное подключение, чтобы быть кэшируемой функцией.
+    Берет собственное подключение из пула, чтобы быть кэшируемой функцией.
     """
     conn = get_db_connection()
     if not conn: return None
@@ -190,7 +341,7 @@ def get_pattern_by_id(pattern_id):
         print(f"Ошибка при получении паттерна по ID: {e}")
         return None
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 # --- Функции для модерации ---
 def get_next_unmoderated_pattern(conn, user_id, phrase_length, min_total_frequency=0, min_total_quantity=0, pattern_id_to_exclude=None):
@@ -410,10 +561,14 @@ def delete_moderation_record(conn, entry_id):
         conn.rollback()
         return False, None
 
-def create_temp_table_for_session(conn, selected_lengths):
+# Предел размера временной таблицы одной сессии (байт, вместе с индексами); 0 — без ограничения
+SESSION_TEMP_MAX_BYTES = int(os.getenv("SESSION_TEMP_MAX_BYTES", str(2 * 1024 ** 3)))
+
+def create_temp_table_for_session(conn, selected_lengths, max_bytes=SESSION_TEMP_MAX_BYTES):
     """
     Создает временную таблицу для сессии, содержащую n-граммы только выбранных длин.
     Это значительно ускоряет последующие запросы на фильтрацию и получение подсказок.
+    Таблица больше max_bytes сразу удаляется (возвращается None): такая сессия работает с ngrams.
     """
     if not conn or not selected_lengths:
         return None
@@ -426,7 +581,7 @@ def create_temp_table_for_session(conn, selected_lengths):
             # ON COMMIT PRESERVE ROWS важно, так как Streamlit может выполнять коммиты между rerun'ами
             cur.execute(f"""
                 CREATE TEMP TABLE IF NOT EXISTS {table_name} (
-                    LIKE ngrams INCLUDING ALL
+                    LIKE ngrams INCLUDING DEFAULTS
                 ) ON COMMIT PRESERVE ROWS;
             """)
 
@@ -434,16 +589,16 @@ def create_temp_table_for_session(conn, selected_lengths):
             # Вставляем данные во временную таблицу
             cur.execute(f"INSERT INTO {table_name} SELECT * FROM ngrams WHERE len IN %s;", (lengths_tuple,))
 
-            # Создаем индексы для ускорения
-            # B-Tree index for frequency is useful for sorting and range queries.
-            cur.execute(f"CREATE INDEX ON {table_name} (freq_mln);")
-            # GIN indexes are crucial for accelerating containment queries (@>) on JSONB arrays.
-            cur.execute(f"CREATE INDEX ON {table_name} USING gin (deps);")
-            cur.execute(f"CREATE INDEX ON {table_name} USING gin (pos);")
-            cur.execute(f"CREATE INDEX ON {table_name} USING gin (tags);")
-            cur.execute(f"CREATE INDEX ON {table_name} USING gin (tokens);")
-            cur.execute(f"CREATE INDEX ON {table_name} USING gin (lemmas);")
-            cur.execute(f"CREATE INDEX ON {table_name} USING gin (morph);")
+            # Индексы строятся позже и только нужные (core.index_planner); автоочистка временные
+            # таблицы не анализирует, поэтому статистика собирается сразу
+            cur.execute(f"ANALYZE {table_name};")
+            if max_bytes:
+                cur.execute("SELECT pg_total_relation_size(%s::regclass);", (table_name,))
+                table_size = cur.fetchone()[0]
+                if table_size > max_bytes:
+                    print(f"Временная таблица {table_name} ({table_size} байт) превышает предел сессии {max_bytes} байт")
+                    conn.rollback()
+                    return None
             conn.commit()
             return table_name
     except Exception as e:
@@ -451,6 +606,260 @@ def create_temp_table_for_session(conn, selected_lengths):
         conn.rollback()
         return None
 
+def drop_temp_table(conn, table_name):
+    """Удаляет временную таблицу сессии (например, при смене набора длин)."""
+    if not conn or not table_name: return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS pg_temp.{table_name};")
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Ошибка при удалении временной таблицы: {e}")
+        conn.rollback()
+        return False
+
+# --- Общие таблицы-подмножества ngrams по набору длин ---
+# Одна UNLOGGED-таблица на каждый различный набор длин, общая для всех сессий и процессов.
+# Сессии держат ссылки (строки ngram_subset_refs), которые продлеваются, пока сессия активна;
+# подмножество без живых ссылок удаляется, если им не пользовались дольше SUBSET_IDLE_TTL.
+SUBSETS_TABLE = "ngram_subsets"
+SUBSET_REFS_TABLE = "ngram_subset_refs"
+# Ссылка сессии считается брошенной, если ее не продлевали дольше этого интервала (сек)
+SUBSET_REF_TTL = int(os.getenv("SUBSET_REF_TTL", "1800"))
+# Подмножество без ссылок живет еще столько секунд: популярный набор длин не пересоздается между визитами
+SUBSET_IDLE_TTL = int(os.getenv("SUBSET_IDLE_TTL", "3600"))
+
+def _subset_table_name(lengths):
+    name = "ngrams_subset_" + "_".join(map(str, lengths))
+    if len(name) > 63:
+        name = "ngrams_subset_" + hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+    return name
+
+def _ensure_subset_registry(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {SUBSETS_TABLE} (
+            name text PRIMARY KEY,
+            lengths int[] NOT NULL UNIQUE,
+            data_version text,
+            created_at timestamptz NOT NULL DEFAULT NOW(),
+            last_used_at timestamptz NOT NULL DEFAULT NOW()
+        );
+        CREATE TABLE IF NOT EXISTS {SUBSET_REFS_TABLE} (
+            subset_name text NOT NULL REFERENCES {SUBSETS_TABLE} (name) ON DELETE CASCADE,
+            session_id text NOT NULL,
+            last_seen_at timestamptz NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (subset_name, session_id)
+        );
+    """)
+
+def _create_subset_table(cur, table_name, lengths):
+    cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+    cur.execute(f"CREATE UNLOGGED TABLE {table_name} (LIKE ngrams INCLUDING DEFAULTS);")
+    cur.execute(f"INSERT INTO {table_name} SELECT * FROM ngrams WHERE len = ANY(%s::int[]);", (list(lengths),))
+    # Только копия и статистика: индексы под реально используемые условия строит core.index_planner
+    cur.execute(f"ANALYZE {table_name};")
+
+def acquire_length_subset(conn, selected_lengths, session_id):
+    """
+    Возвращает имя общей таблицы-подмножества ngrams для набора длин и регистрирует ссылку сессии.
+    Если подмножество уже есть и построено по текущей версии данных, копирование и индексация
+    пропускаются; иначе таблица (пере)создается под advisory-блокировкой, так что параллельные
+    сессии с тем же набором длин дождутся одной сборки. None — при ошибке (например, нет прав на CREATE).
+    """
+    if not conn or not selected_lengths:
+        return None
+    lengths = sorted(set(int(length) for length in selected_lengths))
+    table_name = _subset_table_name(lengths)
+    data_version = get_ngrams_data_version(conn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (SUBSETS_TABLE,))
+            _ensure_subset_registry(cur)
+        conn.commit()
+        with conn.cursor() as cur:
+            # Блокировка набора длин держится до конца сборки; другие наборы собираются параллельно
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (table_name,))
+            cur.execute(f"SELECT data_version FROM {SUBSETS_TABLE} WHERE name = %s;", (table_name,))
+            row = cur.fetchone()
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table_name,))
+            table_exists = cur.fetchone()[0]
+            if row is None or not table_exists or (data_version is not None and row[0] != data_version):
+                _create_subset_table(cur, table_name, lengths)
+            cur.execute(f"""
+                INSERT INTO {SUBSETS_TABLE} (name, lengths, data_version) VALUES (%s, %s::int[], %s)
+                ON CONFLICT (name) DO UPDATE SET last_used_at = NOW(),
+                    data_version = COALESCE(EXCLUDED.data_version, {SUBSETS_TABLE}.data_version);
+            """, (table_name, lengths, data_version))
+            cur.execute(f"""
+                INSERT INTO {SUBSET_REFS_TABLE} (subset_name, session_id) VALUES (%s, %s)
+                ON CONFLICT (subset_name, session_id) DO UPDATE SET last_seen_at = NOW();
+            """, (table_name, session_id))
+        conn.commit()
+        return table_name
+    except Exception as e:
+        print(f"Ошибка при подготовке подмножества ngrams: {e}")
+        conn.rollback()
+        return None
+
+def touch_length_subset(conn, table_name, session_id):
+    """Продлевает ссылку сессии на подмножество; False — подмножество успели удалить."""
+    if not conn or not table_name: return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"UPDATE {SUBSET_REFS_TABLE} SET last_seen_at = NOW() WHERE subset_name = %s AND session_id = %s;", (table_name, session_id))
+            touched = cur.rowcount > 0
+            cur.execute(f"UPDATE {SUBSETS_TABLE} SET last_used_at = NOW() WHERE name = %s;", (table_name,))
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table_name,))
+            exists = cur.fetchone()[0]
+        conn.commit()
+        return touched and exists
+    except Exception as e:
+        print(f"Ошибка при продлении ссылки на подмножество: {e}")
+        conn.rollback()
+        return False
+
+def release_length_subset(conn, table_name, session_id):
+    """Снимает ссылку сессии; сама таблица удаляется позже в evict_length_subsets."""
+    if not conn or not table_name: return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {SUBSET_REFS_TABLE} WHERE subset_name = %s AND session_id = %s;", (table_name, session_id))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Ошибка при освобождении подмножества: {e}")
+        conn.rollback()
+        return False
+
+def evict_length_subsets(conn, ref_ttl=SUBSET_REF_TTL, idle_ttl=SUBSET_IDLE_TTL):
+    """
+    Удаляет брошенные ссылки сессий и подмножества без ссылок, простоявшие дольше idle_ttl.
+    Возвращает список удаленных таблиц (None — при ошибке).
+    """
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (SUBSETS_TABLE,))
+            if not cur.fetchone()[0]:
+                return []
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (SUBSETS_TABLE,))
+            cur.execute(f"DELETE FROM {SUBSET_REFS_TABLE} WHERE last_seen_at < NOW() - make_interval(secs => %s);", (ref_ttl,))
+            cur.execute(f"""
+                SELECT s.name FROM {SUBSETS_TABLE} s
+                WHERE s.last_used_at < NOW() - make_interval(secs => %s)
+                  AND NOT EXISTS (SELECT 1 FROM {SUBSET_REFS_TABLE} r WHERE r.subset_name = s.name);
+            """, (idle_ttl,))
+            evicted = []
+            for (table_name,) in cur.fetchall():
+                # Та же блокировка, что при сборке: не удаляем подмножество, которое как раз пересоздают
+                cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s));", (table_name,))
+                if not cur.fetchone()[0]:
+                    continue
+                cur.execute(f"DROP TABLE IF EXISTS {table_name};")
+                cur.execute(f"DELETE FROM {SUBSETS_TABLE} WHERE name = %s;", (table_name,))
+                evicted.append(table_name)
+        conn.commit()
+        return evicted
+    except Exception as e:
+        print(f"Ошибка при удалении неиспользуемых подмножеств: {e}")
+        conn.rollback()
+        return None
+
+# --- Индексы таблиц-подмножеств под используемые условия ---
+# Ключ индекса: ("order",) — сортировка результатов, ("id",) — полусоединение с ngram_tokens,
+# ("pattern_id",) — выборка n-грамм по паттернам из ngram_pattern_positions,
+# ("jsonb", тип, позиция) и ("codes", тип, позиция) — правила по JSONB и по колонкам кодов.
+# Позиция в условиях передается параметром, но при выполнении с конкретными значениями
+# (custom plan) выражение сворачивается в константу и совпадает с выражением индекса.
+
+def predicate_index_keys(blocks, features=frozenset()):
+    """
+    Ключи индексов, которые пригодились бы условиям build_where_clauses для этих блоков
+    (тот же выбор способа компиляции правил по готовым производным структурам).
+    """
+    keys = [("order",)]
+    rules = [
+        (block, rule) for block in blocks for rule in block['rules']
+        if rule['values'] and COLUMN_MAPPING.get(rule['type'])
+    ]
+    if 'pattern_positions' in features:
+        if any(rule['type'] in PATTERN_POSITION_TYPES for _, rule in rules):
+            keys.append(("pattern_id",))
+        rules = [(block, rule) for block, rule in rules if rule['type'] not in PATTERN_POSITION_TYPES]
+    if 'token_index' in features:
+        if rules:
+            keys.append(("id",))
+        return keys
+    for block, rule in rules:
+        if rule['type'] == 'morph' and 'morph_bits' in features:
+            continue # побитовое И по маскам индексом не ускоряется
+        if 'encoded' in features and rule['type'] in CODE_COLUMN_MAPPING:
+            keys.append(("codes", rule['type'], block['position']))
+        else:
+            keys.append(("jsonb", rule['type'], block['position']))
+    return list(dict.fromkeys(keys))
+
+def _index_definition(table_name, key):
+    """Имя индекса и его определение (метод и выражение) для ключа predicate_index_keys."""
+    if key[0] == "order":
+        suffix, definition = "order", "(freq_mln, id)"
+    elif key[0] == "id":
+        suffix, definition = "id", "(id)"
+    elif key[0] == "pattern_id":
+        suffix, definition = "pattern_id", "(pattern_id)"
+    elif key[0] == "codes":
+        _, attr, position = key
+        suffix, definition = f"{attr}_c{position}", f"(({CODE_COLUMN_MAPPING[attr][1]}[{int(position) + 1}]))"
+    else:
+        _, attr, position = key
+        column = COLUMN_MAPPING[attr]
+        if column == 'morph':
+            suffix, definition = f"morph_j{position}", f"USING gin ((morph->{int(position)}))"
+        else:
+            suffix, definition = f"{attr}_j{position}", f"(({column}->>{int(position)}))"
+    index_name = f"{table_name}_{suffix}_idx"
+    if len(index_name) > 63:
+        index_name = "ngrams_idx_" + hashlib.sha1(index_name.encode('utf-8')).hexdigest()[:20]
+    return index_name, definition
+
+def build_subset_index(conn, table_name, key, concurrently=True):
+    """
+    Строит индекс таблицы-подмножества под ключ условия, если его еще нет.
+    Общие подмножества индексируются CONCURRENTLY, не блокируя запросы сессий (нужен autocommit);
+    временные таблицы — обычным CREATE INDEX на подключении сессии. Возвращает True, если индекс есть.
+    """
+    if not conn: return False
+    index_name, definition = _index_definition(table_name, key)
+    previous_autocommit = conn.autocommit
+    try:
+        if concurrently:
+            conn.rollback()
+            conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table_name,))
+            if not cur.fetchone()[0]:
+                return False
+            cur.execute(f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name} ON {table_name} {definition};")
+        if not concurrently:
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"Ошибка при построении индекса {index_name}: {e}")
+        if concurrently:
+            # Прерванное CONCURRENTLY оставляет невалидный индекс, который IF NOT EXISTS больше не перестроит
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f"DROP INDEX IF EXISTS {index_name};")
+            except Exception:
+                pass
+        else:
+            conn.rollback()
+        return False
+    finally:
+        if concurrently:
+            conn.autocommit = previous_autocommit
+
 def get_all_unique_lengths(conn):
     if not conn: return []
     try:
@@ -461,140 +870,366 @@ def get_all_unique_lengths(conn):
         print(f"Ошибка при получении длин: {e}")
         return []
 
-def get_unique_values_for_rule(conn, position, rule_type, selected_lengths, all_blocks, block_id_to_exclude, rule_id_to_exclude, min_frequency, min_quantity, table_name="ngrams"):
-    if not conn: return []
-    db_column_name = COLUMN_MAPPING.get(rule_type, rule_type)
-    preceding_where_clauses = build_where_clauses(all_blocks, block_id_to_exclude, rule_id_to_exclude, table_name=table_name)
-    
+# Признаки хранения, при которых build_where_clauses строит подзапросы (полусоединения по индексам).
+# В пакетном запросе фасетов условие каждого правила вычисляется для каждой строки, поэтому там
+# используются только сравнения колонок самой строки: подзапрос выполнялся бы на каждую строку и правило.
+_SUBQUERY_FEATURES = frozenset({'token_index', 'pattern_positions'})
+
+def get_unique_values_for_rules(conn, rule_requests, selected_lengths, all_blocks, min_frequency, min_quantity, table_name="ngrams"):
+    """
+    Списки значений для всех правил на экране за один проход по таблице.
+    rule_requests — последовательность (block_id, rule_id, position, rule_type).
+    Для каждой строки через LATERAL VALUES вычисляется по одному флагу на правило: «строка проходит
+    все фильтры, кроме этого правила», и значение на позиции правила; группировка идет по (правило, значение).
+    Флаги строятся из сравнений колонок строки (без подзапросов, см. _SUBQUERY_FEATURES). При готовых
+    словарях ('encoded') группировка идет по целочисленным кодам, а расшифровываются только итоги.
+    Возвращает словарь {rule_id: [(value, F, Q), ...]}; None — запрос не выполнен (нет подключения,
+    ошибка, отмена или statement_timeout), такой ответ нельзя кэшировать как пустой.
+    """
+    if not rule_requests: return {}
+    if not conn: return None
+    features = get_storage_features(conn, table_name)
+    row_features = features - _SUBQUERY_FEATURES
+
+    common_where = []
+    common_params = []
     if selected_lengths:
-        preceding_where_clauses.append(f"{table_name}.len IN ({', '.join(map(str, selected_lengths))})")
-    
+        common_where.append(f"{table_name}.len = ANY(%s::int[])")
+        common_params.append(list(selected_lengths))
     if min_frequency > 0:
-        preceding_where_clauses.append(f"{table_name}.freq_mln >= {float(min_frequency)}")
+        common_where.append(f"{table_name}.freq_mln >= %s")
+        common_params.append(float(min_frequency))
+
+    values_rows = []
+    values_params = []
+    for rule_key, (block_id, rule_id, position, rule_type) in enumerate(rule_requests):
+        db_column_name = COLUMN_MAPPING.get(rule_type, rule_type)
+        clauses, params = build_where_clauses(all_blocks, block_id, rule_id, table_name=table_name, features=row_features)
+        if 'encoded' in features and rule_type in CODE_COLUMN_MAPPING:
+            _, code_col, _ = CODE_COLUMN_MAPPING[rule_type]
+            length_check = f"array_length({table_name}.{code_col}, 1) > %s"
+            codes_expr = f"ARRAY[{table_name}.{code_col}[%s::int + 1]::int]"
+            values_expr = "NULL::text[]"
+        else:
+            length_check = f"jsonb_array_length({table_name}.{db_column_name}) > %s"
+            codes_expr = "NULL::int[]"
+            if db_column_name == 'morph':
+                values_expr = f"ARRAY(SELECT jsonb_array_elements_text({table_name}.morph->%s::int))"
+            else:
+                values_expr = f"ARRAY[{table_name}.{db_column_name}->>%s::int]"
+        ok_expr = " AND ".join([length_check] + clauses)
+        values_rows.append(f"(%s::int, %s::text, ({ok_expr}), {codes_expr}, {values_expr})")
+        values_params.extend([rule_key, rule_type, position] + params + [position])
 
-    preceding_where_str = " AND " + " AND ".join(preceding_where_clauses) if preceding_where_clauses else ""
-    base_where = f"jsonb_array_length({table_name}.{db_column_name}) > {position}"
+    where_str = " AND ".join(common_where + ["r.ok"])
+    having_clause = "HAVING COUNT(*) >= %s" if min_quantity > 0 else ""
+    having_params = [int(min_quantity)] if min_quantity > 0 else []
 
-    # Применяем min_quantity через HAVING для корректной фильтрации
-    having_clause = f"HAVING COUNT(id) >= {int(min_quantity)}" if min_quantity > 0 else ""
+    # unnest от двух массивов дополняет более короткий NULL-ами: у правила заполнен либо массив кодов, либо значений
+    query = f"""
+        SELECT agg.rule_key, COALESCE(voc.value, agg.value), agg.total_freq, agg.total_qty
+        FROM (
+            SELECT r.rule_key, r.attr, v.code, v.value, SUM({table_name}.freq_mln) AS total_freq, COUNT(*) AS total_qty
+            FROM {table_name}
+            CROSS JOIN LATERAL (VALUES {", ".join(values_rows)}) AS r(rule_key, attr, ok, codes, vals)
+            CROSS JOIN LATERAL unnest(r.codes, r.vals) AS v(code, value)
+            WHERE {where_str} AND (v.code IS NOT NULL OR v.value IS NOT NULL)
+            GROUP BY 1, 2, 3, 4 {having_clause}
+        ) agg
+        LEFT JOIN {NGRAM_VOCAB_TABLE} voc ON agg.code IS NOT NULL AND voc.attr = agg.attr AND voc.code = agg.code
+        ORDER BY 1, 3 DESC;
+    """
+    # Параметры LATERAL стоят в тексте запроса раньше условий WHERE
+    params = values_params + common_params + having_params
 
-    query_template = "SELECT {field}, SUM(freq_mln), COUNT(id) FROM {table_name} WHERE {base_where} {preceding_where_str} GROUP BY 1 {having_clause} ORDER BY 2 DESC;"
-    if db_column_name == 'morph':
-        field = f"jsonb_array_elements_text({table_name}.morph->{position})"
-    else:
-        field = f"{table_name}.{db_column_name}->>{position}"
-    
-    query = query_template.format(field=field, table_name=table_name, base_where=base_where, preceding_where_str=preceding_where_str, having_clause=having_clause)
-    
+    facets = {rule_id: [] for _, rule_id, _, _ in rule_requests}
     try:
         with conn.cursor() as cur:
-            cur.execute(query)
-            return [(r[0], r[1], r[2]) for r in cur.fetchall() if r[0] is not None]
+            execute_prepared(cur, query, params)
+            for rule_key, value, total_freq, total_qty in cur.fetchall():
+                if value is not None:
+                    facets[rule_requests[rule_key][1]].append((value, total_freq, total_qty))
+        return facets
     except Exception as e:
-        print(f"Ошибка при получении уникальных значений: {e}")
-        return []
+        print(f"Ошибка при пакетном получении уникальных значений: {e}")
+        conn.rollback()
+        return None
 
 def get_frequent_sequences(conn, sequence_type, phrase_length, filter_blocks, selected_lengths, table_name="ngrams", limit=100):
-    if not conn: return []
+    """Частые последовательности значений sequence_type для длины phrase_length; None — запрос не выполнен."""
+    if not conn: return None
     db_column_name = COLUMN_MAPPING.get(sequence_type, sequence_type)
     
     if not (1 <= phrase_length <= 10): # Ограничение на длину фразы для безопасности и производительности
         return []
 
-    select_parts = []
-    group_by_parts = []
-    for i in range(phrase_length):
-        select_parts.append(f"{table_name}.{db_column_name}->>{i}")
-        group_by_parts.append(f"{table_name}.{db_column_name}->>{i}")
-    
-    select_clause = ", ".join(select_parts)
-    group_by_clause = ", ".join(group_by_parts)
+    features = get_storage_features(conn, table_name)
+    has_active_rules = any(r.get('values') for b in filter_blocks for r in b['rules'])
+    if 'sequence_freq' in features and not has_active_rules and sequence_type in SEQUENCE_TYPES:
+        # Без фильтров список последовательностей заранее посчитан в ngram_sequence_freq
+        if selected_lengths and phrase_length not in selected_lengths:
+            return []
+        try:
+            rows = _get_frequent_sequences_materialized(conn, sequence_type, phrase_length, limit)
+            if rows is not None:
+                return rows
+        except psycopg2.extensions.QueryCanceledError as e:
+            # Отмененный запрос не должен продолжаться полным подсчетом
+            print(f"Запрос частых последовательностей прерван: {e}")
+            conn.rollback()
+            return None
+        except Exception as e:
+            print(f"Ошибка при чтении таблицы частых последовательностей: {e}")
+            conn.rollback()
+
+    use_codes = 'encoded' in features and sequence_type in CODE_COLUMN_MAPPING
 
-    where_clauses = build_where_clauses(filter_blocks, table_name=table_name)
+    where_clauses, params = build_where_clauses(filter_blocks, table_name=table_name, features=features)
     if selected_lengths:
-        where_clauses.append(f"{table_name}.len IN ({', '.join(map(str, selected_lengths))})")
+        where_clauses.append(f"{table_name}.len = ANY(%s::int[])")
+        params.append(list(selected_lengths))
 
     # Добавляем условие на длину фразы для текущего запроса
-    where_clauses.append(f"len = {phrase_length}")
-    where_clauses.append(f"jsonb_array_length({table_name}.{db_column_name}) = {phrase_length}")
+    where_clauses.append(f"{table_name}.len = %s")
+    if use_codes:
+        _, code_col, _ = CODE_COLUMN_MAPPING[sequence_type]
+        where_clauses.append(f"array_length({table_name}.{code_col}, 1) = %s")
+    else:
+        where_clauses.append(f"jsonb_array_length({table_name}.{db_column_name}) = %s")
+    params.extend([phrase_length, phrase_length])
 
     full_where_clause = " AND ".join(where_clauses) if where_clauses else "1=1"
 
-    query = f"""
-        SELECT
-            {select_clause},
-            SUM(freq_mln) as total_frequency,
-            COUNT(id) as total_quantity
-        FROM
-            {table_name}
-        WHERE
-            {full_where_clause}
-        GROUP BY
-            {group_by_clause}
-        ORDER BY
-            total_frequency DESC
-        LIMIT {limit};
-    """
+    if use_codes:
+        # Группируем массивы кодов целиком и расшифровываем только попавшие в топ последовательности
+        query = f"""
+            SELECT
+                ARRAY(SELECT v.value FROM unnest(agg.codes) WITH ORDINALITY AS c(code, ord)
+                      LEFT JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = '{sequence_type}' AND v.code = c.code
+                      ORDER BY c.ord),
+                agg.total_frequency,
+                agg.total_quantity
+            FROM (
+                SELECT {table_name}.{code_col} AS codes, SUM(freq_mln) AS total_frequency, COUNT(id) AS total_quantity
+                FROM {table_name}
+                WHERE {full_where_clause}
+                GROUP BY 1
+                ORDER BY 2 DESC
+                LIMIT %s
+            ) agg
+            ORDER BY 2 DESC;
+        """
+    else:
+        # Позиции 0..N-1 задаются длиной фразы, т.е. формой запроса, поэтому остаются в тексте SQL
+        select_clause = ", ".join(f"{table_name}.{db_column_name}->>{i}" for i in range(phrase_length))
+        group_by_clause = ", ".join(str(i + 1) for i in range(phrase_length))
+        query = f"""
+            SELECT
+                {select_clause},
+                SUM(freq_mln) as total_frequency,
+                COUNT(id) as total_quantity
+            FROM
+                {table_name}
+            WHERE
+                {full_where_clause}
+            GROUP BY
+                {group_by_clause}
+            ORDER BY
+                total_frequency DESC
+            LIMIT %s;
+        """
+    params.append(int(limit))
     
     try:
         with conn.cursor() as cur:
-            cur.execute(query)
-            # Возвращаем список кортежей: (val1, val2, ..., valN, total_frequency)
+            execute_prepared(cur, query, params)
+            # Возвращаем список кортежей: (val1, val2, ..., valN, total_frequency, total_quantity)
+            if use_codes:
+                return [tuple(row[0]) + (row[1], row[2]) for row in cur.fetchall()]
             return cur.fetchall()
     except Exception as e:
         print(f"Ошибка при получении частых последовательностей {sequence_type} для длины {phrase_length}: {e}")
-        return []
+        conn.rollback()
+        return None
 
-def get_suggestion_data(conn, selected_lengths, filter_blocks, min_frequency, min_quantity, table_name="ngrams"):
+def get_suggestion_data(conn, selected_lengths, filter_blocks, min_frequency, min_quantity, table_name="ngrams", sample_percent=None):
     """
     Получает данные для панели подсказок.
     Эта версия оптимизирована и использует один сложный SQL-запрос вместо множества UNION ALL,
     что значительно повышает производительность.
+    Если задан sample_percent, агрегаты считаются по TABLESAMPLE BERNOULLI выборке и масштабируются
+    (см. _scale_sampled_suggestions); такие записи помечены ключом "rel_err".
+    Если активны только правила dep/pos/tag и готова позиционная таблица паттернов, подсказки
+    dep/pos/tag складываются из итогов unique_patterns (см. _get_structural_suggestions_from_patterns),
+    а по n-граммам считается только morph.
+    None — запрос не выполнен (нет подключения, ошибка, отмена или statement_timeout).
     """
-    if not conn or not selected_lengths:
+    if not selected_lengths:
         return {}
+    if not conn:
+        return None
 
     max_len = max(selected_lengths)
 
-    where_clauses = build_where_clauses(filter_blocks, table_name=table_name)
+    features = get_storage_features(conn, table_name)
+    has_active_rules = any(r.get('values') for b in filter_blocks for r in b['rules'])
+    if 'facet_cube' in features and not has_active_rules and min_frequency <= 0:
+        # Без фильтров ответ полностью определяется выбранными длинами и берется из куба фасетов
+        try:
+            cube_data = _get_suggestion_data_from_cube(conn, selected_lengths, min_quantity)
+            if cube_data is not None:
+                return cube_data
+        except psycopg2.extensions.QueryCanceledError as e:
+            print(f"Запрос подсказок прерван: {e}")
+            conn.rollback()
+            return None
+        except Exception as e:
+            print(f"Ошибка при чтении куба фасетов: {e}")
+            conn.rollback()
+
+    # Итоги паттернов учитывают все n-граммы паттерна, поэтому мин. частотность и правила
+    # token/lemma/morph требуют подсчета по самим n-граммам
+    has_ngram_rules = any(r.get('values') and r['type'] not in PATTERN_POSITION_TYPES for b in filter_blocks for r in b['rules'])
+    structural_rows = None
+    if 'pattern_positions' in features and not has_ngram_rules and min_frequency <= 0:
+        try:
+            structural_rows = _get_structural_suggestions_from_patterns(conn, selected_lengths, filter_blocks, min_quantity)
+        except psycopg2.extensions.QueryCanceledError as e:
+            print(f"Запрос подсказок прерван: {e}")
+            conn.rollback()
+            return None
+        except Exception as e:
+            print(f"Ошибка при подсчете подсказок по паттернам: {e}")
+            conn.rollback()
+    morph_only = structural_rows is not None
+
+    where_clauses, params = build_where_clauses(filter_blocks, table_name=table_name, features=features)
     if table_name == "ngrams":
-        where_clauses.append(f"len IN ({', '.join(map(str, selected_lengths))})")
+        where_clauses.append("len = ANY(%s::int[])")
+        params.append(list(selected_lengths))
     if min_frequency > 0:
-        where_clauses.append(f"freq_mln >= {float(min_frequency)}")
+        where_clauses.append("freq_mln >= %s")
+        params.append(float(min_frequency))
 
     base_where_str = " AND ".join(where_clauses) if where_clauses else "1=1"
 
-    query = f"""
-    WITH filtered_ngrams AS (
-        SELECT * FROM {table_name} WHERE {base_where_str}
-    ),
-    unpacked_values AS (
-        SELECT i.pos AS position, 'dep' AS type, fn.deps->>i.pos AS value, fn.freq_mln
-        FROM filtered_ngrams fn, LATERAL generate_series(0, jsonb_array_length(fn.deps) - 1) AS i(pos)
-        UNION ALL
-        SELECT i.pos AS position, 'pos' AS type, fn.pos->>i.pos AS value, fn.freq_mln
-        FROM filtered_ngrams fn, LATERAL generate_series(0, jsonb_array_length(fn.pos) - 1) AS i(pos)
-        UNION ALL
-        SELECT i.pos AS position, 'tag' AS type, fn.tags->>i.pos AS value, fn.freq_mln
-        FROM filtered_ngrams fn, LATERAL generate_series(0, jsonb_array_length(fn.tags) - 1) AS i(pos)
+    # Доля выборки; HAVING сравнивает количество в выборке с порогом, уменьшенным в той же пропорции.
+    # BERNOULLI отбирает строки независимо, на чем основана оценка погрешности в _scale_sampled_suggestions;
+    # SYSTEM берет страницы целиком, а строки одной страницы похожи (их вставляли подряд), и реальная
+    # погрешность была бы заметно выше. BERNOULLI читает все страницы, но экономит на разборе и агрегации
+    sample_rate = min(float(sample_percent), 100.0) / 100.0 if sample_percent else 1.0
+    sample_clause = "TABLESAMPLE BERNOULLI (%s)" if sample_rate < 1.0 else ""
+    if sample_clause:
+        params.insert(0, sample_rate * 100.0)
+    min_sample_quantity = min_quantity * sample_rate if sample_clause else int(min_quantity)
+
+    if 'encoded' in features:
+        # dep/pos/tag группируются по целочисленным кодам, значения подставляются из словаря
+        # уже после агрегации; morph разворачивается из JSONB или считается по битовым маскам
+        if 'morph_bits' in features:
+            # Наборы признаков на позиции повторяются часто: сначала группируем слова масок,
+            # затем раскладываем немногие различные слова на биты через словарь
+            morph_totals_sql = f"""
+        morph_words AS (
+            SELECT (u.ord - 1) / {MORPH_BIT_WORDS} AS position, (u.ord - 1) %% {MORPH_BIT_WORDS} AS word, u.bits,
+                   SUM(fn.freq_mln) AS freq, COUNT(*) AS qty
+            FROM filtered_ngrams fn, unnest(fn.morph_bits) WITH ORDINALITY AS u(bits, ord)
+            WHERE u.bits <> 0
+            GROUP BY 1, 2, 3
+        ),
+        morph_totals AS (
+            SELECT mw.position::int AS position, 'morph' AS type, v.value, SUM(mw.freq) AS total_freq, SUM(mw.qty) AS total_qty
+            FROM morph_words mw
+            JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = 'morph' AND (v.code - 1) / 64 = mw.word
+                 AND (mw.bits >> ((v.code - 1) %% 64)) & 1 = 1
+            WHERE v.value != '' AND mw.position < %s
+            GROUP BY mw.position, v.value
+            HAVING SUM(mw.qty) >= %s
+        )"""
+        else:
+            morph_totals_sql = """
+        morph_totals AS (
+            SELECT i.pos AS position, 'morph' AS type, m.value, SUM(fn.freq_mln) AS total_freq, COUNT(*) AS total_qty
+            FROM filtered_ngrams fn,
+                    LATERAL generate_series(0, jsonb_array_length(fn.morph) - 1) AS i(pos),
+                    LATERAL jsonb_array_elements_text(fn.morph->i.pos) AS m(value)
+            WHERE m.value IS NOT NULL AND m.value != '' AND i.pos < %s
+            GROUP BY i.pos, m.value
+            HAVING COUNT(*) >= %s
+        )"""
+        if morph_only:
+            query = f"""
+        WITH filtered_ngrams AS (
+            SELECT freq_mln, {'morph_bits' if 'morph_bits' in features else 'morph'} FROM {table_name} {sample_clause} WHERE {base_where_str}
+        ),{morph_totals_sql}
+        SELECT mt.position, mt.type, mt.value, mt.total_freq, mt.total_qty FROM morph_totals mt
+        ORDER BY 1, 4 DESC;
+        """
+            params.extend([max_len, min_sample_quantity])
+        else:
+            query = f"""
+        WITH filtered_ngrams AS (
+            SELECT freq_mln, dep_codes, pos_codes, tag_codes, {'morph_bits' if 'morph_bits' in features else 'morph'} FROM {table_name} {sample_clause} WHERE {base_where_str}
+        ),
+        coded_values AS (
+            SELECT u.ord - 1 AS position, 'dep' AS type, u.code, fn.freq_mln
+            FROM filtered_ngrams fn, unnest(fn.dep_codes) WITH ORDINALITY AS u(code, ord)
+            UNION ALL
+            SELECT u.ord - 1 AS position, 'pos' AS type, u.code, fn.freq_mln
+            FROM filtered_ngrams fn, unnest(fn.pos_codes) WITH ORDINALITY AS u(code, ord)
+            UNION ALL
+            SELECT u.ord - 1 AS position, 'tag' AS type, u.code, fn.freq_mln
+            FROM filtered_ngrams fn, unnest(fn.tag_codes) WITH ORDINALITY AS u(code, ord)
+        ),
+        coded_totals AS (
+            SELECT cv.position, cv.type, cv.code, SUM(cv.freq_mln) AS total_freq, COUNT(*) AS total_qty
+            FROM coded_values cv
+            WHERE cv.code IS NOT NULL AND cv.position < %s
+            GROUP BY cv.position, cv.type, cv.code
+            HAVING COUNT(*) >= %s
+        ),{morph_totals_sql}
+        SELECT ct.position::int, ct.type, v.value, ct.total_freq, ct.total_qty
+        FROM coded_totals ct JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = ct.type AND v.code = ct.code
+        WHERE v.value != ''
         UNION ALL
-        SELECT i.pos AS position, 'morph' AS type, m.value, fn.freq_mln
-        FROM filtered_ngrams fn,
-                LATERAL generate_series(0, jsonb_array_length(fn.morph) - 1) AS i(pos),
-                LATERAL jsonb_array_elements_text(fn.morph->i.pos) AS m(value)
-    )
-    SELECT
-        uv.position, uv.type, uv.value, SUM(uv.freq_mln) AS total_freq, COUNT(*) AS total_qty
-    FROM unpacked_values uv
-    WHERE uv.value IS NOT NULL AND uv.value != '' AND uv.position < {max_len}
-    GROUP BY uv.position, uv.type, uv.value
-    HAVING COUNT(*) >= {int(min_quantity)}
-    ORDER BY uv.position, total_freq DESC;
-    """
+        SELECT mt.position, mt.type, mt.value, mt.total_freq, mt.total_qty FROM morph_totals mt
+        ORDER BY 1, 4 DESC;
+        """
+            params.extend([max_len, min_sample_quantity, max_len, min_sample_quantity])
+    else:
+        structural_values_sql = "" if morph_only else """
+            SELECT i.pos AS position, 'dep' AS type, fn.deps->>i.pos AS value, fn.freq_mln
+            FROM filtered_ngrams fn, LATERAL generate_series(0, jsonb_array_length(fn.deps) - 1) AS i(pos)
+            UNION ALL
+            SELECT i.pos AS position, 'pos' AS type, fn.pos->>i.pos AS value, fn.freq_mln
+            FROM filtered_ngrams fn, LATERAL generate_series(0, jsonb_array_length(fn.pos) - 1) AS i(pos)
+            UNION ALL
+            SELECT i.pos AS position, 'tag' AS type, fn.tags->>i.pos AS value, fn.freq_mln
+            FROM filtered_ngrams fn, LATERAL generate_series(0, jsonb_array_length(fn.tags) - 1) AS i(pos)
+            UNION ALL"""
+        query = f"""
+        WITH filtered_ngrams AS (
+            SELECT * FROM {table_name} {sample_clause} WHERE {base_where_str}
+        ),
+        unpacked_values AS ({structural_values_sql}
+            SELECT i.pos AS position, 'morph' AS type, m.value, fn.freq_mln
+            FROM filtered_ngrams fn,
+                    LATERAL generate_series(0, jsonb_array_length(fn.morph) - 1) AS i(pos),
+                    LATERAL jsonb_array_elements_text(fn.morph->i.pos) AS m(value)
+        )
+        SELECT
+            uv.position, uv.type, uv.value, SUM(uv.freq_mln) AS total_freq, COUNT(*) AS total_qty
+        FROM unpacked_values uv
+        WHERE uv.value IS NOT NULL AND uv.value != '' AND uv.position < %s
+        GROUP BY uv.position, uv.type, uv.value
+        HAVING COUNT(*) >= %s
+        ORDER BY uv.position, total_freq DESC;
+        """
+        params.extend([max_len, min_sample_quantity])
 
     try:
         with conn.cursor() as cur:
-            cur.execute(query)
+            execute_prepared(cur, query, params)
             results = cur.fetchall()
             
             suggestion_data = {}
@@ -607,11 +1242,58 @@ def get_suggestion_data(conn, selected_lengths, filter_blocks, min_frequency, mi
                     suggestion_data[pos] = []
                 suggestion_data[pos].append({"type": r_type, "value": r_val, "freq": r_freq, "qty": r_qty})
 
+            if sample_clause:
+                suggestion_data = _scale_sampled_suggestions(suggestion_data, sample_rate)
+            if morph_only:
+                # Точные итоги dep/pos/tag по паттернам вливаются в списки позиций с сохранением порядка по F
+                for pos, r_type, r_val, r_freq, r_qty in structural_rows:
+                    if (pos, r_type) in active_filters:
+                        continue
+                    suggestion_data.setdefault(pos, []).append({"type": r_type, "value": r_val, "freq": r_freq, "qty": r_qty})
+                for entries in suggestion_data.values():
+                    entries.sort(key=lambda entry: entry["freq"], reverse=True)
             return suggestion_data
     except Exception as e:
         print(f"Ошибка при получении данных для подсказок: {e}")
         conn.rollback()
-        return {}
+        return None
+
+def _get_structural_suggestions_from_patterns(conn, selected_lengths, filter_blocks, min_quantity):
+    """
+    Подсказки dep/pos/tag из итогов паттернов: total_frequency/total_quantity паттернов выбранных длин,
+    прошедших структурные правила, суммируются по (позиция, тип, значение) позиционной таблицы паттернов.
+    Годится, только когда все активные правила — dep/pos/tag и мин. частотность не задана.
+    Возвращает строки (position, type, value, total_freq, total_qty), упорядоченные как в get_suggestion_data.
+    """
+    where_clauses, params = build_where_clauses(filter_blocks, table_name="fp", features=frozenset({'pattern_positions'}))
+    where_str = "".join(f" AND {clause}" for clause in where_clauses)
+    query = f"""
+        SELECT fp.position::int, t.type, t.value, SUM(up.total_frequency) AS total_freq, SUM(up.total_quantity) AS total_qty
+        FROM {PATTERN_POSITIONS_TABLE} fp
+        JOIN unique_patterns up ON up.id = fp.pattern_id
+        CROSS JOIN LATERAL (VALUES ('dep', fp.dep), ('pos', fp.pos), ('tag', fp.tag)) AS t(type, value)
+        WHERE up.phrase_length = ANY(%s::int[]) AND fp.position < %s AND t.value IS NOT NULL{where_str}
+        GROUP BY 1, 2, 3
+        HAVING SUM(up.total_quantity) >= %s
+        ORDER BY 1, 4 DESC;
+    """
+    with conn.cursor() as cur:
+        execute_prepared(cur, query, [list(selected_lengths), max(selected_lengths)] + params + [int(min_quantity)])
+        return cur.fetchall()
+
+def _scale_sampled_suggestions(suggestion_data, sample_rate):
+    """
+    Переводит агрегаты по выборке в оценки для всей таблицы: F и Q делятся на долю выборки.
+    rel_err — относительная погрешность (95%) оценки Q при независимом отборе строк (TABLESAMPLE BERNOULLI):
+    1.96 * sqrt((1 - r) / q), где q — количество в выборке; та же доля используется как оценка для F.
+    """
+    for entries in suggestion_data.values():
+        for entry in entries:
+            sample_qty = int(entry["qty"])
+            entry["rel_err"] = 1.96 * ((1.0 - sample_rate) / sample_qty) ** 0.5 if sample_qty else 1.0
+            entry["freq"] = float(entry["freq"]) / sample_rate
+            entry["qty"] = round(sample_qty / sample_rate)
+    return suggestion_data
 
 # --- Функции для сохранения/загрузки НАБОРОВ ---
 def save_filter_set(conn, name, data):
@@ -1201,58 +1883,1247 @@ def execute_multiple_merges(conn, merges):
 
 
 
+# --- Производные структуры для ускорения фильтрации ---
+# Готовность каждой производной структуры хранится в ngram_derived_state;
+# компилятор фильтров использует только структуры, помеченные как готовые.
+DERIVED_STATE_TABLE = "ngram_derived_state"
+NGRAM_TOKENS_TABLE = "ngram_tokens"
+STORAGE_FEATURES_TTL = 60
+
+_storage_features = {"checked_at": 0.0, "value": frozenset()}
+_storage_features_lock = threading.Lock()
+
+def _ensure_derived_state_table(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DERIVED_STATE_TABLE} (
+            name text PRIMARY KEY,
+            ready boolean NOT NULL DEFAULT FALSE,
+            refreshed_at timestamptz
+        );
+    """)
+
+def _set_derived_state(cur, name, ready):
+    cur.execute(f"""
+        INSERT INTO {DERIVED_STATE_TABLE} (name, ready, refreshed_at) VALUES (%s, %s, NOW())
+        ON CONFLICT (name) DO UPDATE SET ready = EXCLUDED.ready, refreshed_at = EXCLUDED.refreshed_at;
+    """, (name, ready))
+
+def invalidate_storage_features():
+    with _storage_features_lock:
+        _storage_features["checked_at"] = 0.0
+    with _table_columns_lock:
+        _table_columns.clear()
+
+def get_storage_features(conn, table_name="ngrams"):
+    """
+    Возвращает frozenset имен готовых производных структур (например, 'token_index').
+    Результат кэшируется в процессе на STORAGE_FEATURES_TTL секунд.
+    Для таблицы-подмножества или временной таблицы (table_name) исключаются структуры, колонок
+    которых в ней нет: таблица, скопированная из ngrams до rebuild_ngram_vocabulary или
+    rebuild_ngram_morph_bits, не содержит *_codes и morph_bits.
+    """
+    features = _get_global_storage_features(conn)
+    if table_name == "ngrams" or not features & _FEATURE_COLUMNS.keys():
+        return features
+    columns = _get_table_columns(conn, table_name)
+    return frozenset(
+        feature for feature in features
+        if feature not in _FEATURE_COLUMNS or columns.issuperset(_FEATURE_COLUMNS[feature])
+    )
+
+_table_columns = {}  # имя таблицы -> (время проверки, frozenset колонок)
+_table_columns_lock = threading.Lock()
+
+def _get_table_columns(conn, table_name):
+    """Колонки таблицы (временная таблица видна только своему подключению); кэшируются на STORAGE_FEATURES_TTL секунд."""
+    with _table_columns_lock:
+        entry = _table_columns.get(table_name)
+        if entry is not None and time.monotonic() - entry[0] < STORAGE_FEATURES_TTL:
+            return entry[1]
+    if not conn: return frozenset()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT attname FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped;
+            """, (table_name,))
+            columns = frozenset(row[0] for row in cur.fetchall())
+    except Exception as e:
+        print(f"Ошибка при чтении колонок таблицы {table_name}: {e}")
+        conn.rollback()
+        return frozenset()
+    with _table_columns_lock:
+        _table_columns[table_name] = (time.monotonic(), columns)
+    return columns
+
+def _get_global_storage_features(conn):
+    with _storage_features_lock:
+        if time.monotonic() - _storage_features["checked_at"] < STORAGE_FEATURES_TTL:
+            return _storage_features["value"]
+    if not conn: return frozenset()
+    features = frozenset()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (DERIVED_STATE_TABLE,))
+            if cur.fetchone()[0]:
+                cur.execute(f"SELECT name FROM {DERIVED_STATE_TABLE} WHERE ready;")
+                features = frozenset(row[0] for row in cur.fetchall())
+    except Exception as e:
+        print(f"Ошибка при определении производных структур: {e}")
+        conn.rollback()
+        return frozenset()
+    with _storage_features_lock:
+        _storage_features["value"] = features
+        _storage_features["checked_at"] = time.monotonic()
+    return features
+
+# Версия данных ngrams для ключей постоянного кэша результатов (core.result_cache)
+_data_version = {"checked_at": 0.0, "value": None}
+_data_version_lock = threading.Lock()
+
+def install_ngrams_data_version(conn):
+    """
+    Включает настоящую версию данных ngrams: строка 'data_version' в ngram_derived_state, у которой
+    statement-level триггеры на INSERT/UPDATE/DELETE/TRUNCATE ngrams обновляют refreshed_at.
+    Обновление идет в той же транзакции, что и изменение: откатанная запись версию не меняет,
+    а после перезапуска сервера версия сохраняется.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION ngrams_data_version_bump() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE {DERIVED_STATE_TABLE} SET refreshed_at = clock_timestamp() WHERE name = 'data_version';
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            for suffix, event in (('ins', 'INSERT'), ('upd', 'UPDATE'), ('del', 'DELETE'), ('trunc', 'TRUNCATE')):
+                cur.execute(f"DROP TRIGGER IF EXISTS ngrams_data_version_{suffix} ON ngrams;")
+                cur.execute(f"CREATE TRIGGER ngrams_data_version_{suffix} AFTER {event} ON ngrams FOR EACH STATEMENT EXECUTE FUNCTION ngrams_data_version_bump();")
+            _set_derived_state(cur, 'data_version', True)
+            conn.commit()
+        invalidate_storage_features()
+        with _data_version_lock:
+            _data_version["checked_at"] = 0.0
+        return True
+    except Exception as e:
+        print(f"Ошибка при включении версии данных: {e}")
+        conn.rollback()
+        return False
+
+def get_ngrams_data_version(conn):
+    """
+    Возвращает строку, меняющуюся при любом изменении ngrams. Если версия включена
+    (install_ngrams_data_version), это отметка времени последнего изменения из ngram_derived_state.
+    Иначе версия собирается из файла таблицы (TRUNCATE, VACUUM FULL) и счетчиков вставок/изменений/удалений
+    pg_stat_user_tables вместе со временем запуска сервера и сброса статистики: счетчики обнуляются
+    при перезапуске и pg_stat_reset(), и без этих отметок версия могла бы повториться. Счетчики считают
+    и откатанные записи (лишь делает кэш неактуальным) и обновляются с задержкой, поэтому свежие
+    изменения могут быть видны в кэше не сразу. Результат кэшируется в процессе на STORAGE_FEATURES_TTL
+    секунд; None — версию определить не удалось.
+    """
+    with _data_version_lock:
+        if time.monotonic() - _data_version["checked_at"] < STORAGE_FEATURES_TTL:
+            return _data_version["value"]
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            row = None
+            if 'data_version' in get_storage_features(conn):
+                cur.execute(f"SELECT refreshed_at FROM {DERIVED_STATE_TABLE} WHERE name = 'data_version' AND ready;")
+                row = cur.fetchone()
+            if row:
+                version = f"v:{row[0].isoformat()}"
+            else:
+                cur.execute("""
+                    SELECT pg_relation_filenode('ngrams'::regclass), s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+                           pg_postmaster_start_time(), d.stats_reset
+                    FROM pg_stat_user_tables s
+                    LEFT JOIN pg_stat_database d ON d.datname = current_database()
+                    WHERE s.relid = 'ngrams'::regclass;
+                """)
+                row = cur.fetchone()
+                version = ":".join(map(str, row)) if row else None
+    except Exception as e:
+        print(f"Ошибка при определении версии данных: {e}")
+        conn.rollback()
+        return None
+    with _data_version_lock:
+        _data_version["value"] = version
+        _data_version["checked_at"] = time.monotonic()
+    return version
+
+# Разворачивает строки ngrams (псевдоним n) в строки позиционного индекса токенов
+_NGRAM_TOKENS_SELECT = """
+    SELECT n.id, i.position,
+           n.deps->>i.position, n.pos->>i.position, n.tags->>i.position,
+           n.tokens->>i.position, n.lemmas->>i.position,
+           COALESCE(ARRAY(SELECT jsonb_array_elements_text(n.morph->i.position)), '{{}}'::text[])
+    FROM {source} n,
+         LATERAL generate_series(0, GREATEST(
+             jsonb_array_length(n.deps), jsonb_array_length(n.pos), jsonb_array_length(n.tags),
+             jsonb_array_length(n.tokens), jsonb_array_length(n.lemmas), jsonb_array_length(n.morph)
+         ) - 1) AS i(position)
+"""
+
+# Строки UPDATE, у которых изменился хотя бы один из исходных JSONB-массивов (для триггеров)
+_CHANGED_NGRAMS_SELECT = """
+    SELECT n.* FROM new_rows n JOIN old_rows o ON o.id = n.id
+    WHERE (o.deps, o.pos, o.tags, o.tokens, o.lemmas, o.morph)
+          IS DISTINCT FROM (n.deps, n.pos, n.tags, n.tokens, n.lemmas, n.morph)
+"""
+
+def rebuild_ngram_tokens_index(conn):
+    """
+    Создает и полностью перестраивает позиционный индекс токенов ngram_tokens:
+    одна строка на (n-грамма, позиция) с dep/pos/tag/token/lemma/morph и составными B-tree индексами.
+    Синхронизацию с ngrams после перестройки поддерживают statement-level триггеры.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {NGRAM_TOKENS_TABLE} (
+                    ngram_id bigint NOT NULL,
+                    position smallint NOT NULL,
+                    dep text, pos text, tag text, token text, lemma text,
+                    morph text[] NOT NULL DEFAULT '{{}}',
+                    PRIMARY KEY (ngram_id, position)
+                );
+            """)
+            _set_derived_state(cur, 'token_index', False)
+            cur.execute(f"TRUNCATE {NGRAM_TOKENS_TABLE};")
+            cur.execute(f"INSERT INTO {NGRAM_TOKENS_TABLE} {_NGRAM_TOKENS_SELECT.format(source='ngrams')};")
+            for column in ('dep', 'pos', 'tag', 'token', 'lemma'):
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {NGRAM_TOKENS_TABLE}_{column}_idx ON {NGRAM_TOKENS_TABLE} (position, {column}, ngram_id);")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {NGRAM_TOKENS_TABLE}_morph_idx ON {NGRAM_TOKENS_TABLE} USING gin (morph);")
+
+            # Триггеры уровня оператора с таблицами переходов: одна вставка/удаление на UPDATE пачки n-грамм
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION {NGRAM_TOKENS_TABLE}_sync() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        DELETE FROM {NGRAM_TOKENS_TABLE} t USING old_rows o WHERE t.ngram_id = o.id;
+                    ELSIF TG_OP = 'INSERT' THEN
+                        INSERT INTO {NGRAM_TOKENS_TABLE} {_NGRAM_TOKENS_SELECT.format(source='new_rows')};
+                    ELSE
+                        -- Переиндексируем только строки, у которых изменились исходные массивы
+                        DELETE FROM {NGRAM_TOKENS_TABLE} t USING ({_CHANGED_NGRAMS_SELECT}) c WHERE t.ngram_id = c.id;
+                        INSERT INTO {NGRAM_TOKENS_TABLE} {_NGRAM_TOKENS_SELECT.format(source=f'({_CHANGED_NGRAMS_SELECT})')};
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            triggers = {
+                'ins': "AFTER INSERT ON ngrams REFERENCING NEW TABLE AS new_rows",
+                'upd': "AFTER UPDATE ON ngrams REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+                'del': "AFTER DELETE ON ngrams REFERENCING OLD TABLE AS old_rows",
+            }
+            for suffix, definition in triggers.items():
+                cur.execute(f"DROP TRIGGER IF EXISTS {NGRAM_TOKENS_TABLE}_sync_{suffix} ON ngrams;")
+                cur.execute(f"CREATE TRIGGER {NGRAM_TOKENS_TABLE}_sync_{suffix} {definition} FOR EACH STATEMENT EXECUTE FUNCTION {NGRAM_TOKENS_TABLE}_sync();")
+
+            _set_derived_state(cur, 'token_index', True)
+            conn.commit()
+            cur.execute(f"ANALYZE {NGRAM_TOKENS_TABLE};")
+            conn.commit()
+        invalidate_storage_features()
+        return True
+    except Exception as e:
+        print(f"Ошибка при перестройке индекса токенов: {e}")
+        conn.rollback()
+        return False
+
+NGRAM_VOCAB_TABLE = "ngram_vocab"
+# Атрибут -> (исходная JSONB-колонка ngrams, колонка кодов, тип элемента кодов)
+CODE_COLUMN_MAPPING = {
+    'dep': ('deps', 'dep_codes', 'smallint'),
+    'pos': ('pos', 'pos_codes', 'smallint'),
+    'tag': ('tags', 'tag_codes', 'smallint'),
+    'token': ('tokens', 'token_codes', 'integer'),
+    'lemma': ('lemmas', 'lemma_codes', 'integer'),
+}
+# Производные структуры, которые хранятся в колонках самой таблицы n-грамм (см. get_storage_features)
+_FEATURE_COLUMNS = {
+    'encoded': frozenset(code_col for _, code_col, _ in CODE_COLUMN_MAPPING.values()),
+    'morph_bits': frozenset({'morph_bits'}),
+}
+# Откуда брать значения словаря для каждого атрибута (morph — признаки внутри массива массивов)
+_VOCAB_SOURCES = {
+    'dep': "jsonb_array_elements_text(n.deps) AS e(value)",
+    'pos': "jsonb_array_elements_text(n.pos) AS e(value)",
+    'tag': "jsonb_array_elements_text(n.tags) AS e(value)",
+    'token': "jsonb_array_elements_text(n.tokens) AS e(value)",
+    'lemma': "jsonb_array_elements_text(n.lemmas) AS e(value)",
+    'morph': "jsonb_array_elements(n.morph) AS m(feats), jsonb_array_elements_text(m.feats) AS e(value)",
+}
+
+def _encode_array_sql(attr, source_expr):
+    """SQL-выражение: JSONB-массив строк -> массив кодов словаря с сохранением позиций (неизвестные -> NULL)."""
+    return (
+        f"ARRAY(SELECT v.code FROM jsonb_array_elements_text({source_expr}) WITH ORDINALITY AS e(value, ord) "
+        f"LEFT JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = '{attr}' AND v.value = e.value ORDER BY e.ord)"
+    )
+
+def rebuild_ngram_vocabulary(conn):
+    """
+    Заполняет словари ngram_vocab (attr, code, value) для dep/pos/tag/token/lemma/morph
+    и колонки кодов dep_codes/pos_codes/tag_codes (smallint[]) и token_codes/lemma_codes (int[]) в ngrams.
+    Новые значения получают следующий свободный код; частые значения — меньшие коды.
+    Дальше коды поддерживает BEFORE-триггер на вставку и изменение ngrams.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {NGRAM_VOCAB_TABLE} (
+                    attr text NOT NULL,
+                    code integer NOT NULL,
+                    value text NOT NULL,
+                    PRIMARY KEY (attr, code),
+                    UNIQUE (attr, value)
+                );
+            """)
+            _set_derived_state(cur, 'encoded', False)
+
+            for attr, source in _VOCAB_SOURCES.items():
+                cur.execute(f"""
+                    INSERT INTO {NGRAM_VOCAB_TABLE} (attr, code, value)
+                    SELECT %s, base.max_code + row_number() OVER (ORDER BY v.qty DESC, v.value), v.value
+                    FROM (
+                        SELECT e.value, COUNT(*) AS qty
+                        FROM ngrams n, {source}
+                        WHERE e.value IS NOT NULL
+                        GROUP BY e.value
+                    ) v
+                    CROSS JOIN (SELECT COALESCE(MAX(code), 0) AS max_code FROM {NGRAM_VOCAB_TABLE} WHERE attr = %s) base
+                    WHERE NOT EXISTS (SELECT 1 FROM {NGRAM_VOCAB_TABLE} x WHERE x.attr = %s AND x.value = v.value);
+                """, (attr, attr, attr))
+
+            set_parts = []
+            for attr, (source_col, code_col, code_type) in CODE_COLUMN_MAPPING.items():
+                cur.execute(f"ALTER TABLE ngrams ADD COLUMN IF NOT EXISTS {code_col} {code_type}[];")
+                set_parts.append(f"{code_col} = {_encode_array_sql(attr, f'n.{source_col}')}::{code_type}[]")
+            cur.execute(f"UPDATE ngrams n SET {', '.join(set_parts)};")
+
+            # Кодирование новых и измененных строк: недостающие значения дописываются в словарь
+            # под advisory-блокировкой атрибута, чтобы параллельные вставки не выдали один код дважды
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION {NGRAM_VOCAB_TABLE}_encode(p_attr text, p_values jsonb) RETURNS integer[] AS $$
+                DECLARE
+                    missing text[];
+                BEGIN
+                    IF p_values IS NULL THEN
+                        RETURN NULL;
+                    END IF;
+                    SELECT array_agg(DISTINCT e.value) INTO missing
+                    FROM jsonb_array_elements_text(p_values) AS e(value)
+                    WHERE e.value IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM {NGRAM_VOCAB_TABLE} v WHERE v.attr = p_attr AND v.value = e.value);
+                    IF missing IS NOT NULL THEN
+                        PERFORM pg_advisory_xact_lock(hashtext('{NGRAM_VOCAB_TABLE}:' || p_attr));
+                        INSERT INTO {NGRAM_VOCAB_TABLE} (attr, code, value)
+                        SELECT p_attr, COALESCE((SELECT MAX(code) FROM {NGRAM_VOCAB_TABLE} WHERE attr = p_attr), 0)
+                                       + row_number() OVER (ORDER BY m.value), m.value
+                        FROM unnest(missing) AS m(value)
+                        WHERE NOT EXISTS (SELECT 1 FROM {NGRAM_VOCAB_TABLE} v WHERE v.attr = p_attr AND v.value = m.value);
+                    END IF;
+                    RETURN ARRAY(
+                        SELECT v.code FROM jsonb_array_elements_text(p_values) WITH ORDINALITY AS e(value, ord)
+                        LEFT JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = p_attr AND v.value = e.value
+                        ORDER BY e.ord
+                    );
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            encode_lines = "\n".join(
+                f"IF TG_OP = 'INSERT' OR NEW.{source_col} IS DISTINCT FROM OLD.{source_col} THEN "
+                f"NEW.{code_col} := {NGRAM_VOCAB_TABLE}_encode('{attr}', NEW.{source_col}); END IF;"
+                for attr, (source_col, code_col, _) in CODE_COLUMN_MAPPING.items()
+            )
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION ngrams_encode_row() RETURNS trigger AS $$
+                BEGIN
+                    {encode_lines}
+                    IF TG_OP = 'INSERT' OR NEW.morph IS DISTINCT FROM OLD.morph THEN
+                        PERFORM {NGRAM_VOCAB_TABLE}_encode('morph', (
+                            SELECT jsonb_agg(f) FROM jsonb_array_elements(NEW.morph) AS m(feats), jsonb_array_elements(m.feats) AS f
+                        ));
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS ngrams_encode_row ON ngrams;")
+            cur.execute("CREATE TRIGGER ngrams_encode_row BEFORE INSERT OR UPDATE ON ngrams FOR EACH ROW EXECUTE FUNCTION ngrams_encode_row();")
+
+            _set_derived_state(cur, 'encoded', True)
+            conn.commit()
+            cur.execute(f"ANALYZE {NGRAM_VOCAB_TABLE};")
+            cur.execute("ANALYZE ngrams;")
+            conn.commit()
+        invalidate_storage_features()
+        return True
+    except Exception as e:
+        print(f"Ошибка при построении словарей значений: {e}")
+        conn.rollback()
+        return False
+
+# Битовая маска morph: на каждую позицию MORPH_BIT_WORDS слов bigint, бит признака = код в ngram_vocab - 1.
+# Колонка ngrams.morph_bits хранит маски всех позиций подряд (позиция p — элементы p*W+1..p*W+W).
+MORPH_BIT_WORDS = 2
+MORPH_BIT_CAPACITY = MORPH_BIT_WORDS * 64
+
+def rebuild_ngram_morph_bits(conn):
+    """
+    Заполняет ngrams.morph_bits (bigint[]) битовыми масками признаков morph по позициям.
+    Правила morph превращаются в побитовое И с маской значений, а фасеты morph — в подсчет битов.
+    Требует словаря признаков (rebuild_ngram_vocabulary). Если признаков больше, чем MORPH_BIT_CAPACITY,
+    маски не включаются; если такой признак появится позже, триггер снимет готовность 'morph_bits'.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (NGRAM_VOCAB_TABLE,))
+            if not cur.fetchone()[0]:
+                print("Ошибка при построении масок morph: сначала постройте словари значений.")
+                return False
+            cur.execute(f"SELECT COUNT(*) FROM {NGRAM_VOCAB_TABLE} WHERE attr = 'morph' AND code > %s;", (MORPH_BIT_CAPACITY,))
+            overflow = cur.fetchone()[0]
+            if overflow:
+                print(f"Ошибка при построении масок morph: {overflow} признаков не помещаются в {MORPH_BIT_CAPACITY} бит.")
+                return False
+            _set_derived_state(cur, 'morph_bits', False)
+
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION ngram_morph_mask(p_values text[]) RETURNS bigint[] AS $$
+                    SELECT ARRAY(
+                        SELECT COALESCE((
+                            SELECT bit_or(1::bigint << ((v.code - 1) % 64)) FROM {NGRAM_VOCAB_TABLE} v
+                            WHERE v.attr = 'morph' AND v.value = ANY(p_values) AND (v.code - 1) / 64 = w.word
+                        ), 0)
+                        FROM generate_series(0, {MORPH_BIT_WORDS - 1}) AS w(word) ORDER BY w.word
+                    );
+                $$ LANGUAGE sql STABLE;
+            """)
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION ngram_morph_bits(p_morph jsonb) RETURNS bigint[] AS $$
+                    SELECT ARRAY(
+                        SELECT COALESCE((
+                            SELECT bit_or(1::bigint << ((v.code - 1) % 64))
+                            FROM jsonb_array_elements_text(p_morph->i.pos) AS f(value)
+                            JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = 'morph' AND v.value = f.value
+                            WHERE (v.code - 1) / 64 = w.word
+                        ), 0)
+                        FROM generate_series(0, jsonb_array_length(p_morph) - 1) AS i(pos),
+                             generate_series(0, {MORPH_BIT_WORDS - 1}) AS w(word)
+                        ORDER BY i.pos, w.word
+                    );
+                $$ LANGUAGE sql STABLE;
+            """)
+            cur.execute("ALTER TABLE ngrams ADD COLUMN IF NOT EXISTS morph_bits bigint[];")
+            cur.execute("UPDATE ngrams SET morph_bits = ngram_morph_bits(morph);")
+
+            # Срабатывает после ngrams_encode_row (триггеры BEFORE идут по имени), т.е. когда новые признаки уже в словаре
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION ngrams_morph_bits_row() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' OR NEW.morph IS DISTINCT FROM OLD.morph THEN
+                        NEW.morph_bits := ngram_morph_bits(NEW.morph);
+                        IF EXISTS (SELECT 1 FROM {NGRAM_VOCAB_TABLE} WHERE attr = 'morph' AND code > {MORPH_BIT_CAPACITY}) THEN
+                            UPDATE {DERIVED_STATE_TABLE} SET ready = FALSE WHERE name = 'morph_bits' AND ready;
+                        END IF;
+                    END IF;
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS ngrams_morph_bits_row ON ngrams;")
+            cur.execute("CREATE TRIGGER ngrams_morph_bits_row BEFORE INSERT OR UPDATE ON ngrams FOR EACH ROW EXECUTE FUNCTION ngrams_morph_bits_row();")
+
+            _set_derived_state(cur, 'morph_bits', True)
+            conn.commit()
+            cur.execute("ANALYZE ngrams;")
+            conn.commit()
+        invalidate_storage_features()
+        return True
+    except Exception as e:
+        print(f"Ошибка при построении масок morph: {e}")
+        conn.rollback()
+        return False
+
+FACET_CUBE_TABLE = "ngram_facet_cube"
+FACET_CUBE_DIRTY_TABLE = "ngram_facet_cube_dirty"
+# Атрибуты, агрегированные в кубе фасетов
+FACET_CUBE_TYPES = ('dep', 'pos', 'tag', 'morph')
+
+# Агрегаты SUM(freq_mln)/COUNT по (len, position, type, value) для n-грамм заданных длин (параметр dirty)
+_FACET_CUBE_SELECT = """
+    SELECT n.len, u.position, u.type, u.value, SUM(n.freq_mln), COUNT(*)
+    FROM ngrams n,
+         LATERAL (
+             SELECT i.pos, 'dep', n.deps->>i.pos FROM generate_series(0, jsonb_array_length(n.deps) - 1) AS i(pos)
+             UNION ALL
+             SELECT i.pos, 'pos', n.pos->>i.pos FROM generate_series(0, jsonb_array_length(n.pos) - 1) AS i(pos)
+             UNION ALL
+             SELECT i.pos, 'tag', n.tags->>i.pos FROM generate_series(0, jsonb_array_length(n.tags) - 1) AS i(pos)
+             UNION ALL
+             SELECT i.pos, 'morph', m.value
+             FROM generate_series(0, jsonb_array_length(n.morph) - 1) AS i(pos),
+                  jsonb_array_elements_text(n.morph->i.pos) AS m(value)
+         ) AS u(position, type, value)
+    WHERE n.len = ANY(dirty) AND u.value IS NOT NULL AND u.value != ''
+    GROUP BY 1, 2, 3, 4
+"""
+
+def _install_dirty_length_tracking(cur, name, dirty_table, watched_columns):
+    """
+    Создает таблицу «грязных» длин dirty_table и statement-level триггеры {name}_dirty_* на ngrams,
+    которые записывают в нее длины вставленных, удаленных и измененных строк
+    (для UPDATE — только если изменилась одна из колонок watched_columns).
+    """
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {dirty_table} (len smallint PRIMARY KEY);")
+    old_columns = ", ".join(f"o.{column}" for column in watched_columns)
+    new_columns = ", ".join(f"n.{column}" for column in watched_columns)
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION {name}_mark_dirty() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO {dirty_table} SELECT DISTINCT len FROM new_rows ON CONFLICT DO NOTHING;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO {dirty_table} SELECT DISTINCT len FROM old_rows ON CONFLICT DO NOTHING;
+            ELSE
+                INSERT INTO {dirty_table}
+                SELECT DISTINCT l.len FROM new_rows n JOIN old_rows o ON o.id = n.id,
+                     LATERAL (VALUES (n.len), (o.len)) AS l(len)
+                WHERE ({old_columns}) IS DISTINCT FROM ({new_columns})
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    triggers = {
+        'ins': "AFTER INSERT ON ngrams REFERENCING NEW TABLE AS new_rows",
+        'upd': "AFTER UPDATE ON ngrams REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+        'del': "AFTER DELETE ON ngrams REFERENCING OLD TABLE AS old_rows",
+    }
+    for suffix, definition in triggers.items():
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}_dirty_{suffix} ON ngrams;")
+        cur.execute(f"CREATE TRIGGER {name}_dirty_{suffix} {definition} FOR EACH STATEMENT EXECUTE FUNCTION {name}_mark_dirty();")
+
+def rebuild_ngram_facet_cube(conn):
+    """
+    Создает куб фасетов ngram_facet_cube: SUM(freq_mln) и COUNT по (len, position, type, value)
+    для dep/pos/tag/morph. Он отвечает на панель подсказок без фильтров вместо полного разворота ngrams.
+    Изменения ngrams отмечают затронутые длины в ngram_facet_cube_dirty (statement-level триггеры),
+    а ngram_facet_cube_refresh() пересчитывает куб только для этих длин.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {FACET_CUBE_TABLE} (
+                    len smallint NOT NULL,
+                    position smallint NOT NULL,
+                    type text NOT NULL,
+                    value text NOT NULL,
+                    total_freq numeric NOT NULL,
+                    total_qty bigint NOT NULL,
+                    PRIMARY KEY (len, position, type, value)
+                );
+            """)
+            _set_derived_state(cur, 'facet_cube', False)
+
+            # Триггеры только помечают длины: пересчет агрегатов в каждой транзакции записи был бы слишком дорог
+            _install_dirty_length_tracking(cur, FACET_CUBE_TABLE, FACET_CUBE_DIRTY_TABLE, ('len', 'freq_mln', 'deps', 'pos', 'tags', 'morph'))
+
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION {FACET_CUBE_TABLE}_refresh() RETURNS integer AS $$
+                DECLARE
+                    dirty smallint[];
+                BEGIN
+                    WITH d AS (DELETE FROM {FACET_CUBE_DIRTY_TABLE} RETURNING len)
+                    SELECT array_agg(len) INTO dirty FROM d;
+                    IF dirty IS NULL THEN
+                        RETURN 0;
+                    END IF;
+                    DELETE FROM {FACET_CUBE_TABLE} WHERE len = ANY(dirty);
+                    INSERT INTO {FACET_CUBE_TABLE} (len, position, type, value, total_freq, total_qty) {_FACET_CUBE_SELECT};
+                    RETURN array_length(dirty, 1);
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            # Полная перестройка — это пересчет всех длин как «грязных»
+            cur.execute(f"TRUNCATE {FACET_CUBE_TABLE};")
+            cur.execute(f"INSERT INTO {FACET_CUBE_DIRTY_TABLE} SELECT DISTINCT len FROM ngrams ON CONFLICT DO NOTHING;")
+            cur.execute(f"SELECT {FACET_CUBE_TABLE}_refresh();")
+
+            _set_derived_state(cur, 'facet_cube', True)
+            conn.commit()
+            cur.execute(f"ANALYZE {FACET_CUBE_TABLE};")
+            conn.commit()
+        invalidate_storage_features()
+        return True
+    except Exception as e:
+        print(f"Ошибка при построении куба фасетов: {e}")
+        conn.rollback()
+        return False
+
+def refresh_ngram_facet_cube(conn):
+    """Пересчитывает куб фасетов для длин, измененных с прошлого обновления. Возвращает число длин или None при ошибке."""
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {FACET_CUBE_TABLE}_refresh();")
+            refreshed = cur.fetchone()[0]
+            conn.commit()
+            return refreshed
+    except Exception as e:
+        print(f"Ошибка при обновлении куба фасетов: {e}")
+        conn.rollback()
+        return None
+
+def _get_suggestion_data_from_cube(conn, selected_lengths, min_quantity):
+    """
+    Данные панели подсказок из куба фасетов (без фильтров и мин. частотности).
+    Возвращает None, если какая-то из выбранных длин ожидает пересчета куба, — тогда нужен живой запрос.
+    """
+    with conn.cursor() as cur:
+        execute_prepared(cur, f"SELECT EXISTS (SELECT 1 FROM {FACET_CUBE_DIRTY_TABLE} WHERE len = ANY(%s::int[]));", [list(selected_lengths)])
+        if cur.fetchone()[0]:
+            return None
+        execute_prepared(cur, f"""
+            SELECT position::int, type, value, SUM(total_freq) AS total_freq, SUM(total_qty) AS total_qty
+            FROM {FACET_CUBE_TABLE}
+            WHERE len = ANY(%s::int[]) AND position < %s
+            GROUP BY 1, 2, 3
+            HAVING SUM(total_qty) >= %s
+            ORDER BY 1, 4 DESC;
+        """, [list(selected_lengths), max(selected_lengths), int(min_quantity)])
+        suggestion_data = {}
+        for pos, r_type, r_val, r_freq, r_qty in cur.fetchall():
+            suggestion_data.setdefault(pos, []).append({"type": r_type, "value": r_val, "freq": r_freq, "qty": r_qty})
+        return suggestion_data
+
+SEQUENCE_FREQ_TABLE = "ngram_sequence_freq"
+SEQUENCE_FREQ_DIRTY_TABLE = "ngram_sequence_freq_dirty"
+SEQUENCE_TYPES = ('dep', 'pos', 'tag')
+
+# Частоты полных последовательностей dep/pos/tag для n-грамм заданных длин (параметр dirty)
+_SEQUENCE_FREQ_SELECT = "\n    UNION ALL\n".join(
+    f"""
+    SELECT '{sequence_type}', s.len, s.sequence, SUM(s.freq_mln), COUNT(*)
+    FROM (
+        SELECT n.len, ARRAY(SELECT jsonb_array_elements_text(n.{COLUMN_MAPPING[sequence_type]})) AS sequence, n.freq_mln
+        FROM ngrams n
+        WHERE n.len = ANY(dirty) AND jsonb_array_length(n.{COLUMN_MAPPING[sequence_type]}) = n.len
+    ) s
+    GROUP BY s.len, s.sequence"""
+    for sequence_type in SEQUENCE_TYPES
+)
+
+def rebuild_ngram_sequence_freq(conn):
+    """
+    Создает таблицу частот последовательностей ngram_sequence_freq (sequence_type, len, sequence)
+    с SUM(freq_mln)/COUNT для диалога «Заполнить по шаблону» без фильтров.
+    Как и куб фасетов, обновляется инкрементально: триггеры отмечают измененные длины,
+    ngram_sequence_freq_refresh() пересчитывает только их.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {SEQUENCE_FREQ_TABLE} (
+                    sequence_type text NOT NULL,
+                    len smallint NOT NULL,
+                    sequence text[] NOT NULL,
+                    total_freq numeric NOT NULL,
+                    total_qty bigint NOT NULL,
+                    PRIMARY KEY (sequence_type, len, sequence)
+                );
+            """)
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {SEQUENCE_FREQ_TABLE}_top_idx ON {SEQUENCE_FREQ_TABLE} (sequence_type, len, total_freq DESC);")
+            _set_derived_state(cur, 'sequence_freq', False)
+            _install_dirty_length_tracking(cur, SEQUENCE_FREQ_TABLE, SEQUENCE_FREQ_DIRTY_TABLE, ('len', 'freq_mln', 'deps', 'pos', 'tags'))
+
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION {SEQUENCE_FREQ_TABLE}_refresh() RETURNS integer AS $$
+                DECLARE
+                    dirty smallint[];
+                BEGIN
+                    WITH d AS (DELETE FROM {SEQUENCE_FREQ_DIRTY_TABLE} RETURNING len)
+                    SELECT array_agg(len) INTO dirty FROM d;
+                    IF dirty IS NULL THEN
+                        RETURN 0;
+                    END IF;
+                    DELETE FROM {SEQUENCE_FREQ_TABLE} WHERE len = ANY(dirty);
+                    INSERT INTO {SEQUENCE_FREQ_TABLE} (sequence_type, len, sequence, total_freq, total_qty) {_SEQUENCE_FREQ_SELECT};
+                    RETURN array_length(dirty, 1);
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+
+            cur.execute(f"TRUNCATE {SEQUENCE_FREQ_TABLE};")
+            cur.execute(f"INSERT INTO {SEQUENCE_FREQ_DIRTY_TABLE} SELECT DISTINCT len FROM ngrams ON CONFLICT DO NOTHING;")
+            cur.execute(f"SELECT {SEQUENCE_FREQ_TABLE}_refresh();")
+
+            _set_derived_state(cur, 'sequence_freq', True)
+            conn.commit()
+            cur.execute(f"ANALYZE {SEQUENCE_FREQ_TABLE};")
+            conn.commit()
+        invalidate_storage_features()
+        return True
+    except Exception as e:
+        print(f"Ошибка при построении таблицы частых последовательностей: {e}")
+        conn.rollback()
+        return False
+
+def refresh_ngram_sequence_freq(conn):
+    """Пересчитывает частоты последовательностей для измененных длин. Возвращает число длин или None при ошибке."""
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {SEQUENCE_FREQ_TABLE}_refresh();")
+            refreshed = cur.fetchone()[0]
+            conn.commit()
+            return refreshed
+    except Exception as e:
+        print(f"Ошибка при обновлении таблицы частых последовательностей: {e}")
+        conn.rollback()
+        return None
+
+def _get_frequent_sequences_materialized(conn, sequence_type, phrase_length, limit):
+    """Топ последовательностей из ngram_sequence_freq; None, если длина ожидает пересчета."""
+    with conn.cursor() as cur:
+        execute_prepared(cur, f"SELECT EXISTS (SELECT 1 FROM {SEQUENCE_FREQ_DIRTY_TABLE} WHERE len = %s);", [phrase_length])
+        if cur.fetchone()[0]:
+            return None
+        execute_prepared(cur, f"""
+            SELECT sequence, total_freq, total_qty FROM {SEQUENCE_FREQ_TABLE}
+            WHERE sequence_type = %s AND len = %s
+            ORDER BY total_freq DESC
+            LIMIT %s;
+        """, [sequence_type, phrase_length, int(limit)])
+        return [tuple(row[0]) + (row[1], row[2]) for row in cur.fetchall()]
+
+PATTERN_POSITIONS_TABLE = "ngram_pattern_positions"
+# Атрибуты, которые целиком определяются паттерном n-граммы (закодированы в unique_patterns.pattern_text)
+PATTERN_POSITION_TYPES = ('dep', 'pos', 'tag')
+
+# Разворачивает строки unique_patterns (псевдоним p) в строки (паттерн, позиция, dep, pos, tag).
+# pattern_text — это deps, затем pos, затем tags, склеенные через '_' (по phrase_length элементов).
+_PATTERN_POSITIONS_SELECT = """
+    SELECT p.id, i.position,
+           NULLIF(s.parts[i.position + 1], ''),
+           NULLIF(s.parts[p.phrase_length + i.position + 1], ''),
+           NULLIF(s.parts[2 * p.phrase_length + i.position + 1], '')
+    FROM {source} p
+    CROSS JOIN LATERAL string_to_array(p.pattern_text, '_') AS s(parts)
+    CROSS JOIN LATERAL generate_series(0, p.phrase_length - 1) AS i(position)
+"""
+
+# Строки UPDATE unique_patterns, у которых изменился текст паттерна (для триггеров)
+_CHANGED_PATTERNS_SELECT = """
+    SELECT n.* FROM new_rows n JOIN old_rows o ON o.id = n.id
+    WHERE (o.pattern_text, o.phrase_length) IS DISTINCT FROM (n.pattern_text, n.phrase_length)
+"""
+
+def rebuild_pattern_positions(conn):
+    """
+    Создает позиционную форму паттернов ngram_pattern_positions: одна строка на (паттерн, позиция)
+    с dep/pos/tag из unique_patterns.pattern_text и B-tree индексами (position, <атрибут>).
+    Правила dep/pos/tag тогда решаются по таблице паттернов, которая намного меньше ngrams,
+    а n-граммы выбираются по pattern_id. Синхронизацию с unique_patterns поддерживают триггеры.
+    """
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            _ensure_derived_state_table(cur)
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {PATTERN_POSITIONS_TABLE} (
+                    pattern_id integer NOT NULL,
+                    position smallint NOT NULL,
+                    dep text, pos text, tag text,
+                    PRIMARY KEY (pattern_id, position)
+                );
+            """)
+            _set_derived_state(cur, 'pattern_positions', False)
+            cur.execute(f"TRUNCATE {PATTERN_POSITIONS_TABLE};")
+            cur.execute(f"INSERT INTO {PATTERN_POSITIONS_TABLE} {_PATTERN_POSITIONS_SELECT.format(source='unique_patterns')};")
+            for column in PATTERN_POSITION_TYPES:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {PATTERN_POSITIONS_TABLE}_{column}_idx ON {PATTERN_POSITIONS_TABLE} (position, {column}, pattern_id);")
+
+            # Второй шаг двухуровневой фильтрации — выборка n-грамм по pattern_id — требует индекса на ngrams
+            cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_index i
+                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = 'ngrams'::regclass AND a.attname = 'pattern_id'
+                );
+            """)
+            if not cur.fetchone()[0]:
+                cur.execute("CREATE INDEX ngrams_pattern_id_idx ON ngrams (pattern_id);")
+
+            cur.execute(f"""
+                CREATE OR REPLACE FUNCTION {PATTERN_POSITIONS_TABLE}_sync() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        DELETE FROM {PATTERN_POSITIONS_TABLE} t USING old_rows o WHERE t.pattern_id = o.id;
+                    ELSIF TG_OP = 'INSERT' THEN
+                        INSERT INTO {PATTERN_POSITIONS_TABLE} {_PATTERN_POSITIONS_SELECT.format(source='new_rows')};
+                    ELSE
+                        -- Изменения итогов и отметок модерации позиции паттерна не затрагивают
+                        DELETE FROM {PATTERN_POSITIONS_TABLE} t USING ({_CHANGED_PATTERNS_SELECT}) c WHERE t.pattern_id = c.id;
+                        INSERT INTO {PATTERN_POSITIONS_TABLE} {_PATTERN_POSITIONS_SELECT.format(source=f'({_CHANGED_PATTERNS_SELECT})')};
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            triggers = {
+                'ins': "AFTER INSERT ON unique_patterns REFERENCING NEW TABLE AS new_rows",
+                'upd': "AFTER UPDATE ON unique_patterns REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+                'del': "AFTER DELETE ON unique_patterns REFERENCING OLD TABLE AS old_rows",
+            }
+            for suffix, definition in triggers.items():
+                cur.execute(f"DROP TRIGGER IF EXISTS {PATTERN_POSITIONS_TABLE}_sync_{suffix} ON unique_patterns;")
+                cur.execute(f"CREATE TRIGGER {PATTERN_POSITIONS_TABLE}_sync_{suffix} {definition} FOR EACH STATEMENT EXECUTE FUNCTION {PATTERN_POSITIONS_TABLE}_sync();")
+
+            _set_derived_state(cur, 'pattern_positions', True)
+            conn.commit()
+            cur.execute(f"ANALYZE {PATTERN_POSITIONS_TABLE};")
+            conn.commit()
+        invalidate_storage_features()
+        return True
+    except Exception as e:
+        print(f"Ошибка при построении позиционной таблицы паттернов: {e}")
+        conn.rollback()
+        return False
+
 # --- Построение SQL ---
-def build_where_clauses(blocks, block_id_to_skip=None, rule_id_to_skip=None, table_name="ngrams"):
+def _compile_rule(rule, position, table_name):
+    """Условие одного правила по JSONB-колонкам строки n-граммы и его параметры."""
+    db_col_type = COLUMN_MAPPING.get(rule['type'])
+    values = [str(v) for v in rule['values']]
+    length_check = f"jsonb_array_length({table_name}.{db_col_type}) > %s"
+
+    if db_col_type == 'morph':
+        # For morph, which is an array of arrays: ?| checks whether any of the
+        # values is present among the string elements at the position.
+        rule_logic = f"{table_name}.morph->%s::int ?| %s::text[]"
+    else:
+        # For simple arrays (dep, pos, tag, token, lemma).
+        rule_logic = f"{table_name}.{db_col_type}->>%s::int = ANY(%s::text[])"
+
+    # Apply operator
+    if rule.get('operator', 'include') == 'exclude':
+        return f"({length_check} AND NOT ({rule_logic}))", [position, position, values]
+    return f"({length_check} AND {rule_logic})", [position, position, values] # include
+
+def _compile_rule_encoded(rule, position, table_name):
+    """
+    Условие одного правила по колонке кодов (dep_codes и т.п.).
+    Значения из UI переводятся в коды прямо в запросе (подзапрос к словарю вычисляется один раз),
+    а сама проверка по строкам — сравнение целых чисел вместо разбора JSONB.
+    """
+    _, code_col, _ = CODE_COLUMN_MAPPING[rule['type']]
+    values = [str(v) for v in rule['values']]
+    length_check = f"array_length({table_name}.{code_col}, 1) > %s"
+    rule_logic = (
+        f"{table_name}.{code_col}[%s::int + 1] = ANY(ARRAY("
+        f"SELECT code FROM {NGRAM_VOCAB_TABLE} WHERE attr = '{rule['type']}' AND value = ANY(%s::text[])))"
+    )
+    if rule.get('operator', 'include') == 'exclude':
+        return f"({length_check} AND NOT ({rule_logic}))", [position, position, values]
+    return f"({length_check} AND {rule_logic})", [position, position, values]
+
+def _compile_rule_morph_bits(rule, position, table_name):
+    """
+    Условие правила morph по битовым маскам morph_bits: побитовое И слов позиции с маской значений.
+    Маска значений считается из словаря один раз на запрос (некоррелированный подзапрос).
+    """
+    values = [str(v) for v in rule['values']]
+    length_check = f"array_length({table_name}.morph_bits, 1) > %s::int * {MORPH_BIT_WORDS}"
+    rule_logic = " OR ".join(
+        f"({table_name}.morph_bits[%s::int * {MORPH_BIT_WORDS} + {word + 1}] & (SELECT (ngram_morph_mask(%s::text[]))[{word + 1}])) <> 0"
+        for word in range(MORPH_BIT_WORDS)
+    )
+    params = [position] + [position, values] * MORPH_BIT_WORDS
+    if rule.get('operator', 'include') == 'exclude':
+        return f"({length_check} AND NOT ({rule_logic}))", params
+    return f"({length_check} AND ({rule_logic}))", params
+
+def _compile_rule_token_index(rule):
+    """Условие одного правила по строке позиционного индекса ngram_tokens (псевдоним tk)."""
+    values = [str(v) for v in rule['values']]
+    if rule['type'] == 'morph':
+        rule_logic = "tk.morph && %s::text[]"
+    else:
+        rule_logic = f"tk.{rule['type']} = ANY(%s::text[])"
+    if rule.get('operator', 'include') == 'exclude':
+        return f"NOT ({rule_logic})", [values]
+    return rule_logic, [values]
+
+def _compile_rule_pattern_positions(rule):
+    """Условие одного правила dep/pos/tag по строке позиционной таблицы паттернов (псевдоним pp)."""
+    values = [str(v) for v in rule['values']]
+    rule_logic = f"pp.{rule['type']} = ANY(%s::text[])"
+    if rule.get('operator', 'include') == 'exclude':
+        return f"NOT ({rule_logic})", [values]
+    return rule_logic, [values]
+
+def build_where_clauses(blocks, block_id_to_skip=None, rule_id_to_skip=None, table_name="ngrams", features=frozenset()):
+    """
+    Компилирует блоки фильтров в список SQL-условий и список параметров к ним.
+    Значения и позиции не вставляются в текст запроса, а передаются как параметры,
+    поэтому фильтры одинаковой формы дают одинаковый текст SQL и переиспользуют
+    подготовленный на сервере план (см. execute_prepared).
+    Если готов позиционный индекс токенов (features содержит 'token_index'), каждый блок
+    превращается в поиск по индексу ngram_tokens и полусоединение по id вместо разбора JSONB.
+    Иначе, если готовы словари ('encoded'), правила сравнивают целочисленные коды,
+    а правила morph при готовых масках ('morph_bits') — проверяются побитовым И.
+    При готовой позиционной таблице паттернов ('pattern_positions') правила dep/pos/tag всех блоков
+    сначала сводятся к одному множеству pattern_id (пересечение поисков по ngram_pattern_positions),
+    и лишь правила token/lemma/morph проверяются на n-граммах этих паттернов.
+    """
+    use_pattern_positions = 'pattern_positions' in features
+    use_token_index = 'token_index' in features
+    use_codes = 'encoded' in features
+    use_morph_bits = 'morph_bits' in features
     where_clauses = []
+    params = []
+    pattern_lookups = []
+    pattern_params = []
     for block in blocks:
         if block['id'] == block_id_to_skip and rule_id_to_skip is None: continue
         position = block['position']
         block_rules = []
+        block_params = []
+        structural_rules = []
+        structural_params = []
         for rule in block['rules']:
             if block['id'] == block_id_to_skip and rule['id'] == rule_id_to_skip: continue
             if not rule['values']: continue
+            if not COLUMN_MAPPING.get(rule['type']): continue # Should not happen with valid UI
+
+            if use_pattern_positions and rule['type'] in PATTERN_POSITION_TYPES:
+                rule_sql, rule_params = _compile_rule_pattern_positions(rule)
+                structural_rules.append(rule_sql)
+                structural_params.extend(rule_params)
+                continue
+            if use_token_index:
+                rule_sql, rule_params = _compile_rule_token_index(rule)
+            elif use_morph_bits and rule['type'] == 'morph':
+                rule_sql, rule_params = _compile_rule_morph_bits(rule, position, table_name)
+            elif use_codes and rule['type'] in CODE_COLUMN_MAPPING:
+                rule_sql, rule_params = _compile_rule_encoded(rule, position, table_name)
+            else:
+                rule_sql, rule_params = _compile_rule(rule, position, table_name)
+            block_rules.append(rule_sql)
+            block_params.extend(rule_params)
+
+        if structural_rules:
+            pattern_lookups.append(
+                f"SELECT pp.pattern_id FROM {PATTERN_POSITIONS_TABLE} pp "
+                f"WHERE pp.position = %s AND {' AND '.join(structural_rules)}"
+            )
+            pattern_params.append(position)
+            pattern_params.extend(structural_params)
+        if not block_rules:
+            continue
+        if use_token_index:
+            # Все правила блока относятся к одной позиции: наличие строки индекса на этой позиции
+            # заменяет проверку длины массива, а условие решается по B-tree индексу (position, <атрибут>)
+            where_clauses.append(
+                f"{table_name}.id IN (SELECT tk.ngram_id FROM {NGRAM_TOKENS_TABLE} tk "
+                f"WHERE tk.position = %s AND {' AND '.join(block_rules)})"
+            )
+            params.append(position)
+        else:
+            where_clauses.append(f"({' AND '.join(block_rules)})")
+        params.extend(block_params)
+    if pattern_lookups:
+        # Структурное условие идет первым: оно отбирает паттерны, остальные проверяются на их n-граммах
+        where_clauses.insert(0, f"{table_name}.pattern_id IN ({' INTERSECT '.join(pattern_lookups)})")
+        params[:0] = pattern_params
+    return where_clauses, params
+
+# Сколько подготовленных запросов держать на одном подключении, прежде чем сбросить их все
+MAX_PREPARED_STATEMENTS = 200
+
+def _to_server_placeholders(query):
+    """Переводит плейсхолдеры psycopg2 (%s) в нумерованные параметры PREPARE ($1, $2, ...)."""
+    parts = query.replace('%%', '\0').split('%s')
+    server_query = parts[0]
+    for i, part in enumerate(parts[1:], start=1):
+        server_query += f"${i}{part}"
+    return server_query.replace('\0', '%'), len(parts) - 1
+
+def execute_prepared(cur, query, params):
+    """
+    Выполняет запрос через серверный PREPARE/EXECUTE.
+    Запрос готовится один раз на подключение (имя выводится из текста запроса),
+    последующие вызовы с теми же формой и другими значениями переиспользуют план.
+    """
+    conn = cur.connection
+    statements = getattr(conn, 'prepared_statements', None)
+    if statements is None:
+        cur.execute(query, params)
+        return
+
+    statement_name = "ngq_" + hashlib.md5(query.encode('utf-8')).hexdigest()[:16]
+    if statement_name not in statements:
+        if len(statements) >= MAX_PREPARED_STATEMENTS:
+            cur.execute("DEALLOCATE ALL;")
+            statements.clear()
+        server_query, n_params = _to_server_placeholders(query.strip().rstrip(';'))
+        cur.execute(f"PREPARE {statement_name} AS {server_query};")
+        statements[statement_name] = n_params
+
+    placeholders = ", ".join(["%s"] * statements[statement_name])
+    try:
+        cur.execute(f"EXECUTE {statement_name} ({placeholders});" if placeholders else f"EXECUTE {statement_name};", params)
+    except psycopg2.Error:
+        # Например, временная таблица пересоздана: план больше не валиден.
+        # После отката транзакции подготовим запрос заново.
+        statements.pop(statement_name, None)
+        conn.rollback()
+        try:
+            with conn.cursor() as cleanup_cur:
+                cleanup_cur.execute(f"DEALLOCATE {statement_name};")
+        except psycopg2.Error:
+            conn.rollback()
+        raise
+
+def build_results_where(filter_blocks, selected_lengths, min_frequency, table_name="ngrams", features=frozenset()):
+    """
+    Собирает полное условие выборки фраз: правила блоков, мин. частотность и,
+    для основной таблицы ngrams, выбранные длины (временная таблица уже отфильтрована по длине).
+    """
+    where_clauses, params = build_where_clauses(filter_blocks, table_name=table_name, features=features)
+    if min_frequency > 0:
+        where_clauses.append(f"{table_name}.freq_mln >= %s")
+        params.append(float(min_frequency))
+    if table_name == "ngrams":
+        where_clauses.insert(0, "len = ANY(%s::int[])")
+        params.insert(0, list(selected_lengths))
+    return where_clauses, params
 
-            operator = rule.get('operator', 'include')
-            db_col_type = COLUMN_MAPPING.get(rule['type'])
-            values = rule['values']
-            
-            if not db_col_type: continue # Should not happen with valid UI
+# Размер одной страницы результатов в таблице фраз
+RESULTS_PAGE_SIZE = 500
 
-            length_check = f"jsonb_array_length({table_name}.{db_col_type}) > {position}"
+def get_results_page(conn, where_clauses, params, table_name="ngrams", after=None, page_size=RESULTS_PAGE_SIZE):
+    """
+    Возвращает одну страницу фраз (text, freq_mln, tokens, id), отсортированных по частотности.
+    Пагинация по ключу (freq_mln, id): after — пара из последней строки предыдущей страницы,
+    следующая страница читается по индексу сразу за ней, без OFFSET и без чтения всего результата.
+    None — запрос не выполнен (нет подключения, ошибка, отмена или statement_timeout).
+    """
+    if not conn: return None
+    page_clauses = list(where_clauses)
+    page_params = list(params)
+    if after is not None:
+        page_clauses.append(f"({table_name}.freq_mln, {table_name}.id) < (%s, %s)")
+        page_params.extend(after)
+    where_str = f"WHERE {' AND '.join(page_clauses)}" if page_clauses else ""
+    query = f"""
+        SELECT text, freq_mln, tokens, id
+        FROM {table_name}
+        {where_str}
+        ORDER BY freq_mln DESC, id DESC
+        LIMIT %s;
+    """
+    page_params.append(int(page_size))
+    return execute_query(conn, query, page_params)
 
-            if db_col_type == 'morph':
-                # For morph, which is an array of arrays.
-                # Escape double quotes in values to prevent errors.
-                safe_values = [str(v).replace('"', '\\"') for v in values]
-                conditions = ' OR '.join([f"{table_name}.morph->{position} @> '[\"{v}\"]'::jsonb" for v in safe_values])
-                rule_logic = f"({conditions})"
-            else:
-                # For simple arrays (dep, pos, tag, token, lemma).
-                # Escape single quotes in values to prevent SQL errors.
-                safe_values = [str(v).replace("'", "''") for v in values]
-                positional_values = ", ".join([f"'{v}'" for v in safe_values])
-                rule_logic = f"{table_name}.{db_col_type}->>{position} IN ({positional_values})"
-
-            # Apply operator
-            if operator == 'exclude':
-                block_rules.append(f"({length_check} AND NOT ({rule_logic}))")
-            else: # include
-                block_rules.append(f"({length_check} AND {rule_logic})")
-
-        if block_rules:
-            where_clauses.append(f"({' AND '.join(block_rules)})")
-    return where_clauses
+def get_results_totals(conn, where_clauses, params, table_name="ngrams"):
+    """Считает суммарную частотность и количество фраз отдельным агрегирующим запросом; None — запрос не выполнен."""
+    if not conn: return None
+    where_str = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+    query = f"SELECT COALESCE(SUM(freq_mln), 0), COUNT(*) FROM {table_name} {where_str};"
+    try:
+        with conn.cursor() as cur:
+            execute_prepared(cur, query, params)
+            total_frequency, total_quantity = cur.fetchone()
+            return total_frequency, total_quantity
+    except Exception as e:
+        print(f"Ошибка при подсчете итогов выборки: {e}")
+        conn.rollback()
+        return None
 
-def execute_query(conn, query):
-    """Выполняет основной запрос на получение фраз."""
-    if not conn: return []
+def get_selection_totals(conn, filter_blocks, selected_lengths, min_frequency, table_name="ngrams"):
+    """
+    Итоги выборки (SUM(freq_mln), COUNT) без чтения строк. Без мин. частотности итоги берутся из готовых
+    агрегатов, если они точно описывают выборку: из куба фасетов для единственного правила include
+    и из итогов паттернов, когда все правила — dep/pos/tag. Иначе — агрегирующий запрос по выборке.
+    None — запрос не выполнен (нет подключения, ошибка, отмена или statement_timeout).
+    """
+    if not conn: return None
+    features = get_storage_features(conn, table_name)
+    active_rules = [
+        (block['position'], rule) for block in filter_blocks for rule in block['rules']
+        if rule['values'] and COLUMN_MAPPING.get(rule['type'])
+    ]
+    if active_rules and min_frequency <= 0:
+        try:
+            totals = None
+            if 'facet_cube' in features and len(active_rules) == 1:
+                totals = _get_totals_from_cube(conn, selected_lengths, *active_rules[0])
+            if totals is None and 'pattern_positions' in features and all(rule['type'] in PATTERN_POSITION_TYPES for _, rule in active_rules):
+                totals = _get_totals_from_patterns(conn, selected_lengths, filter_blocks)
+            if totals is not None:
+                return totals
+        except psycopg2.extensions.QueryCanceledError as e:
+            print(f"Подсчет итогов выборки прерван: {e}")
+            conn.rollback()
+            return None
+        except Exception as e:
+            print(f"Ошибка при чтении готовых итогов выборки: {e}")
+            conn.rollback()
+    where_clauses, params = build_results_where(filter_blocks, selected_lengths, min_frequency, table_name=table_name, features=features)
+    return get_results_totals(conn, where_clauses, params, table_name=table_name)
+
+def _get_totals_from_cube(conn, selected_lengths, position, rule):
+    """
+    Итоги одного правила include из куба фасетов; None, если куб их не описывает точно.
+    dep/pos/tag на позиции однозначны, поэтому итоги значений складываются; признаки morph
+    на одной позиции встречаются вместе, поэтому годится только одно значение.
+    """
+    if rule.get('operator', 'include') != 'include' or rule['type'] not in FACET_CUBE_TYPES:
+        return None
+    if rule['type'] == 'morph' and len(rule['values']) != 1:
+        return None
+    with conn.cursor() as cur:
+        execute_prepared(cur, f"SELECT EXISTS (SELECT 1 FROM {FACET_CUBE_DIRTY_TABLE} WHERE len = ANY(%s::int[]));", [list(selected_lengths)])
+        if cur.fetchone()[0]:
+            return None
+        execute_prepared(cur, f"""
+            SELECT COALESCE(SUM(total_freq), 0), COALESCE(SUM(total_qty), 0)
+            FROM {FACET_CUBE_TABLE}
+            WHERE len = ANY(%s::int[]) AND position = %s AND type = %s AND value = ANY(%s::text[]);
+        """, [list(selected_lengths), int(position), rule['type'], [str(v) for v in rule['values']]])
+        return cur.fetchone()
+
+def _get_totals_from_patterns(conn, selected_lengths, filter_blocks):
+    """Итоги выборки из total_frequency/total_quantity паттернов, прошедших правила dep/pos/tag."""
+    where_clauses, params = build_where_clauses(filter_blocks, table_name="up", features=frozenset({'pattern_positions'}))
+    where_str = "".join(f" AND {clause}" for clause in where_clauses)
+    with conn.cursor() as cur:
+        execute_prepared(cur, f"""
+            SELECT COALESCE(SUM(up.total_frequency), 0), COALESCE(SUM(up.total_quantity), 0)
+            FROM (SELECT id AS pattern_id, phrase_length, total_frequency, total_quantity FROM unique_patterns) up
+            WHERE up.phrase_length = ANY(%s::int[]){where_str};
+        """, [list(selected_lengths)] + params)
+        return cur.fetchone()
+
+# Сколько самых частотных слов на позицию возвращает анализ слов по позициям
+WORD_ANALYSIS_TOP_K = 50
+WORD_ANALYSIS_TYPES = ('token', 'lemma')
+
+def get_word_analysis(conn, where_clauses, params, table_name="ngrams", top_k=WORD_ANALYSIS_TOP_K):
+    """
+    Анализ слов по позициям для всей выборки одним агрегирующим запросом: для токенов и лемм
+    на каждой позиции — top_k значений по SUM(freq_mln) с F и Q, а также итоги позиции.
+    Возвращает {тип: {позиция: {"values": [...], "freq": [...], "qty": [...], "total_freq": F, "total_qty": Q}}};
+    None — запрос не выполнен.
+    """
+    if not conn: return None
+    features = get_storage_features(conn, table_name)
+    where_str = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+    if 'encoded' in features:
+        # Группировка по целочисленным кодам, значения из словаря подставляются только для top_k
+        word_totals_sql = " UNION ALL ".join(f"""
+            SELECT '{attr}' AS type, u.ord - 1 AS position, u.code AS word, SUM(fw.freq_mln) AS freq, COUNT(*) AS qty
+            FROM filtered_words fw, unnest(fw.{CODE_COLUMN_MAPPING[attr][1]}) WITH ORDINALITY AS u(code, ord)
+            WHERE u.code IS NOT NULL
+            GROUP BY 1, 2, 3""" for attr in WORD_ANALYSIS_TYPES)
+        source_columns = ", ".join(CODE_COLUMN_MAPPING[attr][1] for attr in WORD_ANALYSIS_TYPES)
+        value_sql = "v.value"
+        value_join = f"JOIN {NGRAM_VOCAB_TABLE} v ON v.attr = r.type AND v.code = r.word"
+    else:
+        word_totals_sql = " UNION ALL ".join(f"""
+            SELECT '{attr}' AS type, w.ord - 1 AS position, w.value AS word, SUM(fw.freq_mln) AS freq, COUNT(*) AS qty
+            FROM filtered_words fw, jsonb_array_elements_text(fw.{COLUMN_MAPPING[attr]}) WITH ORDINALITY AS w(value, ord)
+            WHERE w.value IS NOT NULL AND w.value != ''
+            GROUP BY 1, 2, 3""" for attr in WORD_ANALYSIS_TYPES)
+        source_columns = ", ".join(COLUMN_MAPPING[attr] for attr in WORD_ANALYSIS_TYPES)
+        value_sql = "r.word"
+        value_join = ""
+    query = f"""
+        WITH filtered_words AS (
+            SELECT freq_mln, {source_columns} FROM {table_name} {where_str}
+        ),
+        word_totals AS ({word_totals_sql}
+        ),
+        ranked AS (
+            SELECT wt.*,
+                   row_number() OVER (PARTITION BY wt.type, wt.position ORDER BY wt.freq DESC, wt.qty DESC) AS rn,
+                   SUM(wt.freq) OVER (PARTITION BY wt.type, wt.position) AS position_freq,
+                   SUM(wt.qty) OVER (PARTITION BY wt.type, wt.position) AS position_qty
+            FROM word_totals wt
+        )
+        SELECT r.type, r.position::int,
+               array_agg({value_sql} ORDER BY r.rn), array_agg(r.freq ORDER BY r.rn), array_agg(r.qty ORDER BY r.rn),
+               MAX(r.position_freq), MAX(r.position_qty)
+        FROM ranked r {value_join}
+        WHERE r.rn <= %s
+        GROUP BY 1, 2
+        ORDER BY 1, 2;
+    """
+    try:
+        with conn.cursor() as cur:
+            execute_prepared(cur, query, list(params) + [int(top_k)])
+            analysis = {}
+            for r_type, position, values, freqs, qtys, total_freq, total_qty in cur.fetchall():
+                analysis.setdefault(r_type, {})[position] = {
+                    "values": list(values), "freq": [float(f) for f in freqs], "qty": list(qtys),
+                    "total_freq": float(total_freq), "total_qty": int(total_qty),
+                }
+            return analysis
+    except Exception as e:
+        print(f"Ошибка при анализе слов по позициям: {e}")
+        conn.rollback()
+        return None
+
+def iter_query_rows(conn, query, params=None, batch_size=5000):
+    """
+    Потоково читает результат запроса через серверный (именованный) курсор,
+    отдавая строки пачками по batch_size. В памяти клиента одновременно находится одна пачка.
+    """
+    if not conn: return
+    with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+        cur.itersize = batch_size
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+def execute_query(conn, query, params=None):
+    """Выполняет основной запрос на получение фраз; None — запрос не выполнен."""
+    if not conn: return None
     try:
         with conn.cursor() as cur:
-            cur.execute(query)
+            if params is None:
+                cur.execute(query)
+            else:
+                execute_prepared(cur, query, params)
             return cur.fetchall()
     except Exception as e:
         print(f"Ошибка выполнения запроса: {e}")
-        return []
+        conn.rollback()
+        return None
 
 # --- Функции для работы с категориями паттернов ---
 
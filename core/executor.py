@@ -0,0 +1,152 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, CancelledError
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from core.database import db_connection, tagged_session, DB_POOL_MAX_SIZE, QUERY_STATEMENT_TIMEOUT_MS, QueryFailedError
+from core.sessions import SESSION_CONNECTIONS_MAX
+
+
+class _TaggedTask:
+    """Запись о помеченной задаче: подключение, на котором идет ее запрос, и отметка об отмене."""
+
+    def __init__(self, session_id, tag):
+        self.session_id = session_id
+        self.tag = tag
+        self.future = None
+        self.conn = None
+        self.cancelled = False
+
+
+class QueryExecutor:
+    """
+    Пул потоков для параллельного выполнения независимых запросов страницы.
+    Каждая задача submit_query получает собственное подключение из общего пула,
+    поэтому запросы одного rerun'а идут на сервер одновременно, а не друг за другом.
+    Контекст Streamlit передается в поток, чтобы задачи могли вызывать функции под st.cache_data.
+
+    Задачи можно пометить отпечатком фильтров (query_tag): когда сессия запускает запросы
+    с другим отпечатком, cancel_superseded отменяет ее устаревшие задачи прямо на сервере.
+    Отмененная задача завершается QueryFailedError, а не пустым результатом, чтобы его не закэшировали.
+    """
+
+    def __init__(self, max_workers=None):
+        # Подключения, которые не могут быть закреплены за сессиями, делятся пополам между
+        # фоновыми задачами и операциями основных потоков страниц: иначе при всех закрепленных
+        # сессиях потоки задач ждали бы подключений, занятых друг другом и страницами
+        free_connections = max(DB_POOL_MAX_SIZE - SESSION_CONNECTIONS_MAX, 1)
+        self.max_workers = max_workers or max(free_connections // 2, 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="query")
+        self._lock = threading.Lock()
+        self._tagged = set()
+        self._current = threading.local()  # помеченная задача, которую выполняет поток
+
+    def submit(self, fn, *args, **kwargs):
+        """Запускает fn(*args, **kwargs) в фоне без подключения к БД (например, для движков в памяти)."""
+        ctx = get_script_run_ctx()
+
+        def task():
+            if ctx is not None:
+                add_script_run_ctx(threading.current_thread(), ctx)
+            return fn(*args, **kwargs)
+        return self._pool.submit(task)
+
+    def submit_query(self, fn, *args, query_tag=None, statement_timeout_ms=QUERY_STATEMENT_TIMEOUT_MS, **kwargs):
+        """
+        Запускает fn(conn, *args, **kwargs) в фоне на отдельном подключении из пула.
+        С query_tag запросы задачи помечаются тегом, ограничиваются statement_timeout_ms
+        (0 — без ограничения, для долгих фоновых уточнений) и могут быть отменены через cancel_superseded.
+        """
+        return self.submit_query_on(
+            db_connection, fn, *args, query_tag=query_tag, statement_timeout_ms=statement_timeout_ms, **kwargs
+        )
+
+    def submit_query_on(self, connect, fn, *args, query_tag=None, statement_timeout_ms=QUERY_STATEMENT_TIMEOUT_MS, **kwargs):
+        """
+        То же, что submit_query, но подключение задаче дает вызывающий: connect() — контекстный менеджер,
+        который выдает подключение на время задачи (например, SessionConnections.use для закрепленного
+        за сессией подключения). Задача так же помечается, ограничивается по времени и отменяется.
+        """
+        if query_tag is None:
+            def with_connection():
+                with connect() as task_conn:
+                    return fn(task_conn, *args, **kwargs)
+            return self.submit(with_connection)
+
+        ctx = get_script_run_ctx()
+        entry = _TaggedTask(ctx.session_id if ctx is not None else None, query_tag)
+
+        def with_tagged_connection():
+            with connect() as task_conn:
+                with self._lock:
+                    if entry.cancelled:
+                        raise QueryFailedError("запрос отменен: фильтры изменились")
+                    entry.conn = task_conn
+                self._current.entry = entry
+                try:
+                    app_name = f"ngrams:{(entry.session_id or '')[:8]}:{query_tag[:16]}"
+                    with tagged_session(task_conn, app_name, statement_timeout_ms) as tagged_conn:
+                        return fn(tagged_conn, *args, **kwargs)
+                finally:
+                    self._current.entry = None
+                    with self._lock:
+                        entry.conn = None
+                        self._tagged.discard(entry)
+
+        with self._lock:
+            entry.future = self.submit(with_tagged_connection)
+            self._tagged.add(entry)
+        return entry.future
+
+    def raise_if_cancelled(self):
+        """
+        Для задач из нескольких запросов: вызывается между шагами и прерывает задачу QueryFailedError,
+        если cancel_superseded уже отменил ее (отмена на сервере прерывает только текущий запрос).
+        """
+        entry = getattr(self._current, "entry", None)
+        if entry is not None and entry.cancelled:
+            raise QueryFailedError("запрос отменен: фильтры изменились")
+
+    def cancel_superseded(self, query_tag):
+        """
+        Отменяет помеченные задачи текущей сессии с тегом, отличным от query_tag: ожидающие
+        снимаются с очереди, у выполняющихся запрос прерывается на сервере (cancel подключения).
+        Возвращает число отмененных задач.
+        """
+        ctx = get_script_run_ctx()
+        session_id = ctx.session_id if ctx is not None else None
+        cancelled = 0
+        with self._lock:
+            for entry in list(self._tagged):
+                if entry.session_id != session_id or entry.tag == query_tag or entry.cancelled:
+                    continue
+                entry.cancelled = True
+                entry.future.cancel()
+                if entry.conn is not None and not entry.conn.closed:
+                    entry.conn.cancel()
+                self._tagged.discard(entry)
+                cancelled += 1
+        return cancelled
+
+
+def iter_completed(futures, on_wait=None, poll_interval=0.25, on_error=None):
+    """
+    Отдает пары (имя, результат) из словаря {имя: Future} по мере завершения задач.
+    Пока задачи идут, раз в poll_interval вызывается on_wait(оставшиеся имена): вывод в
+    Streamlit из него дает прервать устаревший rerun, не дожидаясь его запросов.
+    Задачи, завершившиеся ошибкой или отмененные, при заданном on_error не отдаются:
+    вместо этого вызывается on_error(имя, исключение).
+    """
+    names = {future: name for name, future in futures.items()}
+    pending = set(names)
+    while pending:
+        done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+        for future in done:
+            if on_error is not None:
+                error = CancelledError() if future.cancelled() else future.exception()
+                if error is not None:
+                    on_error(names[future], error)
+                    continue
+            yield names[future], future.result()
+        if pending and on_wait is not None:
+            on_wait(sorted(names[future] for future in pending))
@@ -0,0 +1,156 @@
+import os
+import time
+import uuid
+
+import psycopg2
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    pa = None
+
+# --- Выгрузка результатов фильтрации ---
+# Выборка уходит на диск потоком COPY ... TO STDOUT: в памяти находится только текущий блок данных,
+# поэтому размер выгрузки ограничен диском, а не памятью процесса. Каталог выгрузок не должен быть
+# внутри static/: файлы оттуда доступны по ссылке без входа в приложение. Страница отдает файл
+# только своей сессии через st.download_button.
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(".cache", "exports"))
+EXPORT_TTL = int(os.getenv("EXPORT_TTL", str(3600)))
+# Размер блока при перекладке CSV в Parquet (байт CSV на одну группу строк)
+EXPORT_PARQUET_BLOCK_BYTES = int(os.getenv("EXPORT_PARQUET_BLOCK_BYTES", str(64 * 1024 * 1024)))
+
+EXPORT_FORMATS = ("csv", "parquet")
+EXPORT_COLUMNS = ("id", "text", "freq_mln", "len", "tokens", "lemmas", "deps", "pos", "tags", "morph")
+
+
+def parquet_available():
+    return pa is not None
+
+
+class _CopyProgressWriter:
+    """
+    Приемник данных COPY: пишет блоки в файл и сообщает о прогрессе в байтах и строках файла.
+    Строки файла — не фразы: перевод строки внутри поля в кавычках тоже дает строку, поэтому
+    число фраз берется из rowcount после COPY, а строки годятся лишь для приблизительной доли.
+    """
+
+    def __init__(self, file, on_progress=None):
+        self.file = file
+        self.on_progress = on_progress
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.bytes += len(data)
+        self.lines += data.count(b"\n")
+        if self.on_progress is not None:
+            self.on_progress(self.bytes, self.lines)
+        return len(data)
+
+
+def _abort_export(conn, *paths):
+    """Откатывает транзакцию выгрузки и удаляет недописанные файлы."""
+    try:
+        conn.rollback()
+    except psycopg2.Error:
+        # Подключение осталось в прерванном COPY: закрытое подключение пул заменит новым
+        conn.close()
+    for path in paths:
+        _remove_file(path)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def purge_old_exports(max_age=EXPORT_TTL):
+    """Удаляет выгрузки старше max_age секунд. Возвращает число удаленных файлов."""
+    if not os.path.isdir(EXPORT_DIR):
+        return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(EXPORT_DIR):
+        path = os.path.join(EXPORT_DIR, name)
+        try:
+            if os.path.isfile(path) and now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError as e:
+            print(f"Ошибка при удалении старой выгрузки {name}: {e}")
+    return removed
+
+
+def _copy_results_csv(conn, where_clauses, params, path, table_name, on_progress):
+    where_str = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+    with conn.cursor() as cur:
+        # COPY не принимает параметры запроса, поэтому значения подставляются на клиенте с экранированием
+        query = cur.mogrify(f"""
+            SELECT {', '.join(EXPORT_COLUMNS)}
+            FROM {table_name}
+            {where_str}
+            ORDER BY freq_mln DESC, id DESC
+        """, params)
+        with open(path, "wb") as file:
+            writer = _CopyProgressWriter(file, on_progress)
+            cur.copy_expert(b"COPY (" + query + b") TO STDOUT WITH (FORMAT csv, HEADER true)", writer)
+        # Число строк из тега команды COPY; -1 — драйвер его не сообщил
+        rows = cur.rowcount if cur.rowcount >= 0 else None
+    conn.commit()
+    return rows
+
+
+def _csv_to_parquet(csv_path, parquet_path):
+    """Перекладывает CSV в Parquet потоково: по блоку EXPORT_PARQUET_BLOCK_BYTES за раз."""
+    column_types = {"id": pa.int64(), "freq_mln": pa.float64(), "len": pa.int16()}
+    column_types.update({column: pa.string() for column in EXPORT_COLUMNS if column not in column_types})
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(block_size=EXPORT_PARQUET_BLOCK_BYTES),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types),
+    )
+    with pa_parquet.ParquetWriter(parquet_path, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+
+def export_results(conn, where_clauses, params, export_format="csv", table_name="ngrams", on_progress=None):
+    """
+    Выгружает все фразы выборки (колонки EXPORT_COLUMNS, по убыванию частотности) в файл EXPORT_DIR.
+    on_progress(байт, строк файла) вызывается по мере поступления данных COPY. Parquet собирается из CSV
+    потоковой перекладкой (нужен пакет pyarrow). Возвращает (путь к файлу, число фраз или None, если
+    драйвер его не сообщил) или None при ошибке.
+    """
+    if not conn: return None
+    if export_format not in EXPORT_FORMATS:
+        print(f"Ошибка выгрузки: неизвестный формат {export_format}")
+        return None
+    if export_format == "parquet" and pa is None:
+        print("Ошибка выгрузки: для формата Parquet установите пакет pyarrow")
+        return None
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    purge_old_exports()
+    base_name = f"ngrams_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    csv_path = os.path.join(EXPORT_DIR, base_name + ".csv")
+    result_path = os.path.join(EXPORT_DIR, f"{base_name}.{export_format}")
+    try:
+        rows = _copy_results_csv(conn, where_clauses, params, csv_path, table_name, on_progress)
+        if export_format == "parquet":
+            _csv_to_parquet(csv_path, result_path)
+            _remove_file(csv_path)
+        return result_path, rows
+    except Exception as e:
+        print(f"Ошибка выгрузки результатов: {e}")
+        _abort_export(conn, csv_path, result_path)
+        return None
+    except BaseException:
+        # Прерывание rerun'ом Streamlit: выгрузка отменяется, недописанные файлы удаляются
+        _abort_export(conn, csv_path, result_path)
+        raise
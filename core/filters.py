@@ -0,0 +1,98 @@
+import hashlib
+import json
+
+
+def normalize_block(block, rule_id_to_skip=None):
+    """
+    Каноническое представление блока фильтров: позиция и отсортированный список правил
+    (тип, оператор, отсортированные значения). Идентификаторы блока и правил, порядок правил
+    и значений, а также правила без значений на результат не влияют и отбрасываются.
+    """
+    rules = sorted(
+        (rule['type'], rule.get('operator', 'include'), sorted(rule['values']))
+        for rule in block['rules']
+        if rule['values'] and rule['id'] != rule_id_to_skip
+    )
+    return {"position": block['position'], "rules": rules}
+
+
+def block_fingerprint(block, rule_id_to_skip=None):
+    """Отпечаток содержимого блока (None, если в блоке нет активных правил)."""
+    normalized = normalize_block(block, rule_id_to_skip)
+    if not normalized['rules']:
+        return None
+    payload = json.dumps(normalized, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def canonicalize_blocks(blocks):
+    """
+    Каноническая форма блоков для ключей кэша: остаются только правила со значениями, блоки
+    упорядочены по содержимому, а идентификаторы заменены производными от этого порядка (b0, b0r0, ...).
+    Одинаковые по смыслу состояния фильтров дают одинаковые канонические блоки независимо от uuid
+    и порядка добавления. Возвращает (канонические блоки, {исходный rule_id: канонический rule_id}).
+    """
+    keyed = []
+    for block in blocks:
+        normalized = normalize_block(block)
+        if normalized['rules']:
+            keyed.append((json.dumps(normalized, ensure_ascii=False, separators=(',', ':')), block))
+    keyed.sort(key=lambda item: item[0])
+
+    canonical_blocks = []
+    rule_ids = {}
+    for block_index, (_, block) in enumerate(keyed):
+        active_rules = sorted(
+            (rule for rule in block['rules'] if rule['values']),
+            key=lambda rule: (rule['type'], rule.get('operator', 'include'), sorted(rule['values']))
+        )
+        canonical_rules = []
+        for rule_index, rule in enumerate(active_rules):
+            rule_id = f"b{block_index}r{rule_index}"
+            rule_ids[rule['id']] = rule_id
+            canonical_rules.append({
+                'id': rule_id, 'type': rule['type'],
+                'operator': rule.get('operator', 'include'), 'values': sorted(rule['values'])
+            })
+        canonical_blocks.append({'id': f"b{block_index}", 'position': block['position'], 'rules': canonical_rules})
+    return canonical_blocks, rule_ids
+
+
+def canonical_rule_requests(blocks):
+    """
+    Канонические запросы значений для всех правил на экране (см. get_unique_values_for_rules).
+    Правило со значениями исключает из фильтра само себя, правило без значений ни на что не влияет,
+    поэтому его запрос определяется только позицией и типом. Возвращает (канонические блоки,
+    отсортированный кортеж запросов, {исходный rule_id: ключ запроса}).
+    """
+    canonical_blocks, rule_ids = canonicalize_blocks(blocks)
+    block_ids = {rule['id']: block['id'] for block in canonical_blocks for rule in block['rules']}
+    requests = set()
+    request_keys = {}
+    for block in blocks:
+        for rule in block['rules']:
+            canonical_rule_id = rule_ids.get(rule['id'])
+            if canonical_rule_id is not None:
+                request = (block_ids[canonical_rule_id], canonical_rule_id, block['position'], rule['type'])
+            else:
+                request = (None, f"p{block['position']}:{rule['type']}", block['position'], rule['type'])
+            requests.add(request)
+            request_keys[rule['id']] = request[1]
+    return canonical_blocks, tuple(sorted(requests, key=lambda r: (r[1], r[2], r[3]))), request_keys
+
+
+def filters_fingerprint(selected_lengths, blocks, **params):
+    """
+    Отпечаток состояния фильтров страницы: набор длин, нормализованные блоки с активными
+    правилами (их порядок не важен) и прочие параметры запросов (пороги, движок).
+    """
+    normalized_blocks = sorted(
+        json.dumps(normalized, ensure_ascii=False, separators=(',', ':'))
+        for normalized in map(normalize_block, blocks)
+        if normalized['rules']
+    )
+    payload = json.dumps(
+        {"lengths": sorted(selected_lengths), "blocks": normalized_blocks, "params": params},
+        ensure_ascii=False, separators=(',', ':'), sort_keys=True
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import Counter
+
+from core.database import build_subset_index
+
+# Сколько раз условие должно встретиться для таблицы, чтобы под него построили индекс
+INDEX_BUILD_THRESHOLD = int(os.getenv("INDEX_BUILD_THRESHOLD", "3"))
+# Индекс сортировки нужен каждому запросу результатов, поэтому строится сразу
+IMMEDIATE_INDEX_KEYS = frozenset({("order",)})
+# После построения (или проверки) индекса условие не учитывается столько секунд; затем
+# созревшее условие снова проверит IF NOT EXISTS — так пересозданная таблица получит индексы заново
+INDEX_RECHECK_INTERVAL = int(os.getenv("INDEX_RECHECK_INTERVAL", "600"))
+
+
+class IndexPlanner:
+    """
+    Ленивое индексирование таблиц-подмножеств: считает, какие условия (атрибут, позиция)
+    реально приходят к каждой таблице, и после INDEX_BUILD_THRESHOLD повторов строит в фоне
+    подходящий индекс выражения (core.database.build_subset_index). Таблица создается
+    без индексов, а строятся только те, что пригодились.
+    """
+
+    def __init__(self, executor, threshold=INDEX_BUILD_THRESHOLD):
+        self.executor = executor
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._pending = set()
+        self._settled = {}
+
+    def record(self, table_name, keys, deferred=False):
+        """
+        Учитывает условия одного запроса к таблице и запускает построение созревших индексов
+        в фоне на отдельном подключении из пула. Временная таблица видна только подключению своей
+        сессии, и строить на нем индекс параллельно с запросами сессии нельзя (общая транзакция),
+        поэтому с deferred=True созревшие условия только возвращаются: вызывающий строит их
+        через build_deferred() в начале своей задачи на подключении сессии.
+        """
+        ready = []
+        now = time.monotonic()
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                slot = (table_name, key)
+                if slot in self._pending or now - self._settled.get(slot, float('-inf')) < INDEX_RECHECK_INTERVAL:
+                    continue
+                self._counts[slot] += 1
+                if self._counts[slot] >= self.threshold or key in IMMEDIATE_INDEX_KEYS:
+                    del self._counts[slot]
+                    self._pending.add(slot)
+                    ready.append(key)
+        if deferred:
+            return ready
+        for key in ready:
+            future = self.executor.submit_query(build_subset_index, table_name, key, concurrently=True)
+            future.add_done_callback(lambda _, slot=(table_name, key): self._done(slot))
+        return ready
+
+    def build_deferred(self, conn, table_name, keys):
+        """
+        Строит индексы, отложенные record(deferred=True), на подключении вызывающего потока.
+        Для временной таблицы вызывается под блокировкой подключения сессии (SessionConnections.use).
+        """
+        for key in keys:
+            try:
+                build_subset_index(conn, table_name, key, concurrently=False)
+            finally:
+                self._done((table_name, key))
+
+    def abandon_deferred(self, table_name, keys):
+        """Снимает отложенные условия, которые так и не были построены: они созреют заново."""
+        with self._lock:
+            for key in keys:
+                self._pending.discard((table_name, key))
+
+    def _done(self, slot):
+        with self._lock:
+            self._pending.discard(slot)
+            self._settled[slot] = time.monotonic()
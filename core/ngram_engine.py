@@ -0,0 +1,433 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from core.database import iter_query_rows, WORD_ANALYSIS_TOP_K, WORD_ANALYSIS_TYPES
+from core.filters import block_fingerprint
+
+# Атрибуты с одним значением на позицию (morph — набор признаков, хранится битовой маской)
+ENGINE_ATTRIBUTES = ('dep', 'pos', 'tag', 'token', 'lemma')
+SUGGESTION_TYPES = ('dep', 'pos', 'tag', 'morph')
+
+
+class NgramMatrixEngine:
+    """
+    Движок фильтрации в памяти процесса: n-граммы выбранных длин загружаются один раз
+    в NumPy-массивы, а блоки фильтров вычисляются векторными булевыми масками без обращения к БД.
+
+    Представление:
+      - codes[attr] — матрица int32 (строки × позиции) с кодами значений, -1 — нет значения;
+      - morph_bits — матрица uint64 (строки × позиции × слова) с битами признаков morph;
+      - freq, ids, row_lengths — векторы частотности, id и длины n-граммы.
+    Коды локальны для движка (values[attr][code] -> значение).
+
+    Маски блоков кэшируются по отпечатку содержимого блока (core.filters.block_fingerprint),
+    поэтому правка одного блока пересчитывает только его, а остальные берутся из кэша.
+    """
+
+    # Сколько масок блоков держать в LRU-кэше движка
+    BLOCK_CACHE_SIZE = 128
+
+    def __init__(self, lengths, ids, texts, freq, row_lengths, codes, values, morph_len, morph_bits, morph_values):
+        self.lengths = tuple(sorted(lengths))
+        self.ids = ids
+        self.texts = texts
+        self.freq = freq
+        self.row_lengths = row_lengths
+        self.codes = codes
+        self.values = values
+        self.value_index = {attr: {v: i for i, v in enumerate(vals)} for attr, vals in values.items()}
+        self.morph_len = morph_len
+        self.morph_bits = morph_bits
+        self.morph_values = morph_values
+        self.morph_index = {v: i for i, v in enumerate(morph_values)}
+        self.max_len = codes['dep'].shape[1] if len(ids) else 0
+        # Общий порядок выдачи результатов: freq_mln DESC, id DESC
+        self.order = np.lexsort((-ids, -freq)) if len(ids) else np.array([], dtype=np.int64)
+        self._block_cache = OrderedDict()
+        self._block_cache_lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, conn, lengths, batch_size=20000):
+        """Загружает n-граммы выбранных длин из ngrams потоковым чтением через именованный курсор."""
+        lengths = sorted(lengths)
+        max_len = max(lengths) if lengths else 0
+        values = {attr: [] for attr in ENGINE_ATTRIBUTES}
+        value_index = {attr: {} for attr in ENGINE_ATTRIBUTES}
+        morph_values, morph_index = [], {}
+
+        ids, texts, freq, row_lengths, morph_len = [], [], [], [], []
+        code_batches = {attr: [] for attr in ENGINE_ATTRIBUTES}
+        morph_rows, morph_positions, morph_features = [], [], []
+
+        query = "SELECT id, text, freq_mln, len, deps, pos, tags, tokens, lemmas, morph FROM ngrams WHERE len = ANY(%s::int[]);"
+        row_number = 0
+        for rows in iter_query_rows(conn, query, (list(lengths),), batch_size=batch_size):
+            batch_codes = {attr: np.full((len(rows), max_len), -1, dtype=np.int32) for attr in ENGINE_ATTRIBUTES}
+            for i, (ngram_id, text, freq_mln, length, deps, pos, tags, tokens, lemmas, morph) in enumerate(rows):
+                ids.append(ngram_id)
+                texts.append(text)
+                freq.append(float(freq_mln))
+                row_lengths.append(length)
+                for attr, array in zip(ENGINE_ATTRIBUTES, (deps, pos, tags, tokens, lemmas)):
+                    index = value_index[attr]
+                    for position, value in enumerate((array or [])[:max_len]):
+                        if value is None:
+                            continue
+                        code = index.get(value)
+                        if code is None:
+                            code = index[value] = len(values[attr])
+                            values[attr].append(value)
+                        batch_codes[attr][i, position] = code
+                morph = (morph or [])[:max_len]
+                morph_len.append(len(morph))
+                for position, features in enumerate(morph):
+                    for feature in features or []:
+                        bit = morph_index.get(feature)
+                        if bit is None:
+                            bit = morph_index[feature] = len(morph_values)
+                            morph_values.append(feature)
+                        morph_rows.append(row_number + i)
+                        morph_positions.append(position)
+                        morph_features.append(bit)
+            for attr in ENGINE_ATTRIBUTES:
+                code_batches[attr].append(batch_codes[attr])
+            row_number += len(rows)
+
+        codes = {
+            attr: np.vstack(batches) if batches else np.empty((0, max_len), dtype=np.int32)
+            for attr, batches in code_batches.items()
+        }
+        words = max((len(morph_values) + 63) // 64, 1)
+        morph_bits = np.zeros((row_number, max_len, words), dtype=np.uint64)
+        if morph_features:
+            features = np.asarray(morph_features, dtype=np.uint64)
+            np.bitwise_or.at(
+                morph_bits,
+                (np.asarray(morph_rows), np.asarray(morph_positions), (features // 64).astype(np.int64)),
+                np.left_shift(np.uint64(1), features % np.uint64(64))
+            )
+        return cls(
+            lengths,
+            ids=np.asarray(ids, dtype=np.int64),
+            texts=np.asarray(texts, dtype=object),
+            freq=np.asarray(freq, dtype=np.float64),
+            row_lengths=np.asarray(row_lengths, dtype=np.int16),
+            codes=codes,
+            values=values,
+            morph_len=np.asarray(morph_len, dtype=np.int16),
+            morph_bits=morph_bits,
+            morph_values=morph_values,
+        )
+
+    # --- Вычисление масок ---
+    def _full_mask(self):
+        return np.ones(self.size, dtype=bool)
+
+    def _min_frequency_mask(self, min_frequency):
+        return self.freq >= float(min_frequency)
+
+    def _as_bool(self, mask):
+        """Приводит маску движка к булевому вектору по строкам."""
+        return mask
+
+    def _codes_for(self, attr, values):
+        index = self.value_index[attr]
+        return np.asarray([index[v] for v in values if v in index], dtype=np.int32)
+
+    def _morph_mask(self, values):
+        mask = np.zeros(self.morph_bits.shape[2], dtype=np.uint64)
+        for value in values:
+            bit = self.morph_index.get(value)
+            if bit is not None:
+                mask[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+        return mask
+
+    def rule_mask(self, rule, position):
+        """Маска строк, удовлетворяющих одному правилу на позиции (семантика как у build_where_clauses)."""
+        if position >= self.max_len:
+            return np.zeros(self.size, dtype=bool)
+        if rule['type'] == 'morph':
+            present = self.morph_len > position
+            hit = (self.morph_bits[:, position, :] & self._morph_mask(rule['values'])).any(axis=1)
+        else:
+            column = self.codes[rule['type']][:, position]
+            present = column >= 0
+            hit = np.isin(column, self._codes_for(rule['type'], rule['values']))
+        if rule.get('operator', 'include') == 'exclude':
+            return present & ~hit
+        return present & hit
+
+    def block_mask(self, block, rule_id_to_skip=None):
+        """
+        Маска блока: И по всем его правилам со значениями (None, если активных правил нет).
+        Маска без правила rule_id_to_skip (для подсчета значений этого правила) — это маска
+        другого по содержимому блока и кэшируется под своим отпечатком.
+        """
+        fingerprint = block_fingerprint(block, rule_id_to_skip)
+        if fingerprint is None:
+            return None
+        with self._block_cache_lock:
+            mask = self._block_cache.get(fingerprint)
+            if mask is not None:
+                self._block_cache.move_to_end(fingerprint)
+                return mask
+
+        for rule in block['rules']:
+            if rule['id'] == rule_id_to_skip or not rule['values']:
+                continue
+            rule_result = self.rule_mask(rule, block['position'])
+            mask = rule_result if mask is None else mask & rule_result
+        # Маска разделяется между запросами и сессиями, поэтому защищаем ее от изменения на месте
+        mask.flags.writeable = False
+
+        with self._block_cache_lock:
+            self._block_cache[fingerprint] = mask
+            while len(self._block_cache) > self.BLOCK_CACHE_SIZE:
+                self._block_cache.popitem(last=False)
+        return mask
+
+    def filter_mask(self, blocks, min_frequency=0, block_id_to_skip=None, rule_id_to_skip=None):
+        """
+        Маска всей выборки: И по закэшированным маскам блоков и мин. частотности.
+        Выборки «без одного блока/правила» для get_unique_values_for_rule собираются
+        из тех же масок блоков, пропуская исключенный блок или беря маску блока без правила.
+        """
+        mask = self._full_mask()
+        for block in blocks:
+            if block['id'] == block_id_to_skip and rule_id_to_skip is None:
+                continue
+            skip_rule = rule_id_to_skip if block['id'] == block_id_to_skip else None
+            block_result = self.block_mask(block, rule_id_to_skip=skip_rule)
+            if block_result is not None:
+                mask &= block_result
+        if min_frequency > 0:
+            mask &= self._min_frequency_mask(min_frequency)
+        return mask
+
+    # --- Результаты ---
+    def get_totals(self, mask):
+        return float(self.freq[mask].sum()), int(mask.sum())
+
+    def _tokens_of(self, row):
+        token_values = self.values['token']
+        return [token_values[c] for c in self.codes['token'][row] if c >= 0]
+
+    def get_results_page(self, mask, after=None, page_size=500):
+        """Страница фраз (text, freq_mln, tokens, id) в порядке freq_mln DESC, id DESC после ключа after."""
+        mask = self._as_bool(mask)
+        selected = self.order[mask[self.order]]
+        if after is not None:
+            after_freq, after_id = float(after[0]), after[1]
+            sel_freq, sel_ids = self.freq[selected], self.ids[selected]
+            past = (sel_freq < after_freq) | ((sel_freq == after_freq) & (sel_ids < after_id))
+            selected = selected[np.argmax(past):] if past.any() else selected[:0]
+        return [
+            (self.texts[row], float(self.freq[row]), self._tokens_of(row), int(self.ids[row]))
+            for row in selected[:page_size]
+        ]
+
+    def get_word_analysis(self, mask, top_k=WORD_ANALYSIS_TOP_K):
+        """
+        Анализ слов по позициям среди строк маски (векторно, через bincount по кодам):
+        top_k токенов и лемм на позицию с F и Q в формате core.database.get_word_analysis.
+        """
+        analysis = {}
+        for attr in WORD_ANALYSIS_TYPES:
+            by_position = {}
+            for position in range(self.max_len):
+                qty, freq, values = self._value_totals(attr, position, mask)
+                present = np.nonzero(qty)[0]
+                if not len(present):
+                    continue
+                top = present[np.lexsort((-qty[present], -freq[present]))][:top_k]
+                by_position[position] = {
+                    "values": [values[i] for i in top], "freq": freq[top].tolist(), "qty": qty[top].tolist(),
+                    "total_freq": float(freq.sum()), "total_qty": int(qty.sum()),
+                }
+            if by_position:
+                analysis[attr] = by_position
+        return analysis
+
+    # --- Фасеты ---
+    def _value_totals(self, attr, position, mask):
+        """Частотность и количество по каждому значению атрибута на позиции среди строк маски."""
+        if attr == 'morph':
+            rows = mask & (self.morph_len > position)
+            bits = np.unpackbits(self.morph_bits[rows, position, :].view(np.uint8), axis=1, bitorder='little')
+            bits = bits[:, :len(self.morph_values)]
+            return bits.sum(axis=0), self.freq[rows] @ bits, self.morph_values
+        column = self.codes[attr][mask, position]
+        valid = column >= 0
+        size = len(self.values[attr])
+        qty = np.bincount(column[valid], minlength=size)
+        freq = np.bincount(column[valid], weights=self.freq[mask][valid], minlength=size)
+        return qty, freq, self.values[attr]
+
+    def _ranked_values(self, attr, position, mask, min_quantity):
+        qty, freq, values = self._value_totals(attr, position, mask)
+        keep = np.nonzero((qty > 0) & (qty >= min_quantity))[0]
+        keep = keep[np.argsort(-freq[keep], kind='stable')]
+        return [(values[i], float(freq[i]), int(qty[i])) for i in keep]
+
+    def get_unique_values_for_rule(self, position, rule_type, blocks, block_id_to_exclude, rule_id_to_exclude, min_frequency, min_quantity):
+        if position >= self.max_len:
+            return []
+        mask = self.filter_mask(blocks, min_frequency, block_id_to_exclude, rule_id_to_exclude)
+        return self._ranked_values(rule_type, position, mask, min_quantity)
+
+    def get_unique_values_for_rules(self, rule_requests, blocks, min_frequency, min_quantity):
+        """Значения для набора правил (block_id, rule_id, position, rule_type) из общих масок блоков."""
+        return {
+            rule_id: self.get_unique_values_for_rule(position, rule_type, blocks, block_id, rule_id, min_frequency, min_quantity)
+            for block_id, rule_id, position, rule_type in rule_requests
+        }
+
+    def get_suggestion_data(self, filter_blocks, min_frequency, min_quantity):
+        mask = self.filter_mask(filter_blocks, min_frequency)
+        active_filters = {(b['position'], r['type']) for b in filter_blocks for r in b['rules'] if r.get('values')}
+        suggestion_data = {}
+        for position in range(self.max_len):
+            entries = []
+            for s_type in SUGGESTION_TYPES:
+                if (position, s_type) in active_filters:
+                    continue
+                for value, freq, qty in self._ranked_values(s_type, position, mask, min_quantity):
+                    if value == '':
+                        continue
+                    entries.append({"type": s_type, "value": value, "freq": freq, "qty": qty})
+            if entries:
+                entries.sort(key=lambda e: e['freq'], reverse=True)
+                suggestion_data[position] = entries
+        return suggestion_data
+
+    def get_frequent_sequences(self, sequence_type, phrase_length, filter_blocks, limit=100):
+        if not (1 <= phrase_length <= self.max_len):
+            return []
+        mask = self._as_bool(self.filter_mask(filter_blocks)) & (self.row_lengths == phrase_length)
+        matrix = self.codes[sequence_type][mask, :phrase_length]
+        complete = (matrix >= 0).all(axis=1)
+        matrix, freq = matrix[complete], self.freq[mask][complete]
+        if not len(matrix):
+            return []
+        sequences, inverse = np.unique(matrix, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        totals_freq = np.bincount(inverse, weights=freq)
+        totals_qty = np.bincount(inverse)
+        top = np.argsort(-totals_freq, kind='stable')[:limit]
+        values = self.values[sequence_type]
+        return [
+            tuple(values[c] for c in sequences[i]) + (float(totals_freq[i]), int(totals_qty[i]))
+            for i in top
+        ]
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _popcount(words):
+    """Число установленных битов в массиве uint64."""
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(words).sum())
+    return int(_POPCOUNT_TABLE[words.view(np.uint8)].sum())
+
+
+class NgramBitmapEngine(NgramMatrixEngine):
+    """
+    Движок на битовых индексах: для каждой тройки (позиция, атрибут, значение) хранится
+    упакованный битсет строк. Правило include — OR битсетов своих значений, exclude —
+    AND-NOT относительно битсета «на позиции есть значение», блоки пересекаются AND.
+    Q считается popcount-ом, F — скалярным произведением маски на вектор freq_mln.
+
+    Битсеты строятся лениво при первом обращении и далее переиспользуются,
+    поэтому переключение чекбоксов подсказок сводится к нескольким побитовым операциям.
+    Движок разделяется всеми сессиями, поэтому битсеты держатся в LRU-кэше ограниченного размера,
+    как и маски блоков. Маской этого движка служит битсет (uint64), а не булев вектор.
+    """
+
+    # Атрибуты с небольшим словарем, фасеты по которым считаются через битсеты
+    BITMAP_FACET_TYPES = ('dep', 'pos', 'tag', 'morph')
+    # Сколько битсетов (позиция, атрибут, значение) держать в LRU-кэше движка
+    BITMAP_CACHE_SIZE = 2048
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.words = (self.size + 63) // 64
+        self._bitmaps = OrderedDict()
+        self._bitmaps_lock = threading.Lock()
+
+    def _pack(self, mask):
+        packed = np.zeros(self.words * 8, dtype=np.uint8)
+        bits = np.packbits(mask, bitorder='little')
+        packed[:len(bits)] = bits
+        return packed.view(np.uint64)
+
+    def _as_bool(self, mask):
+        return np.unpackbits(mask.view(np.uint8), count=self.size, bitorder='little').astype(bool)
+
+    def _full_mask(self):
+        return self._pack(np.ones(self.size, dtype=bool))
+
+    def _min_frequency_mask(self, min_frequency):
+        return self._pack(super()._min_frequency_mask(min_frequency))
+
+    def bitmap(self, position, attr, code=None):
+        """Битсет строк со значением code атрибута attr на позиции (code=None — любое значение)."""
+        key = (position, attr, code)
+        with self._bitmaps_lock:
+            bitmap = self._bitmaps.get(key)
+            if bitmap is not None:
+                self._bitmaps.move_to_end(key)
+                return bitmap
+
+        if attr == 'morph':
+            if code is None:
+                rows = self.morph_len > position
+            else:
+                rows = (self.morph_bits[:, position, code // 64] >> np.uint64(code % 64)) & np.uint64(1) != 0
+        else:
+            column = self.codes[attr][:, position]
+            rows = column >= 0 if code is None else column == code
+        bitmap = self._pack(rows)
+        bitmap.flags.writeable = False
+
+        with self._bitmaps_lock:
+            self._bitmaps[key] = bitmap
+            while len(self._bitmaps) > self.BITMAP_CACHE_SIZE:
+                self._bitmaps.popitem(last=False)
+        return bitmap
+
+    def _value_codes(self, attr, values):
+        index = self.morph_index if attr == 'morph' else self.value_index[attr]
+        return [index[v] for v in values if v in index]
+
+    def rule_mask(self, rule, position):
+        hit = np.zeros(self.words, dtype=np.uint64)
+        if position >= self.max_len:
+            return hit
+        for code in self._value_codes(rule['type'], rule['values']):
+            hit |= self.bitmap(position, rule['type'], code)
+        if rule.get('operator', 'include') == 'exclude':
+            return self.bitmap(position, rule['type']) & ~hit
+        return hit
+
+    def get_totals(self, mask):
+        return float(self.freq @ self._as_bool(mask)), _popcount(mask)
+
+    def _value_totals(self, attr, position, mask):
+        if attr not in self.BITMAP_FACET_TYPES:
+            return super()._value_totals(attr, position, self._as_bool(mask))
+        values = self.morph_values if attr == 'morph' else self.values[attr]
+        # Q — popcount пересечения упакованных битсетов, без распаковки по строкам
+        qty = np.fromiter(
+            (_popcount(self.bitmap(position, attr, code) & mask) for code in range(len(values))),
+            dtype=np.int64, count=len(values)
+        )
+        if not qty.any():
+            return qty, np.zeros(len(values), dtype=np.float64), values
+        # F — взвешенная сумма freq_mln: маска распаковывается один раз для всех значений
+        _, freq, _ = super()._value_totals(attr, position, self._as_bool(mask))
+        return qty, freq, values
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# --- Постоянный кэш результатов ---
+# Второй уровень под st.cache_data: переживает перезапуск процесса и общий для всех воркеров
+# и пользователей. Ключ — отпечаток канонических аргументов и версия данных ngrams,
+# значение — сжатый zlib pickle результата.
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "sqlite")  # sqlite | redis | none
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", os.path.join(".cache", "results.sqlite3"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+RESULT_CACHE_REDIS_URL = os.getenv("RESULT_CACHE_REDIS_URL", "redis://localhost:6379/0")
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def make_cache_key(namespace, data_version, *parts):
+    """Ключ записи: sha1 от пространства имен, версии данных и канонических аргументов."""
+    payload = json.dumps([namespace, data_version, parts], ensure_ascii=False, separators=(',', ':'), sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _dump(value):
+    return zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _load(blob):
+    return pickle.loads(zlib.decompress(blob))
+
+
+class SQLiteResultCache:
+    """
+    Кэш в файле SQLite с вытеснением давно не читанных записей (LRU) при превышении бюджета в байтах.
+    Файл может использоваться несколькими процессами одновременно (журнал WAL).
+    """
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as db:
+            db.execute("PRAGMA journal_mode=WAL;")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                );
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS results_last_access_idx ON results (last_access);")
+
+    def _connection(self):
+        # sqlite3-подключение нельзя делить между потоками, поэтому у каждого потока свое
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        """Возвращает сохраненный результат или None."""
+        try:
+            db = self._connection()
+            row = db.execute("SELECT value, created_at FROM results WHERE key = ?;", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] > self.ttl:
+                db.execute("DELETE FROM results WHERE key = ?;", (key,))
+                return None
+            db.execute("UPDATE results SET last_access = ? WHERE key = ?;", (now, key))
+            return _load(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, zlib.error) as e:
+            print(f"Ошибка чтения кэша результатов: {e}")
+            return None
+
+    def set(self, key, value):
+        """Сохраняет результат и вытесняет давно не читанные записи сверх бюджета."""
+        try:
+            blob = _dump(value)
+            if len(blob) > self.max_bytes:
+                return
+            now = time.time()
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?);",
+                (key, blob, len(blob), now, now)
+            )
+            self._evict(db)
+        except (sqlite3.Error, pickle.PicklingError) as e:
+            print(f"Ошибка записи в кэш результатов: {e}")
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM results;").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            excess = total - self.max_bytes
+            freed = 0
+            victims = []
+            for key, size in db.execute("SELECT key, size FROM results ORDER BY last_access;"):
+                victims.append((key,))
+                freed += size
+                if freed >= excess:
+                    break
+            db.executemany("DELETE FROM results WHERE key = ?;", victims)
+            db.execute("COMMIT;")
+        except sqlite3.Error:
+            db.execute("ROLLBACK;")
+            raise
+
+
+class RedisResultCache:
+    """
+    Кэш на Redis-совместимом сервере. Бюджет памяти и LRU задаются на сервере
+    (maxmemory и maxmemory-policy allkeys-lru), записи дополнительно живут не дольше ttl.
+    """
+
+    def __init__(self, url=RESULT_CACHE_REDIS_URL, ttl=RESULT_CACHE_TTL, prefix="ngrams:results:"):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            blob = self.client.get(self.prefix + key)
+            return _load(blob) if blob is not None else None
+        except (redis.RedisError, pickle.UnpicklingError, zlib.error) as e:
+            print(f"Ошибка чтения кэша результатов: {e}")
+            return None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, _dump(value), ex=self.ttl)
+        except (redis.RedisError, pickle.PicklingError) as e:
+            print(f"Ошибка записи в кэш результатов: {e}")
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Лениво создает кэш процесса по RESULT_CACHE_BACKEND; None — постоянный кэш отключен или недоступен."""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = _create_result_cache() or False
+    return _result_cache or None
+
+
+def _create_result_cache():
+    try:
+        if RESULT_CACHE_BACKEND == "sqlite":
+            return SQLiteResultCache()
+        if RESULT_CACHE_BACKEND == "redis":
+            if redis is None:
+                print("Ошибка кэша результатов: для RESULT_CACHE_BACKEND=redis установите пакет redis")
+                return None
+            return RedisResultCache()
+    except Exception as e:
+        print(f"Ошибка инициализации кэша результатов: {e}")
+        return None
+    return None
+
+
+def cached_result(namespace, data_version, parts, compute):
+    """
+    Возвращает результат compute() через постоянный кэш: ключ строится из namespace, версии данных
+    и канонических аргументов parts. None от compute() означает, что запрос не выполнен (ошибка, отмена,
+    statement_timeout): он возвращается вызывающему, но не сохраняется. Пустые результаты сохраняются —
+    это настоящий ответ, например (0, 0) для выборки без строк.
+    """
+    cache = get_result_cache()
+    if cache is None or data_version is None:
+        return compute()
+    key = make_cache_key(namespace, data_version, *parts)
+    value = cache.get(key)
+    if value is not None:
+        return value
+    value = compute()
+    if value is not None:
+        cache.set(key, value)
+    return value
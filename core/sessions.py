@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from streamlit.runtime import Runtime
+
+from core.database import get_db_connection, release_db_connection, DB_POOL_MAX_SIZE
+
+# Закрепленное подключение сессии без обращений дольше этого интервала (сек) возвращается в пул
+SESSION_CONNECTION_IDLE_TTL = int(os.getenv("SESSION_CONNECTION_IDLE_TTL", "600"))
+# Сколько подключений пула одновременно могут быть закреплены за сессиями; остальные остаются
+# фоновым задачам и операциям страниц, поэтому предел заметно меньше DB_POOL_MAX_SIZE
+SESSION_CONNECTIONS_MAX = int(os.getenv("SESSION_CONNECTIONS_MAX", str(max(DB_POOL_MAX_SIZE // 4, 1))))
+
+
+class SessionConnections:
+    """
+    Подключения из общего пула, закрепленные за сессиями браузера для их временных объектов.
+    Временная таблица видна только своему подключению, поэтому сессия держит одно подключение,
+    пока таблица нужна, а не делит его с остальными пользователями. Подключения закрытых
+    (или долго простаивающих) сессий освобождаются в reap(): временные объекты удаляются
+    через DISCARD TEMP, подключение возвращается в пул. Одновременно закреплено не больше
+    max_sessions подключений, чтобы сессии не забрали весь пул.
+
+    Одно psycopg2-подключение не должно выполнять запросы из двух потоков: у них общая транзакция,
+    и откат одного запроса отменяет другой. Поэтому у каждой сессии своя блокировка, и всякая работа
+    с ее подключением (фоновые задачи, запросы страницы, удаление таблицы, освобождение) идет через use().
+    """
+
+    def __init__(self, idle_ttl=SESSION_CONNECTION_IDLE_TTL, max_sessions=SESSION_CONNECTIONS_MAX):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._pinned = {}  # session_id -> (подключение, время последнего обращения)
+        self._reserved = 0  # подключения, которые сейчас берутся из пула для pin()
+        self._session_locks = {}  # session_id -> RLock подключения сессии
+
+    def _acquire_session_lock(self, session_id, blocking=True):
+        """
+        Захватывает блокировку подключения сессии и возвращает ее (None — занята, при blocking=False).
+        release() удаляет блокировку сессии: ждавший ее поток берет блокировку заново, иначе два потока
+        могли бы работать с новым подключением сессии под разными блокировками.
+        """
+        while True:
+            with self._lock:
+                lock = self._session_locks.setdefault(session_id, threading.RLock())
+            if not lock.acquire(blocking=blocking):
+                return None
+            with self._lock:
+                if self._session_locks.get(session_id) is lock:
+                    return lock
+            lock.release()
+
+    @contextmanager
+    def use(self, session_id, pin=False):
+        """
+        Отдает подключение сессии на время блока, удерживая ее блокировку. pin=True — закрепляет
+        подключение при первом обращении (см. pin()), иначе None, если за сессией ничего не закреплено.
+        Блокировка реентерабельна: вложенные use() одного потока не ждут друг друга.
+        """
+        lock = self._acquire_session_lock(session_id)
+        try:
+            yield self.pin(session_id) if pin else self.get(session_id)
+        finally:
+            lock.release()
+
+    def pin(self, session_id):
+        """
+        Возвращает подключение сессии, при первом обращении закрепляя за ней подключение из пула.
+        None — пул исчерпан или за сессиями уже закреплено max_sessions подключений.
+        Запросы на подключении выполняются внутри use(session_id, pin=True).
+        """
+        self.reap()
+        with self._lock:
+            entry = self._pinned.get(session_id)
+            if entry is not None and not entry[0].closed:
+                self._pinned[session_id] = (entry[0], time.monotonic())
+                return entry[0]
+            if entry is None and len(self._pinned) + self._reserved >= self.max_sessions:
+                print(f"Ошибка закрепления подключения: за сессиями уже закреплено {self.max_sessions} подключений")
+                return None
+            self._reserved += 1
+        try:
+            conn = get_db_connection()
+        finally:
+            with self._lock:
+                self._reserved -= 1
+        if conn is None:
+            return None
+        with self._lock:
+            current = self._pinned.get(session_id)
+            if current is not None and current is not entry and not current[0].closed:
+                # Параллельный pin() этой же сессии успел закрепить подключение: лишнее возвращается в пул
+                conn, duplicate = current[0], conn
+            else:
+                self._pinned[session_id] = (conn, time.monotonic())
+                duplicate = entry[0] if entry is not None else None
+        if duplicate is not None:
+            release_db_connection(duplicate)
+        return conn
+
+    def get(self, session_id):
+        """
+        Подключение, уже закрепленное за сессией, или None. Выполнять на нем запросы можно только
+        внутри use(); сам get() годится для проверки, что подключение еще закреплено.
+        """
+        with self._lock:
+            entry = self._pinned.get(session_id)
+            if entry is None:
+                return None
+            self._pinned[session_id] = (entry[0], time.monotonic())
+            return entry[0]
+
+    def release(self, session_id, blocking=True):
+        """
+        Удаляет временные объекты сессии и возвращает ее подключение в пул. Ждет, пока подключение
+        освободится от текущей работы; с blocking=False занятое подключение не трогает и возвращает False.
+        """
+        lock = self._acquire_session_lock(session_id, blocking=blocking)
+        if lock is None:
+            return False
+        try:
+            with self._lock:
+                entry = self._pinned.pop(session_id, None)
+                self._session_locks.pop(session_id, None)
+            if entry is None:
+                return True
+            conn = entry[0]
+            try:
+                if not conn.closed:
+                    conn.rollback()
+                    with conn.cursor() as cur:
+                        cur.execute("DISCARD TEMP;")
+                    conn.commit()
+            except psycopg2.Error as e:
+                print(f"Ошибка при удалении временных объектов сессии: {e}")
+                conn.close()
+            release_db_connection(conn)
+            return True
+        finally:
+            lock.release()
+
+    def reap(self):
+        """Освобождает подключения сессий, которые закрыты в Streamlit или простаивают дольше idle_ttl."""
+        now = time.monotonic()
+        runtime = Runtime.instance() if Runtime.exists() else None
+        with self._lock:
+            stale = [
+                session_id for session_id, (conn, last_used) in self._pinned.items()
+                if now - last_used > self.idle_ttl
+                or (runtime is not None and not runtime.is_active_session(session_id))
+            ]
+        # Подключение, занятое запросом, освобождается при следующем reap(): ожидание здесь могло бы
+        # зациклиться с потоком, который держит блокировку своей сессии и тоже вызвал reap()
+        return sum(self.release(session_id, blocking=False) for session_id in stale)
@@ -1,6 +1,6 @@
 import streamlit as st
 import pandas as pd
-from core.database import get_db_connection, get_next_unmoderated_pattern, count_unmoderated_patterns, get_examples_by_pattern_id, save_moderation_record, process_moderation_submission
+from core.database import db_connection, get_next_unmoderated_pattern, count_unmoderated_patterns, get_examples_by_pattern_id, save_moderation_record, process_moderation_submission
 
 st.set_page_config(layout="wide", page_title="Pattern Moderation")
 
@@ -9,11 +9,12 @@ if 'logged_in' not in st.session_state or not st.session_state.logged_in:
     st.warning("Пожалуйста, войдите в систему, чтобы получить доступ к этой странице.")
     st.switch_page("Home.py")
 
-conn = get_db_connection()
-
-if not conn:
-    st.error("Не удалось подключиться к базе данных. Проверьте настройки в .env файле и доступность сервера.")
-    st.stop()
+# --- Database Connection ---
+# Подключение берется из пула на время каждой операции; здесь только проверяем, что база доступна
+with db_connection() as conn:
+    if not conn:
+        st.error("Не удалось подключиться к базе данных. Проверьте настройки в .env файле и доступность сервера.")
+        st.stop()
 
 # Phrase Length Options
 phrase_lengths_options = list(range(2, 13)) # 2 to 12
@@ -40,26 +41,27 @@ def load_next_pattern(skipped_pattern_id=None):
         min_freq = st.session_state.get('min_total_frequency', 0)
         min_qty = st.session_state.get('min_total_quantity', 0)
         
-        pattern = get_next_unmoderated_pattern(
-            conn, 
-            st.session_state.user_id, 
-            st.session_state.selected_phrase_length,
-            min_total_frequency=min_freq,
-            min_total_quantity=min_qty,
-            pattern_id_to_exclude=skipped_pattern_id
-        )
-        st.session_state.current_pattern_to_moderate = pattern
+        with db_connection() as conn:
+            pattern = get_next_unmoderated_pattern(
+                conn, 
+                st.session_state.user_id, 
+                st.session_state.selected_phrase_length,
+                min_total_frequency=min_freq,
+                min_total_quantity=min_qty,
+                pattern_id_to_exclude=skipped_pattern_id
+            )
+            st.session_state.current_pattern_to_moderate = pattern
         
-        st.session_state.remaining_patterns_count = count_unmoderated_patterns(
-            conn, st.session_state.user_id, st.session_state.selected_phrase_length,
-            min_total_frequency=min_freq,
-            min_total_quantity=min_qty
-        )
+            st.session_state.remaining_patterns_count = count_unmoderated_patterns(
+                conn, st.session_state.user_id, st.session_state.selected_phrase_length,
+                min_total_frequency=min_freq,
+                min_total_quantity=min_qty
+            )
         
-        if pattern:
-            st.session_state.current_ngrams = get_examples_by_pattern_id(conn, pattern['id'])
-        else:
-            st.session_state.current_ngrams = None
+            if pattern:
+                st.session_state.current_ngrams = get_examples_by_pattern_id(conn, pattern['id'])
+            else:
+                st.session_state.current_ngrams = None
     else:
         st.session_state.current_pattern_to_moderate = None
         st.session_state.remaining_patterns_count = 0
@@ -85,8 +87,11 @@ def handle_rating_submission(rating):
     pattern_id = st.session_state.current_pattern_to_moderate['id']
     user_id = st.session_state.user_id
 
-    if save_moderation_record(conn, pattern_id, user_id, rating, comment, tag):
-        process_moderation_submission(conn, pattern_id)
+    with db_connection() as conn:
+        saved = save_moderation_record(conn, pattern_id, user_id, rating, comment, tag)
+        if saved:
+            process_moderation_submission(conn, pattern_id)
+    if saved:
         st.toast(f"Оценка '{rating}' принята!", icon="✅")
         load_next_pattern() # Загружаем следующий паттерн сразу после успешной отправки
     else:
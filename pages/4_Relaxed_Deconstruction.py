@@ -1,6 +1,6 @@
 import streamlit as st
 import pandas as pd
-from core.database import get_db_connection, get_relaxed_signature
+from core.database import get_db_connection, release_db_connection, get_relaxed_signature
 
 # --- Helper Function ---
 
@@ -40,7 +40,7 @@ def get_patterns_by_relaxed_sig(relaxed_sig, limit=5):
         st.error(f"Error fetching patterns for signature {relaxed_sig}: {e}")
         return []
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 @st.cache_data(ttl=3600)
 def get_available_parent_lengths():
@@ -55,13 +55,14 @@ def get_available_parent_lengths():
         st.error(f"Error getting available lengths: {e}")
         return []
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 @st.cache_data(ttl=3600)
 def get_relaxed_parent_patterns(selected_length=None):
     """Fetches patterns filtered by length with specific formatting."""
+    if not selected_length: return pd.DataFrame()
     conn = get_db_connection()
-    if conn is None or not selected_length: return pd.DataFrame()
+    if conn is None: return pd.DataFrame()
     try:
         query = "SELECT DISTINCT up.id, up.pattern_text, up.phrase_length, up.total_frequency, up.total_quantity FROM unique_patterns up JOIN pattern_relations_relaxed prr ON up.id = prr.parent_pattern_id WHERE up.phrase_length = %(length)s ORDER BY up.total_frequency DESC;"
         df = pd.read_sql(query, conn, params={'length': selected_length})
@@ -74,7 +75,7 @@ def get_relaxed_parent_patterns(selected_length=None):
         st.error(f"Error getting parent patterns: {e}")
         return pd.DataFrame()
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 @st.cache_data(ttl=3600)
 def get_relaxed_children(parent_id):
@@ -86,7 +87,7 @@ def get_relaxed_children(parent_id):
             cur.execute("SELECT child_1_relaxed_signature, child_2_relaxed_signature, split_position FROM pattern_relations_relaxed WHERE parent_pattern_id = %s", (parent_id,))
             return cur.fetchall()
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 @st.cache_data(ttl=3600)
 def get_pattern_examples(pattern_id):
@@ -112,7 +113,7 @@ def get_pattern_examples(pattern_id):
                     return [{"example_text": row[0], "example_frequency": row[1]} for row in slow_examples]
         return []
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 def generate_graphviz_chart(parent_label, child_relations):
     """Generates a Graphviz DOT string for the deconstruction tree."""
@@ -154,7 +155,7 @@ def display_deconstruction(pattern_id):
             return
         parent_info = parent_info_df.iloc[0]
     finally:
-        conn.close()
+        release_db_connection(conn)
 
     pattern_signature_only = get_relaxed_signature(parent_info['pattern_text'], parent_info['phrase_length'])
     id_and_stats = f"F: {parent_info['total_frequency']:,.2f}; Q: {parent_info['total_quantity']:,}; ID: {pattern_id}".replace(',', ' ')
@@ -1,6 +1,6 @@
 import streamlit as st
 import pandas as pd
-from core.database import get_db_connection, get_pattern_by_id, get_relaxed_signature
+from core.database import get_db_connection, release_db_connection, get_pattern_by_id, get_relaxed_signature
 
 # --- Helper Functions ---
 
@@ -17,7 +17,7 @@ def get_pattern_examples(pattern_id):
             examples = cur.fetchall()
             return [{"example_text": row[0], "example_frequency": row[1]} for row in examples]
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
 @st.cache_data(show_spinner=True, ttl=3600)
 def find_constructions_relaxed(source_pattern_id):
@@ -104,7 +104,7 @@ def find_constructions_relaxed(source_pattern_id):
     except Exception as e:
         st.error(f"An error occurred while finding constructions: {e}")
     finally:
-        if conn: conn.close()
+        release_db_connection(conn)
 
     return before_results, after_results
 
@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from core.database import (
-    get_db_connection,
+    db_connection,
     find_next_merge_candidate_group,
     get_patterns_data_by_ids,
     execute_multiple_merges,
@@ -19,8 +19,6 @@ if 'planned_merges' not in st.session_state:
 if 'selected_length' not in st.session_state:
     st.session_state.selected_length = None
 
-conn = get_db_connection()
-
 # --- Функции-помощники для UI ---
 def add_merge_to_plan():
     source_ids = st.session_state.get('merge_source_select', [])
@@ -55,7 +53,8 @@ def clear_current_group():
 st.title("Слияние паттернов")
 st.warning("**Внимание!** Этот раздел выполняет необратимые изменения в базе данных.")
 
-available_lengths = get_available_lengths_for_merging(conn)
+with db_connection() as conn:
+    available_lengths = get_available_lengths_for_merging(conn)
 st.selectbox(
     "Доступные длины:", 
     options=available_lengths, 
@@ -70,7 +69,8 @@ if st.session_state.selected_length:
 
     if not st.session_state.current_merge_group:
         with st.spinner(f"Идет поиск кандидатов длиной {st.session_state.selected_length}..."):
-            st.session_state.current_merge_group = find_next_merge_candidate_group(conn, st.session_state.selected_length)
+            with db_connection() as conn:
+                st.session_state.current_merge_group = find_next_merge_candidate_group(conn, st.session_state.selected_length)
 
     if not st.session_state.current_merge_group:
         st.success(f"✅ Все доступные кандидаты для длины {st.session_state.selected_length} были обработаны!")
@@ -79,7 +79,8 @@ if st.session_state.selected_length:
         pattern_ids = group['pattern_ids']
         
         with st.spinner("Загрузка данных для паттернов..."):
-            patterns_data = get_patterns_data_by_ids(conn, pattern_ids)
+            with db_connection() as conn:
+                patterns_data = get_patterns_data_by_ids(conn, pattern_ids)
             patterns_map = {p['id']: p for p in patterns_data}
 
         st.markdown("---")
@@ -190,7 +191,8 @@ if st.session_state.selected_length:
         with col1:
             if st.button("✅ Выполнить все запланированные слияния", use_container_width=True, type="primary", disabled=not st.session_state.planned_merges):
                 with st.spinner("Выполняется слияние... Это может занять много времени."):
-                    success, message = execute_multiple_merges(conn, st.session_state.planned_merges)
+                    with db_connection() as conn:
+                        success, message = execute_multiple_merges(conn, st.session_state.planned_merges)
                     if success:
                         st.success(f"Слияние успешно завершено! {message}")
                         clear_current_group()
@@ -205,7 +207,8 @@ if st.session_state.selected_length:
                     diff_level = group_info.get("difference_level", 0)
                     diff_types = group_info.get("difference_types", [])
                     
-                    mark_patterns_as_skipped(conn, pattern_ids, diff_level, diff_types)
+                    with db_connection() as conn:
+                        mark_patterns_as_skipped(conn, pattern_ids, diff_level, diff_types)
 
                 st.success(f"Группа пропущена (уровень: {diff_level}, типы: {diff_types}). Паттерны {pattern_ids} больше не будут появляться в подобных поисках.")
                 clear_current_group()
@@ -2,6 +2,9 @@ import streamlit as st
 import pandas as pd
 from core.database import (
     get_db_connection, 
+    release_db_connection,
+    db_connection,
+    QueryFailedError,
     get_category_tree, 
     get_pattern_by_id,
     get_examples_by_pattern_id, 
@@ -11,8 +14,6 @@ from core.database import (
 
 st.set_page_config(page_title="Категории паттернов", layout="wide")
 
-conn = get_db_connection()
-
 # --- Кэширование данных ---
 
 @st.cache_data(ttl=3600)
@@ -24,19 +25,20 @@ def cached_get_pattern_by_id(pattern_id):
 def cached_get_examples_by_pattern_id(pattern_id):
     """Кэшированная функция для получения примеров фраз."""
     db_conn = get_db_connection()
-    if not db_conn: return []
+    # Исключение вместо пустого списка: st.cache_data не сохраняет результат при ошибке
+    if not db_conn: raise QueryFailedError("нет свободного подключения к БД")
     try:
         examples = get_examples_by_pattern_id(db_conn, pattern_id)
         return [{"text": row[0], "freq": row[1]} for row in examples]
     finally:
-        if db_conn: db_conn.close()
+        release_db_connection(db_conn)
 
 @st.cache_data(ttl=3600)
 def cached_count_patterns_for_category(category_id):
     """Кэшированная функция для подсчета паттернов в категории."""
-    # Используем прямое подключение, т.к. основное 'conn' может быть занято
-    with get_db_connection() as db_conn:
-        return count_patterns_for_category(db_conn, category_id) if db_conn else 0
+    with db_connection() as db_conn:
+        if not db_conn: raise QueryFailedError("нет свободного подключения к БД")
+        return count_patterns_for_category(db_conn, category_id)
 
 # --- Функции для отображения ---
 
@@ -61,7 +63,8 @@ def display_category_tree(categories, level=0):
 
 # --- Инициализация состояния ---
 if 'category_tree' not in st.session_state:
-    st.session_state.category_tree = get_category_tree(conn)
+    with db_connection() as conn:
+        st.session_state.category_tree = get_category_tree(conn)
 if 'selected_category_id' not in st.session_state:
     st.session_state.selected_category_id = None
 if 'selected_category_name' not in st.session_state:
@@ -77,7 +80,8 @@ st.title("Анализ паттернов по категориям")
 st.write("На этой странице вы можете просматривать иерархию категорий, список паттернов в них, а также анализировать конкретные паттерны, вводя их ID.")
 
 if st.button("Обновить дерево категорий"):
-    st.session_state.category_tree = get_category_tree(conn)
+    with db_connection() as conn:
+        st.session_state.category_tree = get_category_tree(conn)
     st.rerun()
 
 col1, col2 = st.columns([1, 2])
@@ -96,8 +100,12 @@ with col2:
         category_name = st.session_state.selected_category_name
         category_id = st.session_state.selected_category_id
         
-        with st.spinner(f"Подсчет паттернов в категории '{category_name}'..."):
-            pattern_count = cached_count_patterns_for_category(category_id)
+        try:
+            with st.spinner(f"Подсчет паттернов в категории '{category_name}'..."):
+                pattern_count = cached_count_patterns_for_category(category_id)
+        except QueryFailedError as e:
+            st.error(f"Не удалось подсчитать паттерны: {e}. Повторите попытку.")
+            pattern_count = 0
         
         st.info(f"Выбрана категория: **{category_name}**. В ней найдено **{pattern_count:,}** паттернов.".replace(',', ' '))
 
@@ -110,7 +118,8 @@ with col2:
                 st.session_state.current_page = total_pages
             
             with st.spinner("Загрузка списка паттернов..."):
-                patterns = get_patterns_for_category(conn, category_id, page=st.session_state.current_page, page_size=PAGE_SIZE)
+                with db_connection() as conn:
+                    patterns = get_patterns_for_category(conn, category_id, page=st.session_state.current_page, page_size=PAGE_SIZE)
 
             if patterns:
                 df = pd.DataFrame(patterns)
@@ -155,8 +164,12 @@ with col2:
                     st.markdown("**Категории не присвоены.**")
                 
                 with st.expander("Показать примеры фраз"):
-                    with st.spinner("Загрузка примеров..."):
-                        examples = cached_get_examples_by_pattern_id(pattern_id)
+                    try:
+                        with st.spinner("Загрузка примеров..."):
+                            examples = cached_get_examples_by_pattern_id(pattern_id)
+                    except QueryFailedError as e:
+                        st.error(f"Не удалось загрузить примеры: {e}")
+                        examples = []
                     
                     if examples:
                         df_examples = pd.DataFrame(examples)
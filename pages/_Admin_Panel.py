@@ -1,10 +1,8 @@
 import streamlit as st
 import pandas as pd
-from core.database import get_db_connection, get_all_moderators, update_user_status, update_user_details, add_user
+from core.database import db_connection, get_all_moderators, update_user_status, update_user_details, add_user, rebuild_ngram_tokens_index, rebuild_ngram_vocabulary, rebuild_ngram_morph_bits, rebuild_ngram_facet_cube, refresh_ngram_facet_cube, rebuild_ngram_sequence_freq, refresh_ngram_sequence_freq, rebuild_pattern_positions, evict_length_subsets, install_ngrams_data_version
 import bcrypt
 
-conn = get_db_connection()
-
 st.set_page_config(page_title="Панель администратора", layout="wide")
 
 if not st.session_state.logged_in or st.session_state.user_role != 'admin':
@@ -16,7 +14,8 @@ st.title("Панель администратора")
 st.subheader("Управление модераторами")
 
 def refresh_moderators():
-    data = get_all_moderators(conn)
+    with db_connection() as conn:
+        data = get_all_moderators(conn)
     st.session_state.moderators = pd.DataFrame(data) if data else pd.DataFrame()
 
 if 'moderators' not in st.session_state:
@@ -56,8 +55,11 @@ if not st.session_state.moderators.empty:
                 if original_row["nickname"] != row["nickname"] or \
                    original_row["role"] != row["role"] or \
                    original_row["status"] != row["status"]:
-                    if update_user_details(conn, row["id"], row["nickname"], role=row["role"]):
-                        if update_user_status(conn, row["id"], row["status"]):
+                    with db_connection() as conn:
+                        updated = update_user_details(conn, row["id"], row["nickname"], role=row["role"])
+                        status_updated = updated and update_user_status(conn, row["id"], row["status"])
+                    if updated:
+                        if status_updated:
                             st.success(f"Пользователь {row["login"]} обновлен.")
                         else:
                             st.error(f"Ошибка при обновлении статуса пользователя {row["login"]}.")
@@ -78,7 +80,9 @@ with st.form("new_user_form"):
     submitted = st.form_submit_button("Создать аккаунт")
     if submitted:
         if new_login and new_nickname and new_password:
-            if add_user(conn, new_login, new_nickname, new_password, new_role, 'active'):
+            with db_connection() as conn:
+                created = add_user(conn, new_login, new_nickname, new_password, new_role, 'active')
+            if created:
                 st.success(f"Аккаунт {new_login} создан. Передайте пароль пользователю.")
                 refresh_moderators()
                 st.rerun()
@@ -86,3 +90,93 @@ with st.form("new_user_form"):
                 st.error("Ошибка при создании аккаунта. Возможно, логин уже занят.")
         else:
             st.warning("Пожалуйста, заполните все поля.")
+
+st.markdown("--- ")
+
+st.subheader("Обслуживание производных таблиц")
+st.caption("Производные таблицы ускоряют фильтрацию фраз. После перестройки они поддерживаются триггерами на ngrams.")
+
+if st.button("Перестроить позиционный индекс токенов"):
+    with st.spinner("Перестройка ngram_tokens..."):
+        with db_connection() as maint_conn:
+            if rebuild_ngram_tokens_index(maint_conn):
+                st.success("Индекс токенов перестроен.")
+            else:
+                st.error("Ошибка при перестройке индекса токенов.")
+
+if st.button("Перестроить словари значений (кодирование ngrams)"):
+    with st.spinner("Заполнение ngram_vocab и колонок кодов..."):
+        with db_connection() as maint_conn:
+            if rebuild_ngram_vocabulary(maint_conn):
+                st.success("Словари и колонки кодов обновлены.")
+            else:
+                st.error("Ошибка при построении словарей.")
+
+if st.button("Построить битовые маски morph"):
+    with st.spinner("Заполнение ngrams.morph_bits..."):
+        with db_connection() as maint_conn:
+            if rebuild_ngram_morph_bits(maint_conn):
+                st.success("Маски morph построены.")
+            else:
+                st.error("Ошибка при построении масок morph (нужны словари значений, признаков не больше 128).")
+
+if st.button("Перестроить позиционную таблицу паттернов"):
+    with st.spinner("Разбор unique_patterns в ngram_pattern_positions..."):
+        with db_connection() as maint_conn:
+            if rebuild_pattern_positions(maint_conn):
+                st.success("Позиционная таблица паттернов перестроена.")
+            else:
+                st.error("Ошибка при построении позиционной таблицы паттернов.")
+
+cube_cols = st.columns(2)
+if cube_cols[0].button("Перестроить куб фасетов"):
+    with st.spinner("Агрегация ngram_facet_cube..."):
+        with db_connection() as maint_conn:
+            if rebuild_ngram_facet_cube(maint_conn):
+                st.success("Куб фасетов перестроен.")
+            else:
+                st.error("Ошибка при построении куба фасетов.")
+
+if cube_cols[1].button("Обновить измененные длины в кубе"):
+    with st.spinner("Пересчет измененных длин..."):
+        with db_connection() as maint_conn:
+            refreshed = refresh_ngram_facet_cube(maint_conn)
+            if refreshed is None:
+                st.error("Ошибка при обновлении куба фасетов.")
+            else:
+                st.success(f"Пересчитано длин: {refreshed}.")
+
+sequence_cols = st.columns(2)
+if sequence_cols[0].button("Перестроить частоты последовательностей"):
+    with st.spinner("Агрегация ngram_sequence_freq..."):
+        with db_connection() as maint_conn:
+            if rebuild_ngram_sequence_freq(maint_conn):
+                st.success("Частоты последовательностей перестроены.")
+            else:
+                st.error("Ошибка при построении частот последовательностей.")
+
+if sequence_cols[1].button("Обновить измененные длины в частотах последовательностей"):
+    with st.spinner("Пересчет измененных длин..."):
+        with db_connection() as maint_conn:
+            refreshed = refresh_ngram_sequence_freq(maint_conn)
+            if refreshed is None:
+                st.error("Ошибка при обновлении частот последовательностей.")
+            else:
+                st.success(f"Пересчитано длин: {refreshed}.")
+
+if st.button("Включить учет версии данных ngrams"):
+    with st.spinner("Создание триггеров версии данных..."):
+        with db_connection() as maint_conn:
+            if install_ngrams_data_version(maint_conn):
+                st.success("Версия данных обновляется триггерами: кэш результатов сбрасывается при каждом изменении ngrams.")
+            else:
+                st.error("Ошибка при создании триггеров версии данных.")
+
+if st.button("Удалить неиспользуемые подмножества длин"):
+    with st.spinner("Удаление подмножеств без активных сессий..."):
+        with db_connection() as maint_conn:
+            evicted = evict_length_subsets(maint_conn)
+            if evicted is None:
+                st.error("Ошибка при удалении подмножеств.")
+            else:
+                st.success(f"Удалено подмножеств: {len(evicted)}.")
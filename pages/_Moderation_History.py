@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from core.database import (
-    get_db_connection,
+    db_connection,
     get_user_by_login,
     get_moderation_history,
     update_moderation_entry,
@@ -20,18 +20,14 @@ if 'logged_in' not in st.session_state or not st.session_state.logged_in or 'use
 st.title("История моих модераций")
 
 # --- Database Connection ---
-@st.cache_resource
-def init_connection():
-    return get_db_connection()
-
-conn = init_connection()
-
-if not conn:
-    st.error("Не удалось подключиться к базе данных. Проверьте настройки в .env файле и доступность сервера.")
-    st.stop()
-
-# --- Get User ID ---
-current_user = get_user_by_login(conn, st.session_state.user_login)
+# Подключение берется из пула на время каждой операции; здесь только проверяем, что база доступна
+with db_connection() as conn:
+    if not conn:
+        st.error("Не удалось подключиться к базе данных. Проверьте настройки в .env файле и доступность сервера.")
+        st.stop()
+
+    # --- Get User ID ---
+    current_user = get_user_by_login(conn, st.session_state.user_login)
 if not current_user:
     st.error("Не удалось получить данные пользователя. Пожалуйста, попробуйте войти снова.")
     st.stop()
@@ -39,7 +35,8 @@ user_id = current_user['id']
 
 # --- Helper for refreshing history ---
 def refresh_moderation_history():
-    st.session_state.moderation_history = get_moderation_history(conn, user_id)
+    with db_connection() as conn:
+        st.session_state.moderation_history = get_moderation_history(conn, user_id)
 
 # Initialize or refresh history
 if 'moderation_history' not in st.session_state:
@@ -59,7 +56,9 @@ def set_editing_entry(entry_id):
 
 
 def save_edited_entry(entry_id, new_rating, new_comment, new_tag):
-    if update_moderation_entry(conn, entry_id, new_rating, new_comment, new_tag):
+    with db_connection() as conn:
+        updated = update_moderation_entry(conn, entry_id, new_rating, new_comment, new_tag)
+    if updated:
         st.toast("Запись успешно обновлена!", icon="✅")
         st.session_state.editing_entry_id = None # Exit edit mode
         refresh_moderation_history() # Refresh data
@@ -71,12 +70,13 @@ def cancel_edit():
 
 def delete_entry(entry_id):
     """Callback to delete a moderation record."""
-    success, pattern_id = delete_moderation_record(conn, entry_id)
-    if success:
-        st.toast(f"Запись {entry_id} удалена.", icon="🗑️")
-        if pattern_id:
+    with db_connection() as conn:
+        success, pattern_id = delete_moderation_record(conn, entry_id)
+        if success and pattern_id:
             # Recalculate stats for the affected pattern
             process_moderation_submission(conn, pattern_id)
+    if success:
+        st.toast(f"Запись {entry_id} удалена.", icon="🗑️")
         refresh_moderation_history()
         # Ensure we exit edit mode if the deleted entry was being edited
         if st.session_state.editing_entry_id == entry_id:
@@ -134,7 +134,8 @@ else:
 
                 if st.session_state.show_phrases_for_pattern.get(entry_id, False):
                     st.subheader("Фразы, соответствующие паттерну")
-                    phrases_data = get_examples_by_pattern_id(conn, entry['pattern_id'])
+                    with db_connection() as conn:
+                        phrases_data = get_examples_by_pattern_id(conn, entry['pattern_id'])
                     if phrases_data:
                         df_phrases = pd.DataFrame(phrases_data, columns=["Фраза", "Частотность (млн)"])
                         # Меняем порядок столбцов и отключаем растягивание по ширине
@@ -1,11 +1,18 @@
 import streamlit as st
 import json
+import os
 import uuid
+import time
 import pandas as pd
+import psycopg2
+from concurrent.futures import Future
+from contextlib import contextmanager
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from core.database import (
-    get_db_connection,
+    db_connection,
+    QueryFailedError,
     get_all_unique_lengths,
-    get_unique_values_for_rule,
+    get_unique_values_for_rules,
     save_filter_set,
     load_filter_set_names,
     load_filter_set_by_name,
@@ -14,13 +21,31 @@ from core.database import (
     load_block_names,
     load_block_by_name,
     delete_block_by_name,
-    build_where_clauses,
-    execute_query,
+    build_results_where,
+    get_results_page,
+    get_selection_totals,
+    get_word_analysis,
+    get_storage_features,
+    get_ngrams_data_version,
+    RESULTS_PAGE_SIZE,
     get_frequent_sequences,
     get_suggestion_data,
     get_pattern_by_id, # This import will now work
-    create_temp_table_for_session
+    create_temp_table_for_session,
+    drop_temp_table,
+    predicate_index_keys,
+    acquire_length_subset,
+    touch_length_subset,
+    release_length_subset,
+    evict_length_subsets
 )
+from core.ngram_engine import NgramMatrixEngine, NgramBitmapEngine
+from core.executor import QueryExecutor, iter_completed
+from core.sessions import SessionConnections
+from core.index_planner import IndexPlanner
+from core.result_cache import cached_result
+from core.export import export_results, parquet_available, EXPORT_FORMATS
+from core.filters import canonicalize_blocks, canonical_rule_requests, filters_fingerprint
 
 # --- Управление состоянием ---
 st.set_page_config(layout="wide", page_title="Phrase Filtration")
@@ -33,24 +58,44 @@ if 'logged_in' not in st.session_state or not st.session_state.logged_in:
 if 'filter_blocks' not in st.session_state: st.session_state.filter_blocks = []
 if 'selected_lengths' not in st.session_state: st.session_state.selected_lengths = []
 if 'last_query' not in st.session_state: st.session_state.last_query = ""
+if 'last_query_params' not in st.session_state: st.session_state.last_query_params = []
 if 'results' not in st.session_state: st.session_state.results = []
+if 'results_filter' not in st.session_state: st.session_state.results_filter = None
+if 'results_page_starts' not in st.session_state: st.session_state.results_page_starts = [None]
+if 'results_totals' not in st.session_state: st.session_state.results_totals = (0, 0)
 
 if 'current_filters_hash' not in st.session_state: st.session_state.current_filters_hash = None
 if 'show_word_analysis' not in st.session_state: st.session_state.show_word_analysis = False
+if 'last_export' not in st.session_state: st.session_state.last_export = None
 if 'min_frequency' not in st.session_state: st.session_state.min_frequency = 0.0
 if 'min_quantity' not in st.session_state: st.session_state.min_quantity = 0
 if 'temp_table_name' not in st.session_state: st.session_state.temp_table_name = None
-
-# --- Подключение к БД и кэширование ---
-@st.cache_resource
-def init_connection():
-    return get_db_connection()
-
-conn = init_connection()
-
-if not conn:
-    st.error("Не удалось подключиться к базе данных. Проверьте настройки в .env файле и доступность сервера.")
-    st.stop()
+if 'subset_table_name' not in st.session_state: st.session_state.subset_table_name = None
+if 'subset_touched_at' not in st.session_state: st.session_state.subset_touched_at = 0.0
+if 'filter_engine' not in st.session_state: st.session_state.filter_engine = "postgres"
+if 'approximate_suggestions' not in st.session_state: st.session_state.approximate_suggestions = False
+if 'exact_suggestions' not in st.session_state: st.session_state.exact_suggestions = {}
+if 'exact_suggestions_jobs' not in st.session_state: st.session_state.exact_suggestions_jobs = {}
+if 'exact_suggestions_failed' not in st.session_state: st.session_state.exact_suggestions_failed = set()
+
+# --- Подключение к БД ---
+# Страница не держит своего подключения: каждая операция берет подключение из общего пула и сразу
+# возвращает его, так что транзакции разных пользователей не смешиваются. За сессией закрепляется
+# только подключение с ее временной таблицей (core.sessions).
+@contextmanager
+def query_connection(task_conn=None, required=False):
+    """
+    Отдает подключение фоновой задачи или сессии, а без него берет подключение из пула на время операции.
+    required=True — без подключения поднимается QueryFailedError: так кэшируемые функции не сохраняют
+    пустой результат, полученный из-за исчерпанного пула.
+    """
+    if task_conn is not None:
+        yield task_conn
+        return
+    with db_connection() as pooled_conn:
+        if pooled_conn is None and required:
+            raise QueryFailedError("нет свободного подключения к БД")
+        yield pooled_conn
 
 # --- Хелперы для кэширования ---
 def make_hashable(obj):
@@ -73,64 +118,282 @@ def format_number_with_spaces(number):
     else:
         return f"{number:,.2f}".replace(",", " ")
 
+# --- Движок фильтрации ---
+ENGINE_OPTIONS = {"postgres": "PostgreSQL", "numpy": "NumPy (в памяти)", "bitmap": "Битовые индексы (в памяти)"}
+IN_MEMORY_ENGINES = {"numpy": NgramMatrixEngine, "bitmap": NgramBitmapEngine}
+
+@st.cache_resource(max_entries=4, show_spinner="Загрузка n-грамм в память...")
+def get_matrix_engine(selected_lengths_tuple, engine="numpy"):
+    # Движок только читает загруженные массивы, поэтому один экземпляр на набор длин разделяется всеми сессиями.
+    # Без подключения или при ошибке загрузки поднимается исключение: cache_resource не сохранит пустой движок
+    with query_connection(required=True) as engine_conn:
+        return IN_MEMORY_ENGINES[engine].load(engine_conn, selected_lengths_tuple)
+
+@st.cache_resource
+def get_query_executor():
+    # Один пул потоков на процесс: секции всех сессий делят подключения общего пула БД
+    return QueryExecutor()
+
+@st.cache_resource
+def get_index_planner():
+    # Общий для процесса учет условий к таблицам-подмножествам и фоновое построение индексов
+    return IndexPlanner(get_query_executor())
+
+@st.cache_resource
+def get_session_connections():
+    # Подключения из пула, закрепленные за сессиями с временными таблицами
+    return SessionConnections()
+
 # --- Кэшируемые функции ---
+def _completed(value):
+    """
+    Пропускает результат функции БД в кэш. None — запрос не выполнен (ошибка, отмена, statement_timeout):
+    исключение не дает st.cache_data сохранить сбой, и следующий rerun повторит запрос.
+    """
+    if value is None:
+        raise QueryFailedError("запрос прерван или завершился ошибкой")
+    return value
+
+# Фильтры передаются в каноническом виде (core.filters.canonicalize_blocks), поэтому ключ кэша
+# зависит только от содержимого фильтров: возврат к прежнему состоянию попадает в кэш, и
+# сбрасывать его при каждом изменении не нужно. Объем ограничен max_entries.
+# Функции секций страницы вызываются и из фоновых потоков: _conn передает подключение задачи
+# (не участвует в ключе кэша), а спиннер отключен, так как поток не владеет разметкой страницы.
+# Запросы к PostgreSQL дополнительно проходят через постоянный кэш (core.result_cache), общий
+# для процессов и перезапусков; его ключ включает версию данных ngrams. Имя таблицы в ключ не входит:
+# подмножество длин и временная таблица сессии содержат те же строки выбранных длин, что и ngrams.
 @st.cache_data(ttl=3600)
 def cached_get_all_unique_lengths():
-    return get_all_unique_lengths(conn)
+    with query_connection(required=True) as conn:
+        return get_all_unique_lengths(conn)
 
-@st.cache_data(ttl=3600)
-def cached_get_unique_values_for_rule(position, rule_type, selected_lengths_tuple, blocks_tuple, block_id_to_exclude, rule_id_to_exclude, min_frequency, min_quantity, table_name="ngrams"):
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def cached_get_unique_values_for_rules(rule_requests_tuple, selected_lengths_tuple, blocks_tuple, min_frequency, min_quantity, table_name="ngrams", engine="postgres", _conn=None):
     all_blocks = make_mutable(blocks_tuple)
     selected_lengths = list(selected_lengths_tuple)
-    return get_unique_values_for_rule(conn, position, rule_type, selected_lengths, all_blocks, block_id_to_exclude, rule_id_to_exclude, min_frequency, min_quantity, table_name)
+    if engine in IN_MEMORY_ENGINES and selected_lengths:
+        return get_matrix_engine(selected_lengths_tuple, engine).get_unique_values_for_rules(rule_requests_tuple, all_blocks, min_frequency, min_quantity)
+    with query_connection(_conn, required=True) as query_conn:
+        return _completed(cached_result(
+            "rule_facets", get_ngrams_data_version(query_conn),
+            (rule_requests_tuple, selected_lengths, all_blocks, min_frequency, min_quantity),
+            lambda: get_unique_values_for_rules(query_conn, rule_requests_tuple, selected_lengths, all_blocks, min_frequency, min_quantity, table_name)
+        ))
 
 @st.cache_data(ttl=3600)
 def cached_load_filter_set_names():
-    return load_filter_set_names(conn)
+    with query_connection(required=True) as conn:
+        return load_filter_set_names(conn)
 
 @st.cache_data(ttl=3600)
 def cached_load_block_names():
-    return load_block_names(conn)
+    with query_connection(required=True) as conn:
+        return load_block_names(conn)
 
-@st.cache_data(ttl=3600)
-def cached_get_frequent_sequences(sequence_type, phrase_length, filter_blocks_tuple, selected_lengths_tuple, table_name="ngrams"):
+@st.cache_data(ttl=3600, max_entries=128)
+def cached_get_frequent_sequences(sequence_type, phrase_length, filter_blocks_tuple, selected_lengths_tuple, table_name="ngrams", engine="postgres", _conn=None):
     mutable_filter_blocks = make_mutable(filter_blocks_tuple)
     mutable_selected_lengths = list(selected_lengths_tuple)
-    return get_frequent_sequences(conn, sequence_type, phrase_length, mutable_filter_blocks, mutable_selected_lengths, table_name=table_name)
-
-@st.cache_data(ttl=3600)
-def cached_get_suggestion_data(selected_lengths_tuple, filter_blocks_tuple, min_frequency, min_quantity, table_name="ngrams"):
+    if engine in IN_MEMORY_ENGINES and mutable_selected_lengths:
+        return get_matrix_engine(selected_lengths_tuple, engine).get_frequent_sequences(sequence_type, phrase_length, mutable_filter_blocks)
+    with query_connection(_conn, required=True) as query_conn:
+        return _completed(cached_result(
+            "frequent_sequences", get_ngrams_data_version(query_conn),
+            (sequence_type, phrase_length, mutable_filter_blocks, mutable_selected_lengths),
+            lambda: get_frequent_sequences(query_conn, sequence_type, phrase_length, mutable_filter_blocks, mutable_selected_lengths, table_name=table_name)
+        ))
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def cached_get_suggestion_data(selected_lengths_tuple, filter_blocks_tuple, min_frequency, min_quantity, table_name="ngrams", engine="postgres", sample_percent=None, _conn=None):
+    selected_lengths = list(selected_lengths_tuple)
+    filter_blocks = make_mutable(filter_blocks_tuple)
+    if engine in IN_MEMORY_ENGINES and selected_lengths:
+        return get_matrix_engine(selected_lengths_tuple, engine).get_suggestion_data(filter_blocks, min_frequency, min_quantity)
+    with query_connection(_conn, required=True) as query_conn:
+        return _completed(cached_result(
+            "suggestions", get_ngrams_data_version(query_conn),
+            (selected_lengths, filter_blocks, min_frequency, min_quantity, sample_percent),
+            lambda: get_suggestion_data(query_conn, selected_lengths, filter_blocks, min_frequency, min_quantity, table_name, sample_percent=sample_percent)
+        ))
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def cached_get_selection_totals(selected_lengths_tuple, filter_blocks_tuple, min_frequency, table_name="ngrams", engine="postgres", _conn=None):
     selected_lengths = list(selected_lengths_tuple)
     filter_blocks = make_mutable(filter_blocks_tuple)
-    return get_suggestion_data(conn, selected_lengths, filter_blocks, min_frequency, min_quantity, table_name)
+    if engine in IN_MEMORY_ENGINES and selected_lengths:
+        engine_instance = get_matrix_engine(selected_lengths_tuple, engine)
+        return engine_instance.get_totals(engine_instance.filter_mask(filter_blocks, min_frequency))
+    with query_connection(_conn, required=True) as query_conn:
+        return _completed(cached_result(
+            "results_totals", get_ngrams_data_version(query_conn),
+            (selected_lengths, filter_blocks, min_frequency),
+            lambda: get_selection_totals(query_conn, filter_blocks, selected_lengths, min_frequency, table_name=table_name)
+        ))
+
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def cached_get_word_analysis(results_filter_tuple, _conn=None):
+    results_filter = make_mutable(results_filter_tuple)
+    if results_filter.get('engine') in IN_MEMORY_ENGINES:
+        engine = get_matrix_engine(tuple(results_filter['lengths']), results_filter['engine'])
+        return engine.get_word_analysis(engine.filter_mask(results_filter['blocks'], results_filter['min_frequency']))
+    with query_connection(_conn, required=True) as query_conn:
+        return _completed(cached_result(
+            "word_analysis", get_ngrams_data_version(query_conn),
+            (results_filter['where_clauses'], results_filter['params']),
+            lambda: get_word_analysis(query_conn, results_filter['where_clauses'], results_filter['params'], table_name=results_filter['table_name'])
+        ))
+
+# --- Приблизительные подсказки с уточнением в фоне ---
+SUGGESTIONS_SAMPLE_PERCENT = 5
+SUGGESTIONS_POLL_INTERVAL = 1.0
+
+def _start_exact_suggestions(request_key, selected_lengths, filter_blocks, query_tag, table_name="ngrams"):
+    jobs = st.session_state.exact_suggestions_jobs
+    for key in [k for k in jobs if k != request_key]:
+        jobs.pop(key).cancel()
+    st.session_state.exact_suggestions_failed &= {request_key}
+    if request_key not in jobs and request_key not in st.session_state.exact_suggestions_failed:
+        # Точный запрос идет на своем подключении из пула к ngrams с фильтром по длинам. Он заведомо
+        # долгий и ждать его не нужно, поэтому интерактивный statement_timeout к нему не применяется;
+        # отмена при смене фильтров по-прежнему работает через тег
+        jobs[request_key] = get_query_executor().submit_query(
+            get_suggestion_data, list(selected_lengths), filter_blocks,
+            st.session_state.min_frequency, st.session_state.min_quantity, table_name,
+            query_tag=query_tag, statement_timeout_ms=0
+        )
+
+def _poll_exact_suggestions(request_key):
+    """Фрагмент, который ждет точных подсказок и перерисовывает страницу, когда они готовы."""
+    future = st.session_state.exact_suggestions_jobs.get(request_key)
+    if future is None:
+        if request_key in st.session_state.exact_suggestions_failed:
+            st.caption(f"⚠️ Точные значения посчитать не удалось: показаны оценки по выборке ~{SUGGESTIONS_SAMPLE_PERCENT}% строк.")
+        return
+    if not future.done():
+        st.caption(f"⏳ Оценки по выборке ~{SUGGESTIONS_SAMPLE_PERCENT}% строк, точные значения считаются...")
+        return
+    st.session_state.exact_suggestions_jobs.pop(request_key, None)
+    if future.cancelled():
+        return
+    exact_data = future.result() if future.exception() is None else None
+    if exact_data is None:
+        # Сбой уточнения не подменяет оценки пустым ответом: они остаются на экране с пометкой
+        st.session_state.exact_suggestions_failed.add(request_key)
+        st.caption(f"⚠️ Точные значения посчитать не удалось: показаны оценки по выборке ~{SUGGESTIONS_SAMPLE_PERCENT}% строк.")
+        return
+    st.session_state.exact_suggestions = {request_key: exact_data}
+    st.rerun()
 
 @st.cache_data(ttl=3600)
 def cached_get_pattern_by_id(pattern_id):
     return get_pattern_by_id(pattern_id)
 
 # --- Функции-коллбэки и хендлеры ---
-def clear_caches():
-    cached_get_unique_values_for_rule.clear()
-    cached_get_suggestion_data.clear()
-    cached_get_frequent_sequences.clear()
-
 def handle_length_change():
     st.session_state.selected_lengths = st.session_state.selected_lengths_widget
     max_len = max(st.session_state.selected_lengths) if st.session_state.selected_lengths else 0
     st.session_state.filter_blocks = [b for b in st.session_state.filter_blocks if b['position'] < max_len]
     
-    # Clear caches and temp table when lengths change
-    clear_caches()
+    # Cached values are keyed by lengths, so only the session's tables have to be reset
+    _release_session_tables()
+    _prepare_engine_storage()
+
+def _session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "default"
+
+def _release_session_tables():
+    """Освобождает таблицы прежнего набора длин: ссылку на подмножество и временную таблицу с подключением сессии."""
+    if st.session_state.subset_table_name:
+        with db_connection() as conn:
+            release_length_subset(conn, st.session_state.subset_table_name, _session_id())
+    if st.session_state.temp_table_name:
+        with get_session_connections().use(_session_id()) as session_conn:
+            drop_temp_table(session_conn, st.session_state.temp_table_name)
+        get_session_connections().release(_session_id())
+    st.session_state.subset_table_name = None
     st.session_state.temp_table_name = None # Reset temp table
 
-    if st.session_state.selected_lengths:
-        with st.spinner("Создание временной таблицы для ускорения..."):
-            table_name = create_temp_table_for_session(conn, st.session_state.selected_lengths)
-            if table_name:
-                st.session_state.temp_table_name = table_name
-                st.toast("Временная таблица создана!", icon="✅")
-            else:
-                st.error("Не удалось создать временную таблицу.")
+@contextmanager
+def session_connection():
+    """
+    Подключение для запросов к таблицам сессии: временная таблица видна только закрепленному за сессией подключению.
+    Пока блок выполняется, подключение заблокировано для фоновой задачи сессии (SessionConnections.use).
+    None — временной таблицы нет, запрос берет подключение из пула (query_connection).
+    """
+    if not st.session_state.temp_table_name:
+        yield None
+        return
+    with get_session_connections().use(_session_id()) as session_conn:
+        yield session_conn
+
+def _prepare_engine_storage():
+    """
+    Готовит хранилище выбранного движка: для PostgreSQL — общую таблицу-подмножество выбранных длин
+    (при ее недоступности — временную таблицу сессии), для движков в памяти — загруженные массивы.
+    """
+    if not st.session_state.selected_lengths:
+        return
+    if st.session_state.filter_engine in IN_MEMORY_ENGINES:
+        try:
+            get_matrix_engine(tuple(st.session_state.selected_lengths), st.session_state.filter_engine)
+        except (QueryFailedError, psycopg2.Error) as e:
+            print(f"Ошибка при загрузке движка в память: {e}")
+        return
+    if st.session_state.subset_table_name or st.session_state.temp_table_name:
+        return
+    with st.spinner("Подготовка подмножества n-грамм выбранных длин..."):
+        with db_connection() as conn:
+            evict_length_subsets(conn)
+            table_name = acquire_length_subset(conn, st.session_state.selected_lengths, _session_id())
+        if table_name:
+            st.session_state.subset_table_name = table_name
+            st.session_state.subset_touched_at = time.monotonic()
+            return
+    with st.spinner("Создание временной таблицы для ускорения..."):
+        # Временная таблица создается на закрепленном за сессией подключении из пула, а не на общем
+        with get_session_connections().use(_session_id(), pin=True) as session_conn:
+            table_name = create_temp_table_for_session(session_conn, st.session_state.selected_lengths)
+        if table_name:
+            st.session_state.temp_table_name = table_name
+            st.toast("Временная таблица создана!", icon="✅")
+        else:
+            get_session_connections().release(_session_id())
+            st.warning("Не удалось создать временную таблицу (или она превышает предел сессии); запросы пойдут к ngrams.")
+
+# Как часто активная сессия продлевает ссылку на свое подмножество (сек)
+SUBSET_TOUCH_INTERVAL = 60
+
+def _keep_session_tables_alive():
+    """
+    Следит за таблицами сессии: освобождает подключения закрытых сессий, продлевает ссылку
+    на подмножество и готовит таблицы заново, если подмножество или подключение с временной таблицей освобождены.
+    """
+    get_session_connections().reap()
+    if st.session_state.temp_table_name and get_session_connections().get(_session_id()) is None:
+        st.session_state.temp_table_name = None
+        _prepare_engine_storage()
+    if not st.session_state.subset_table_name or time.monotonic() - st.session_state.subset_touched_at < SUBSET_TOUCH_INTERVAL:
+        return
+    with db_connection() as conn:
+        touched = touch_length_subset(conn, st.session_state.subset_table_name, _session_id())
+    if touched:
+        st.session_state.subset_touched_at = time.monotonic()
+        return
+    st.session_state.subset_table_name = None
+    _prepare_engine_storage()
+
+def _shared_table_name():
+    """Таблица для запросов на подключениях из пула: общее подмножество видно всем подключениям, временная таблица — нет."""
+    return st.session_state.subset_table_name or "ngrams"
+
+def _session_table_name():
+    """Таблица для запросов на подключении страницы."""
+    return st.session_state.subset_table_name or st.session_state.temp_table_name or "ngrams"
+
+def handle_engine_change():
+    st.session_state.filter_engine = st.session_state.filter_engine_widget
+    _prepare_engine_storage()
 
 def add_block():
     new_block_id = str(uuid.uuid4())
@@ -139,7 +402,6 @@ def add_block():
 
 def remove_block(block_id):
     st.session_state.filter_blocks = [b for b in st.session_state.filter_blocks if b['id'] != block_id]
-    clear_caches()
 
 def add_rule(block_id):
     for block in st.session_state.filter_blocks:
@@ -152,7 +414,6 @@ def remove_rule(block_id, rule_id):
         if block['id'] == block_id:
             block['rules'] = [r for r in block['rules'] if r['id'] != rule_id]
             break
-    clear_caches()
 
 def handle_position_change(block_id):
     new_pos = st.session_state[f"pos_block_{block_id}"] - 1
@@ -161,7 +422,6 @@ def handle_position_change(block_id):
             block['position'] = new_pos
             for rule in block['rules']:
                 rule['values'] = []
-            clear_caches()
             break
 
 def handle_type_change(block_id, rule_id):
@@ -173,7 +433,6 @@ def handle_type_change(block_id, rule_id):
                     rule['type'] = new_type
                     rule['values'] = []
                     rule['operator'] = rule.get('operator', 'include') 
-                    clear_caches()
                     break
             break
 
@@ -185,7 +444,6 @@ def handle_values_change(block_id, rule_id, disp_opts):
             for rule in block['rules']:
                 if rule['id'] == rule_id:
                     rule['values'] = new_values
-                    clear_caches()
                     break
             break
 
@@ -196,7 +454,6 @@ def handle_operator_change(block_id, rule_id):
             for rule in block['rules']:
                 if rule['id'] == rule_id and rule.get('operator', 'include') != new_operator:
                     rule['operator'] = new_operator
-                    clear_caches()
                     break
             break
 
@@ -205,7 +462,6 @@ def replace_block(block_id, new_block_data):
         if block['id'] == block_id:
             new_block_data['id'] = block_id
             st.session_state.filter_blocks[i] = new_block_data
-            clear_caches()
             break
 
 def toggle_filter_from_suggestion(position, rule_type, value):
@@ -235,7 +491,6 @@ def toggle_filter_from_suggestion(position, rule_type, value):
     
     st.session_state.filter_blocks = [b for b in ({'id': b['id'], 'position': b['position'], 'rules': [r for r in b['rules'] if r['values']]} for b in st.session_state.filter_blocks) if b['rules']]
     st.session_state.filter_blocks.sort(key=lambda b: b['position'])
-    clear_caches()
 
 # --- Диалоговые окна ---
 @st.dialog("Управление блоком")
@@ -248,7 +503,9 @@ def manage_block_dialog(block_id):
     if st.button("Сохранить блок"):
         if name_to_save:
             clean_block = {k: v for k, v in block_to_manage.items() if k != 'id'}
-            if save_block(conn, name_to_save, clean_block):
+            with db_connection() as conn:
+                saved = save_block(conn, name_to_save, clean_block)
+            if saved:
                 st.toast("Шаблон блока сохранен!", icon="✅")
                 cached_load_block_names.clear()
             else:
@@ -258,13 +515,18 @@ def manage_block_dialog(block_id):
     
     st.markdown("---")
     st.subheader("Загрузить шаблон в текущий блок")
-    saved_block_names = cached_load_block_names()
+    try:
+        saved_block_names = cached_load_block_names()
+    except QueryFailedError as e:
+        st.error(f"Не удалось загрузить шаблоны блоков: {e}")
+        saved_block_names = []
     selected_block_name = st.selectbox("Выберите шаблон", ["-- Выберите --"] + saved_block_names)
     
     load_b_col, del_b_col = st.columns(2)
     if load_b_col.button("Загрузить шаблон"):
         if selected_block_name != "-- Выберите --":
-            loaded_block = load_block_by_name(conn, selected_block_name)
+            with db_connection() as conn:
+                loaded_block = load_block_by_name(conn, selected_block_name)
             if loaded_block:
                 replace_block(block_id, loaded_block)
                 st.rerun()
@@ -273,7 +535,9 @@ def manage_block_dialog(block_id):
 
     if del_b_col.button("Удалить шаблон"):
             if selected_block_name != "-- Выберите --":
-                if delete_block_by_name(conn, selected_block_name):
+                with db_connection() as conn:
+                    deleted = delete_block_by_name(conn, selected_block_name)
+                if deleted:
                     cached_load_block_names.clear()
                     st.rerun()
                 else:
@@ -299,11 +563,16 @@ def fill_sequence_dialog(sequence_type):
     phrase_length = st.session_state.selected_lengths[0]
     st.write(f"Выберите частую последовательность {sequence_type} для длины {phrase_length}:")
 
-    blocks_tuple = make_hashable(st.session_state.filter_blocks)
+    blocks_tuple = make_hashable(canonicalize_blocks(st.session_state.filter_blocks)[0])
     selected_lengths_tuple = tuple(st.session_state.selected_lengths)
 
-    table_to_use = st.session_state.get("temp_table_name") or "ngrams"
-    sequences_data = cached_get_frequent_sequences(sequence_type, phrase_length, blocks_tuple, selected_lengths_tuple, table_name=table_to_use)
+    table_to_use = _session_table_name()
+    try:
+        with session_connection() as session_conn:
+            sequences_data = cached_get_frequent_sequences(sequence_type, phrase_length, blocks_tuple, selected_lengths_tuple, table_name=table_to_use, engine=st.session_state.filter_engine, _conn=session_conn)
+    except QueryFailedError as e:
+        st.error(f"Не удалось загрузить последовательности: {e}")
+        sequences_data = []
     
     options = []
     for seq in sequences_data:
@@ -346,7 +615,6 @@ def fill_sequence_dialog(sequence_type):
                     })
             
             st.session_state.filter_blocks.sort(key=lambda b: b['position'])
-            clear_caches()
             st.toast("Блоки фильтров заполнены!", icon="✅")
             st.rerun()
     
@@ -374,6 +642,8 @@ def load_pattern_by_id_dialog():
 
                 st.session_state.filter_blocks = []
                 st.session_state.selected_lengths = [phrase_length]
+                _release_session_tables()
+                _prepare_engine_storage()
 
                 for i in range(phrase_length):
                     st.session_state.filter_blocks.append({
@@ -386,7 +656,6 @@ def load_pattern_by_id_dialog():
                         ]
                     })
                 
-                clear_caches()
                 st.toast("Паттерн успешно загружен!", icon="✅")
                 st.rerun()
             else:
@@ -397,6 +666,9 @@ def load_pattern_by_id_dialog():
 @st.dialog("Сгенерированный SQL-запрос")
 def show_sql_dialog():
     st.code(st.session_state.last_query, language='sql')
+    if st.session_state.last_query_params:
+        st.caption("Параметры запроса (по порядку плейсхолдеров %s):")
+        st.json(st.session_state.last_query_params, expanded=False)
     if st.button("Закрыть"):
         st.rerun()
 
@@ -405,7 +677,9 @@ def save_set_dialog():
     name_to_save = st.text_input("Имя набора")
     if st.button("Сохранить"):
         if name_to_save:
-            if save_filter_set(conn, name_to_save, {"lengths": st.session_state.selected_lengths, "blocks": st.session_state.filter_blocks}):
+            with db_connection() as conn:
+                saved = save_filter_set(conn, name_to_save, {"lengths": st.session_state.selected_lengths, "blocks": st.session_state.filter_blocks})
+            if saved:
                 st.toast("Набор сохранен!", icon="✅")
                 cached_load_filter_set_names.clear()
                 st.rerun()
@@ -418,22 +692,30 @@ def save_set_dialog():
 
 @st.dialog("Загрузить набор фильтров")
 def load_set_dialog():
-    saved_names = sorted(cached_load_filter_set_names(), key=str.lower)
+    try:
+        saved_names = sorted(cached_load_filter_set_names(), key=str.lower)
+    except QueryFailedError as e:
+        st.error(f"Не удалось загрузить наборы фильтров: {e}")
+        saved_names = []
     selected_name = st.selectbox("Выберите набор", ["-- Выберите --"] + saved_names)
     load_btn_col, del_btn_col = st.columns(2)
     if load_btn_col.button("Загрузить"):
         if selected_name != "-- Выберите --":
-            loaded = load_filter_set_by_name(conn, selected_name)
+            with db_connection() as conn:
+                loaded = load_filter_set_by_name(conn, selected_name)
             if loaded:
                 st.session_state.selected_lengths = loaded.get("lengths", [])
+                _release_session_tables()
+                _prepare_engine_storage()
                 st.session_state.filter_blocks = loaded.get("blocks", [])
-                clear_caches()
                 st.rerun()
             else:
                 st.error("Ошибка загрузки набора.")
     if del_btn_col.button("Удалить"):
         if selected_name != "-- Выберите --":
-            if delete_filter_set_by_name(conn, selected_name):
+            with db_connection() as conn:
+                deleted = delete_filter_set_by_name(conn, selected_name)
+            if deleted:
                 cached_load_filter_set_names.clear()
                 st.rerun()
             else:
@@ -441,47 +723,63 @@ def load_set_dialog():
     if st.button("Отмена"):
         st.rerun()
 
-# --- Основной интерфейс ---
-st.title("Phrase Filtration")
-main_col1, main_col2 = st.columns([2, 1.5])
-
-with main_col1:
-    st.subheader("Параметры фильтрации")
-
-    # Row 1: Min Freq, Min Qty, Length
-    row1_cols = st.columns([1, 1, 2])
-    with row1_cols[0]:
-        st.number_input("Мин. частотность (млн)", min_value=0.0, value=st.session_state.min_frequency, step=0.001, key="min_frequency_widget", on_change=lambda: setattr(st.session_state, 'min_frequency', st.session_state.min_frequency_widget))
-    with row1_cols[1]:
-        st.number_input("Мин. количество фраз", min_value=0, value=st.session_state.min_quantity, step=1, key="min_quantity_widget", on_change=lambda: setattr(st.session_state, 'min_quantity', st.session_state.min_quantity_widget))
-    with row1_cols[2]:
-        st.multiselect(
-            "Длина фразы (токенов)",
-            options=cached_get_all_unique_lengths(),
-            default=st.session_state.selected_lengths,
-            key="selected_lengths_widget",
-            on_change=handle_length_change,
-            label_visibility="visible"
-        )
-
-    # Row 2: DEP, POS, TAG, ID buttons
-    row2_cols = st.columns(4)
-    with row2_cols[0]:
-        st.button("DEP", use_container_width=True, on_click=fill_sequence_dialog, args=("dep",))
-    with row2_cols[1]:
-        st.button("POS", use_container_width=True, on_click=fill_sequence_dialog, args=("pos",))
-    with row2_cols[2]:
-        st.button("TAG", use_container_width=True, on_click=fill_sequence_dialog, args=("tag",))
-    with row2_cols[3]:
-        st.button("ID", use_container_width=True, on_click=load_pattern_by_id_dialog)
-
-    st.markdown("---")
-
+def render_suggestion_panel(suggestion_data):
+    if not suggestion_data:
+        with st.expander("Подсказки для фильтрации", expanded=True):
+            st.info("Нет доступных вариантов для дальнейшей фильтрации.")
+    else:
+        suggestions_by_type_and_pos = {'dep': {}, 'pos': {}, 'tag': {}, 'morph': {}}
+        for position, suggestions in suggestion_data.items():
+            for s in suggestions:
+                if s['type'] in suggestions_by_type_and_pos:
+                    if position not in suggestions_by_type_and_pos[s['type']]:
+                        suggestions_by_type_and_pos[s['type']][position] = []
+                    suggestions_by_type_and_pos[s['type']][position].append(s)
+
+        active_filters = set()
+        for b in st.session_state.filter_blocks:
+            for r in b['rules']:
+                for v in r['values']:
+                    active_filters.add((b['position'], r['type'], v))
+
+        type_names = {
+            'dep': "Параметры фильтрации DEP",
+            'pos': "Параметры фильтрации POS",
+            'tag': "Параметры фильтрации TAG",
+            'morph': "Параметры фильтрации MORPH"
+        }
+
+        for s_type, pos_dict in suggestions_by_type_and_pos.items():
+            if pos_dict:
+                with st.expander(type_names.get(s_type, s_type.upper()), expanded=False):
+                    
+                    sorted_positions = sorted(pos_dict.keys())
+                    num_columns = max(len(sorted_positions), 1)
+                    cols = st.columns(num_columns)
+
+                    for i, position in enumerate(sorted_positions):
+                        with cols[i % num_columns]:
+                            st.markdown(f"**Позиция {position + 1}**")
+                            for s in pos_dict[position]:
+                                is_checked = (position, s['type'], s['value']) in active_filters
+                                key = f"suggest_{position}_{s['type']}_{s['value']}"
+                                label = f"{s['value']}  \nF: {format_number_with_spaces(s['freq'])}  \nQ: {format_number_with_spaces(s['qty'])}" 
+                                if 'rel_err' in s:
+                                    label += f" (±{s['rel_err']:.0%})"
+                                
+                                st.checkbox(
+                                    label, 
+                                    value=is_checked, 
+                                    key=key, 
+                                    on_change=toggle_filter_from_suggestion, 
+                                    args=(position, s['type'], s['value'])
+                                )
+
+
+def render_filter_blocks(rule_facets):
     max_len = max(st.session_state.selected_lengths) if st.session_state.selected_lengths else 0
     pos_options = list(range(1, max_len + 1))
 
-    table_to_use = st.session_state.get("temp_table_name") or "ngrams"
-
     for block in st.session_state.filter_blocks:
         expander_title = f"Позиция {block['position'] + 1}"
         with st.expander(expander_title, expanded=True):
@@ -511,9 +809,7 @@ with main_col1:
                 current_type_index = ['dep', 'pos', 'tag', 'token', 'lemma', 'morph'].index(rule['type'])
                 rule_cols[1].selectbox("Тип", ['dep', 'pos', 'tag', 'token', 'lemma', 'morph'], index=current_type_index, key=f"type_{rule_id}", on_change=handle_type_change, args=(block_id, rule_id), label_visibility="collapsed")
                 
-                blocks_tuple = make_hashable(st.session_state.filter_blocks)
-                selected_lengths_tuple = tuple(st.session_state.selected_lengths)
-                unique_vals = cached_get_unique_values_for_rule(block['position'], rule['type'], selected_lengths_tuple, blocks_tuple, block_id, rule_id, st.session_state.min_frequency, st.session_state.min_quantity, table_name=table_to_use)
+                unique_vals = rule_facets.get(rule_id, [])
                 
                 disp_opts = {f"{v[0]} (F:{format_number_with_spaces(v[1])}, Q:{format_number_with_spaces(v[2])})" if v[1] is not None else f"{v[0]} (Q:{format_number_with_spaces(v[2])})" : v[0] for v in unique_vals}
                 default_disp = [k for k, v in disp_opts.items() if v in rule['values']]
@@ -524,150 +820,15 @@ with main_col1:
             
             st.button("➕ Добавить правило", on_click=add_rule, args=(block_id,), key=f"add_rule_{block_id}")
 
-    st.button("Добавить блок фильтров", on_click=add_block, use_container_width=True)
-
-    sql_col, save_set_col, load_set_col = st.columns(3)
-
-    if sql_col.button("SQL", use_container_width=True):
-        if st.session_state.last_query:
-            show_sql_dialog()
-
-    if save_set_col.button("Сохранить набор", use_container_width=True):
-        save_set_dialog()
-
-    if load_set_col.button("Загрузить набор", use_container_width=True):
-        load_set_dialog()
-    st.markdown("---")
-
-    # --- Панель подсказок ---
-    if st.session_state.selected_lengths:
-        selected_lengths_tuple = tuple(st.session_state.selected_lengths)
-        
-        # Создаем версию блоков фильтров, которая включает только правила со значениями.
-        # Это будет использоваться в качестве ключа кэша для данных подсказок.
-        active_filter_blocks = []
-        for block in st.session_state.filter_blocks:
-            active_rules = [rule for rule in block['rules'] if rule['values']]
-            if active_rules:
-                # Нам нужно сохранить структуру блока, но только с активными правилами
-                active_block = block.copy()
-                active_block['rules'] = active_rules
-                active_filter_blocks.append(active_block)
-
-        filter_blocks_tuple_for_suggestions = make_hashable(active_filter_blocks)
-        
-        table_to_use = st.session_state.get("temp_table_name") or "ngrams"
-        suggestion_data = cached_get_suggestion_data(selected_lengths_tuple, filter_blocks_tuple_for_suggestions, st.session_state.min_frequency, st.session_state.min_quantity, table_name=table_to_use)
-
-        if not suggestion_data:
-            with st.expander("Подсказки для фильтрации", expanded=True):
-                st.info("Нет доступных вариантов для дальнейшей фильтрации.")
-        else:
-            suggestions_by_type_and_pos = {'dep': {}, 'pos': {}, 'tag': {}, 'morph': {}}
-            for position, suggestions in suggestion_data.items():
-                for s in suggestions:
-                    if s['type'] in suggestions_by_type_and_pos:
-                        if position not in suggestions_by_type_and_pos[s['type']]:
-                            suggestions_by_type_and_pos[s['type']][position] = []
-                        suggestions_by_type_and_pos[s['type']][position].append(s)
-
-            active_filters = set()
-            for b in st.session_state.filter_blocks:
-                for r in b['rules']:
-                    for v in r['values']:
-                        active_filters.add((b['position'], r['type'], v))
-
-            type_names = {
-                'dep': "Параметры фильтрации DEP",
-                'pos': "Параметры фильтрации POS",
-                'tag': "Параметры фильтрации TAG",
-                'morph': "Параметры фильтрации MORPH"
-            }
-
-            for s_type, pos_dict in suggestions_by_type_and_pos.items():
-                if pos_dict:
-                    with st.expander(type_names.get(s_type, s_type.upper()), expanded=False):
-                        
-                        sorted_positions = sorted(pos_dict.keys())
-                        num_columns = max(len(sorted_positions), 1)
-                        cols = st.columns(num_columns)
-
-                        for i, position in enumerate(sorted_positions):
-                            with cols[i % num_columns]:
-                                st.markdown(f"**Позиция {position + 1}**")
-                                for s in pos_dict[position]:
-                                    is_checked = (position, s['type'], s['value']) in active_filters
-                                    key = f"suggest_{position}_{s['type']}_{s['value']}"
-                                    label = f"{s['value']}  \nF: {format_number_with_spaces(s['freq'])}  \nQ: {format_number_with_spaces(s['qty'])}" 
-                                    
-                                    st.checkbox(
-                                        label, 
-                                        value=is_checked, 
-                                        key=key, 
-                                        on_change=toggle_filter_from_suggestion, 
-                                        args=(position, s['type'], s['value'])
-                                    )
-    
-    
-def _run_query():
-    
-    if not st.session_state.selected_lengths:
-        st.session_state.results = []
-        st.session_state.last_query = ""
+def render_results_totals():
+    # Итоги приходят отдельно и раньше строк, поэтому заголовок выводится в свой заполнитель
+    total_frequency, total_quantity = st.session_state.results_totals
+    if not total_quantity:
+        totals_area.empty()
         return
-    
-    has_active_filters = any(rule['values'] for block in st.session_state.filter_blocks for rule in block['rules'])
-
-    if not st.session_state.filter_blocks or not has_active_filters:
-        st.session_state.results = []
-        st.session_state.last_query = ""
-        return
-
-    table_to_use = st.session_state.get("temp_table_name") or "ngrams"
-    where_clauses = build_where_clauses(st.session_state.filter_blocks, table_name=table_to_use)
-
-    # Add min_frequency filter
-    if st.session_state.min_frequency > 0:
-        where_clauses.append(f"{table_to_use}.freq_mln >= {float(st.session_state.min_frequency)}")
-
-    # The main WHERE clause for lengths is only needed when querying the main ngrams table
-    # (the temp table is already filtered by length).
-    if table_to_use == "ngrams":
-        where_clauses.insert(0, f"len IN ({', '.join(map(str, st.session_state.selected_lengths))})")
-
-    full_where_clause = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
-
-    query = f"""
-        SELECT text, freq_mln, tokens
-        FROM {table_to_use}
-        {full_where_clause}
-        ORDER BY freq_mln DESC;
-    """
-    st.session_state.last_query = query.strip()
-    results = execute_query(conn, st.session_state.last_query)
-    if results is not None:
-        st.session_state.results = results
-    else:
-        st.session_state.results = []
-        st.error("Ошибка выполнения запроса к базе данных.")
-
-# --- Автоматическое обновление результатов ---
-current_filters_state = {
-    "lengths": st.session_state.selected_lengths,
-    "blocks": st.session_state.filter_blocks
-}
-current_filters_hash = hash(make_hashable(current_filters_state))
-
-if st.session_state.current_filters_hash != current_filters_hash:
-    st.session_state.current_filters_hash = current_filters_hash
-    _run_query()
-
-with main_col2:
-    if st.session_state.results:
-        total_frequency = sum(res[1] for res in st.session_state.results)
-        total_quantity = len(st.session_state.results)
-        st.markdown(f"### <small>F: {format_number_with_spaces(total_frequency)}, Q: {format_number_with_spaces(total_quantity)}</small>", unsafe_allow_html=True)
+    totals_area.markdown(f"### <small>F: {format_number_with_spaces(total_frequency)}, Q: {format_number_with_spaces(total_quantity)}</small>", unsafe_allow_html=True)
 
+def render_results():
     if st.session_state.results:
         swapped_results = [(res[1], res[0]) for res in st.session_state.results]
         df_results = pd.DataFrame(swapped_results, columns=["Частотность (млн)", "Фраза"])
@@ -686,30 +847,529 @@ with main_col2:
             height=800,
             hide_index=True
         )
+
+        current_page = len(st.session_state.results_page_starts)
+        total_pages = max((st.session_state.results_totals[1] + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE, 1)
+        page_cols = st.columns([1.5, 1.5, 3])
+        page_cols[0].button("◀️ Назад", on_click=prev_results_page, disabled=current_page <= 1, use_container_width=True)
+        page_cols[1].button("Вперед ▶️", on_click=next_results_page, disabled=current_page >= total_pages, use_container_width=True)
+        with page_cols[2]:
+            st.write(f"Стр. {current_page} / {total_pages}")
         
+        render_export_controls()
+
         if st.button("Показать анализ слов по позициям"):
             st.session_state.show_word_analysis = not st.session_state.show_word_analysis
         
         if st.session_state.show_word_analysis:
             with st.expander("Анализ слов по позициям", expanded=True):
-                position_word_count = {}
-                for _, _, tokens_list in st.session_state.results:
-                    words = tokens_list
-                    for i, word in enumerate(words):
-                        if i not in position_word_count:
-                            position_word_count[i] = {}
-                        position_word_count[i][word] = position_word_count[i].get(word, 0) + 1
-
-                num_columns = 7
-                sorted_positions = sorted(position_word_count.keys())
-                
-                cols = st.columns(min(len(sorted_positions), num_columns))
-
-                for i, position in enumerate(sorted_positions):
-                    with cols[i % num_columns]:
-                        word_counts = position_word_count[position]
-                        total_words_in_position = sum(word_counts.values())
-                        st.markdown(f"**Позиция {position + 1} ({format_number_with_spaces(total_words_in_position)})**")
-                        sorted_words = sorted(word_counts.items(), key=lambda item: item[1], reverse=True)
-                        for word, count in sorted_words:
-                            st.markdown(f"- {word} ({format_number_with_spaces(count)})")
+                render_word_analysis()
+
+# --- Выгрузка результатов ---
+EXPORT_FORMAT_LABELS = {"csv": "CSV", "parquet": "Parquet"}
+# Как часто обновлять индикатор прогресса выгрузки (сек): COPY передает данные построчно
+EXPORT_PROGRESS_INTERVAL = 0.5
+
+def _export_source():
+    """Условие, параметры и таблица полной выборки для выгрузки; для движков в памяти фильтр компилируется в SQL."""
+    results_filter = st.session_state.results_filter
+    if results_filter.get('engine') in IN_MEMORY_ENGINES:
+        with db_connection() as conn:
+            features = get_storage_features(conn, _shared_table_name())
+        where_clauses, params = build_results_where(
+            results_filter['blocks'], results_filter['lengths'], results_filter['min_frequency'],
+            table_name=_shared_table_name(), features=features
+        )
+        return where_clauses, params, _shared_table_name()
+    return results_filter['where_clauses'], results_filter['params'], results_filter['table_name']
+
+def run_export(export_format):
+    where_clauses, params, table_name = _export_source()
+    total_rows = st.session_state.results_totals[1]
+    progress_bar = st.progress(0.0, text="Выгрузка...")
+    last_update = [0.0]
+
+    def on_progress(bytes_written, lines_written):
+        now = time.monotonic()
+        if now - last_update[0] < EXPORT_PROGRESS_INTERVAL:
+            return
+        last_update[0] = now
+        # Строки файла считаются по переводам строк (включая заголовок и переводы внутри полей),
+        # поэтому доля приблизительная; точное число фраз сообщается после завершения COPY
+        progress_bar.progress(
+            min(lines_written / (total_rows + 1), 1.0) if total_rows else 0.0,
+            text=f"Выгружено: {bytes_written / (1024 * 1024):.1f} МБ, ~{format_number_with_spaces(max(lines_written - 1, 0))} строк файла"
+        )
+
+    if table_name == st.session_state.temp_table_name:
+        # Временная таблица видна только подключению сессии
+        with session_connection() as session_conn:
+            exported = export_results(session_conn, where_clauses, params, export_format, table_name=table_name, on_progress=on_progress)
+    else:
+        with db_connection() as export_conn:
+            exported = export_results(export_conn, where_clauses, params, export_format, table_name=table_name, on_progress=on_progress)
+    progress_bar.empty()
+    if exported is None:
+        st.error("Ошибка при выгрузке результатов.")
+        return
+    st.session_state.last_export = exported
+
+def render_export_link():
+    path, rows = st.session_state.last_export
+    if not os.path.exists(path):
+        st.session_state.last_export = None
+        return
+    file_name = os.path.basename(path)
+    # Файл отдается только текущей сессии: каталог выгрузок не доступен по прямой ссылке
+    label = f"📥 {file_name}" if rows is None else f"📥 {file_name} (строк: {format_number_with_spaces(rows)})"
+    with open(path, "rb") as export_file:
+        st.download_button(label, export_file, file_name=file_name)
+
+def render_export_controls():
+    formats = [export_format for export_format in EXPORT_FORMATS if export_format != "parquet" or parquet_available()]
+    export_cols = st.columns([1.5, 1.5, 3], vertical_alignment="bottom")
+    export_format = export_cols[0].selectbox("Формат выгрузки", formats, format_func=EXPORT_FORMAT_LABELS.get, key="export_format")
+    if export_cols[1].button("Выгрузить все", use_container_width=True):
+        with export_cols[2]:
+            run_export(export_format)
+    if st.session_state.last_export:
+        render_export_link()
+
+WORD_ANALYSIS_LABELS = {"token": "Токены", "lemma": "Леммы"}
+
+def render_word_analysis():
+    # Анализ считается по всей выборке (агрегирующим запросом или по маске движка), а не по загруженной странице
+    try:
+        with st.spinner("Анализ слов по позициям..."):
+            with session_connection() as session_conn:
+                analysis = cached_get_word_analysis(make_hashable(st.session_state.results_filter), _conn=session_conn)
+    except QueryFailedError as e:
+        st.warning(f"Не удалось выполнить анализ слов: {e}. Повторите попытку.")
+        return
+    if not analysis:
+        st.info("Нет данных для анализа.")
+        return
+
+    num_columns = 7
+    tabs = st.tabs([WORD_ANALYSIS_LABELS[word_type] for word_type in WORD_ANALYSIS_LABELS])
+    for tab, word_type in zip(tabs, WORD_ANALYSIS_LABELS):
+        by_position = analysis.get(word_type, {})
+        sorted_positions = sorted(by_position.keys())
+        if not sorted_positions:
+            continue
+        with tab:
+            cols = st.columns(min(len(sorted_positions), num_columns))
+            for i, position in enumerate(sorted_positions):
+                stats = by_position[position]
+                with cols[i % num_columns]:
+                    st.markdown(f"**Позиция {position + 1}** (F: {format_number_with_spaces(stats['total_freq'])}, Q: {format_number_with_spaces(stats['total_qty'])})")
+                    st.dataframe(
+                        pd.DataFrame({"Слово": stats['values'], "F": stats['freq'], "Q": stats['qty']}),
+                        column_config={"F": st.column_config.NumberColumn(format="localized"), "Q": st.column_config.NumberColumn(format="localized")},
+                        hide_index=True,
+                        use_container_width=True
+                    )
+
+# --- Результаты ---
+def _reset_results():
+    st.session_state.results = []
+    st.session_state.results_filter = None
+    st.session_state.results_page_starts = [None]
+    st.session_state.results_totals = (0, 0)
+    st.session_state.last_query = ""
+    st.session_state.last_query_params = []
+
+def _fetch_results_page(page_conn, results_filter, after):
+    """Читает страницу результатов по сохраненному фильтру, начиная после ключа after."""
+    if results_filter.get('engine') in IN_MEMORY_ENGINES:
+        engine = get_matrix_engine(results_filter['lengths'], results_filter['engine'])
+        mask = engine.filter_mask(results_filter['blocks'], results_filter['min_frequency'])
+        return engine.get_results_page(mask, after=after, page_size=RESULTS_PAGE_SIZE)
+    return get_results_page(
+        page_conn, results_filter['where_clauses'], results_filter['params'],
+        table_name=results_filter['table_name'], after=after
+    )
+
+def _load_results_page():
+    """
+    Загружает страницу результатов, начинающуюся после ключа из results_page_starts[-1].
+    Возвращает False, если запрос не выполнен: текущая страница тогда остается на экране.
+    """
+    results_filter = st.session_state.results_filter
+    if not results_filter:
+        st.session_state.results = []
+        return True
+    try:
+        with session_connection() as session_conn, query_connection(session_conn) as page_conn:
+            page = _fetch_results_page(page_conn, results_filter, st.session_state.results_page_starts[-1])
+    except QueryFailedError:
+        page = None
+    if page is None:
+        st.toast("Не удалось загрузить страницу результатов, повторите попытку.", icon="⚠️")
+        return False
+    st.session_state.results = page
+    return True
+
+def next_results_page():
+    if st.session_state.results:
+        last_row = st.session_state.results[-1]
+        st.session_state.results_page_starts.append((last_row[1], last_row[3]))
+        if not _load_results_page():
+            st.session_state.results_page_starts.pop()
+
+def prev_results_page():
+    if len(st.session_state.results_page_starts) > 1:
+        page_start = st.session_state.results_page_starts.pop()
+        if not _load_results_page():
+            st.session_state.results_page_starts.append(page_start)
+
+def _query_totals(selected_lengths, filter_blocks, min_frequency, engine_name, table_name, _conn=None):
+    """Итоги F/Q выборки для заголовка результатов; None — фильтров нет, результаты будут сброшены."""
+    has_active_filters = any(rule['values'] for block in filter_blocks for rule in block['rules'])
+    if not selected_lengths or not has_active_filters:
+        return None
+    return cached_get_selection_totals(
+        tuple(selected_lengths), make_hashable(filter_blocks), min_frequency,
+        table_name=table_name, engine=engine_name, _conn=_conn
+    )
+
+def _query_results(query_conn, selected_lengths, filter_blocks, min_frequency, engine_name, table_name):
+    """
+    Считает первую страницу результатов (итоги считает _query_totals). Не трогает session_state,
+    поэтому может выполняться в фоновом потоке; возвращает состояние для _apply_results (None — сбросить результаты).
+    """
+    has_active_filters = any(rule['values'] for block in filter_blocks for rule in block['rules'])
+    if not selected_lengths or not has_active_filters:
+        return None
+
+    if engine_name in IN_MEMORY_ENGINES:
+        # Фильтрация в памяти: SQL не выполняется, итоги и страницы считаются по одной маске
+        lengths_tuple = tuple(selected_lengths)
+        engine = get_matrix_engine(lengths_tuple, engine_name)
+        results_filter = {"engine": engine_name, "lengths": lengths_tuple, "blocks": filter_blocks, "min_frequency": min_frequency}
+        return {
+            "last_query": "", "last_query_params": [], "results_filter": results_filter,
+            "results": _fetch_results_page(query_conn, results_filter, None),
+        }
+
+    where_clauses, params = build_results_where(filter_blocks, selected_lengths, min_frequency, table_name=table_name, features=get_storage_features(query_conn, table_name))
+
+    full_where_clause = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+
+    query = f"""
+        SELECT text, freq_mln, tokens
+        FROM {table_name}
+        {full_where_clause}
+        ORDER BY freq_mln DESC, id DESC;
+    """
+
+    # Строки читаются постранично; итоги F/Q приходят раньше отдельной секцией
+    results_filter = {"table_name": table_name, "where_clauses": where_clauses, "params": params}
+    first_page = _fetch_results_page(query_conn, results_filter, None)
+    if first_page is None:
+        raise QueryFailedError("запрос результатов прерван или завершился ошибкой")
+    return {
+        "last_query": query.strip(), "last_query_params": params, "results_filter": results_filter,
+        "results": first_page,
+    }
+
+def _apply_results(results_state):
+    if results_state is None:
+        _reset_results()
+        return
+    st.session_state.results_page_starts = [None]
+    for key, value in results_state.items():
+        st.session_state[key] = value
+
+def _submit_session_queries(executor, query_tag, results_args, table_name, index_keys=()):
+    """
+    Итоги и первая страница результатов по временной таблице сессии. Таблица видна только подключению
+    сессии, а одно подключение не должно выполнять два запроса сразу (у них общая транзакция), поэтому
+    одна задача под блокировкой подключения сессии выполняет их друг за другом, а перед ними строит
+    созревшие индексы index_keys (см. IndexPlanner.record с deferred=True). Итоги отдаются своим Future
+    сразу после подсчета. Задача помечена query_tag, как задачи на подключениях из пула: ее запросы
+    ограничены statement_timeout и отменяются на сервере, когда фильтры сессии меняются.
+    Возвращает (Future итогов, Future результатов).
+    """
+    session_connections = get_session_connections()
+    session_id = _session_id()
+    planner = get_index_planner()
+    totals_future = Future()
+    started = []
+
+    def run_session_queries(session_conn):
+        started.append(True)
+        planner.build_deferred(session_conn, table_name, index_keys)
+        if session_conn is None:
+            raise QueryFailedError("подключение сессии освобождено")
+        try:
+            executor.raise_if_cancelled()
+            totals_future.set_result(_query_totals(*results_args, table_name, _conn=session_conn))
+        except Exception as e:
+            totals_future.set_exception(e)
+        executor.raise_if_cancelled()
+        return _query_results(session_conn, *results_args, table_name)
+
+    def on_done(future):
+        # Если задача не начала работу, итоги не должны ждать вечно, а индексы — числиться в работе
+        totals_future.cancel()
+        if not started:
+            planner.abandon_deferred(table_name, index_keys)
+
+    results_future = executor.submit_query_on(
+        lambda: session_connections.use(session_id), run_session_queries, query_tag=query_tag
+    )
+    results_future.add_done_callback(on_done)
+    return totals_future, results_future
+
+def _submit_section(executor, query_tag, cached_fn, *args, **kwargs):
+    """Запускает секцию страницы в фоне: движкам в памяти подключение не нужно, PostgreSQL получает свое из пула."""
+    if st.session_state.filter_engine in IN_MEMORY_ENGINES:
+        return executor.submit(cached_fn, *args, **kwargs)
+    return executor.submit_query(lambda task_conn: cached_fn(*args, _conn=task_conn, **kwargs), query_tag=query_tag)
+
+SECTION_LABELS = {"rule_facets": "значения правил", "suggestions": "подсказки", "totals": "итоги", "results": "результаты"}
+
+# --- Основной интерфейс ---
+st.title("Phrase Filtration")
+loading_status = st.empty()
+main_col1, main_col2 = st.columns([2, 1.5])
+
+try:
+    length_options = cached_get_all_unique_lengths()
+except QueryFailedError as e:
+    st.error(f"Не удалось подключиться к базе данных: {e}. Проверьте настройки в .env файле и доступность сервера.")
+    st.stop()
+
+with main_col1:
+    st.subheader("Параметры фильтрации")
+
+    # Row 1: Min Freq, Min Qty, Length
+    row1_cols = st.columns([1, 1, 2])
+    with row1_cols[0]:
+        st.number_input("Мин. частотность (млн)", min_value=0.0, value=st.session_state.min_frequency, step=0.001, key="min_frequency_widget", on_change=lambda: setattr(st.session_state, 'min_frequency', st.session_state.min_frequency_widget))
+    with row1_cols[1]:
+        st.number_input("Мин. количество фраз", min_value=0, value=st.session_state.min_quantity, step=1, key="min_quantity_widget", on_change=lambda: setattr(st.session_state, 'min_quantity', st.session_state.min_quantity_widget))
+    with row1_cols[2]:
+        st.multiselect(
+            "Длина фразы (токенов)",
+            options=length_options,
+            default=st.session_state.selected_lengths,
+            key="selected_lengths_widget",
+            on_change=handle_length_change,
+            label_visibility="visible"
+        )
+
+    st.radio(
+        "Движок фильтрации",
+        options=list(ENGINE_OPTIONS.keys()),
+        format_func=ENGINE_OPTIONS.get,
+        index=list(ENGINE_OPTIONS.keys()).index(st.session_state.filter_engine),
+        key="filter_engine_widget",
+        on_change=handle_engine_change,
+        horizontal=True,
+        help="Движки в памяти загружают n-граммы выбранных длин один раз и считают фильтры без запросов к БД; битовые индексы быстрее всего при частом переключении подсказок."
+    )
+    st.toggle(
+        "Быстрые приблизительные подсказки",
+        value=st.session_state.approximate_suggestions,
+        key="approximate_suggestions_widget",
+        on_change=lambda: setattr(st.session_state, 'approximate_suggestions', st.session_state.approximate_suggestions_widget),
+        help=f"Подсказки сначала считаются по выборке ~{SUGGESTIONS_SAMPLE_PERCENT}% строк (F и Q — оценки с погрешностью), затем уточняются в фоне."
+    )
+
+    # Row 2: DEP, POS, TAG, ID buttons
+    row2_cols = st.columns(4)
+    with row2_cols[0]:
+        st.button("DEP", use_container_width=True, on_click=fill_sequence_dialog, args=("dep",))
+    with row2_cols[1]:
+        st.button("POS", use_container_width=True, on_click=fill_sequence_dialog, args=("pos",))
+    with row2_cols[2]:
+        st.button("TAG", use_container_width=True, on_click=fill_sequence_dialog, args=("tag",))
+    with row2_cols[3]:
+        st.button("ID", use_container_width=True, on_click=load_pattern_by_id_dialog)
+
+    st.markdown("---")
+
+    # Секции ниже заполняются по мере готовности их запросов
+    blocks_area = st.container()
+
+    st.button("Добавить блок фильтров", on_click=add_block, use_container_width=True)
+
+    sql_col, save_set_col, load_set_col = st.columns(3)
+
+    if sql_col.button("SQL", use_container_width=True):
+        if st.session_state.last_query:
+            show_sql_dialog()
+
+    if save_set_col.button("Сохранить набор", use_container_width=True):
+        save_set_dialog()
+
+    if load_set_col.button("Загрузить набор", use_container_width=True):
+        load_set_dialog()
+    st.markdown("---")
+
+    suggestions_area = st.container()
+
+with main_col2:
+    totals_area = st.empty()
+    results_area = st.container()
+
+# --- Параллельный запуск независимых запросов ---
+# Значения правил, подсказки и результаты не зависят друг от друга, поэтому уходят на сервер
+# одновременно. Фоновые задачи PostgreSQL работают на своих подключениях из пула и читают общее
+# подмножество выбранных длин. Временную таблицу сессии (запасной вариант) они не видят, поэтому
+# в этом случае читают ngrams с фильтром по длинам, а итоги и результаты по очереди выполняются
+# на подключении сессии.
+_keep_session_tables_alive()
+executor = get_query_executor()
+sections = {}
+selected_lengths_tuple = tuple(st.session_state.selected_lengths)
+
+# Запросы помечаются отпечатком фильтров; запросы этой сессии, запущенные для прежних
+# фильтров (пользователь успел переключить подсказки), отменяются на сервере
+query_tag = filters_fingerprint(
+    st.session_state.selected_lengths, st.session_state.filter_blocks,
+    min_frequency=st.session_state.min_frequency, min_quantity=st.session_state.min_quantity,
+    engine=st.session_state.filter_engine, approximate=st.session_state.approximate_suggestions
+)
+executor.cancel_superseded(query_tag)
+if st.session_state.filter_engine in IN_MEMORY_ENGINES and selected_lengths_tuple:
+    # Загрузка движка показывает спиннер, поэтому выполняется в основном потоке до запуска задач
+    try:
+        get_matrix_engine(selected_lengths_tuple, st.session_state.filter_engine)
+    except (QueryFailedError, psycopg2.Error) as e:
+        print(f"Ошибка при загрузке движка в память: {e}")
+        st.error("Не удалось загрузить n-граммы в память: нет свободного подключения к БД или запрос прерван. Обновите страницу позже.")
+        st.stop()
+
+# Значения для всех правил на экране считаются одним пакетным запросом по каноническим запросам;
+# rule_request_keys сопоставляет правила страницы с ключами результата
+canonical_filter_blocks, rule_requests, rule_request_keys = canonical_rule_requests(st.session_state.filter_blocks)
+canonical_blocks_tuple = make_hashable(canonical_filter_blocks)
+if rule_requests:
+    sections["rule_facets"] = _submit_section(
+        executor, query_tag, cached_get_unique_values_for_rules,
+        rule_requests, selected_lengths_tuple, canonical_blocks_tuple,
+        st.session_state.min_frequency, st.session_state.min_quantity, table_name=_shared_table_name(), engine=st.session_state.filter_engine
+    )
+else:
+    with blocks_area:
+        render_filter_blocks({})
+
+# --- Панель подсказок ---
+approximate_request_key = None
+if st.session_state.selected_lengths:
+    # Канонические блоки содержат только правила со значениями и служат ключом кэша подсказок
+    filter_blocks_tuple_for_suggestions = canonical_blocks_tuple
+
+    use_sampling = st.session_state.approximate_suggestions and st.session_state.filter_engine not in IN_MEMORY_ENGINES
+    if not use_sampling:
+        sections["suggestions"] = _submit_section(
+            executor, query_tag, cached_get_suggestion_data, selected_lengths_tuple, filter_blocks_tuple_for_suggestions,
+            st.session_state.min_frequency, st.session_state.min_quantity, table_name=_shared_table_name(), engine=st.session_state.filter_engine
+        )
+    else:
+        # Сначала оценки по выборке, затем точные значения из фонового запроса
+        request_key = (selected_lengths_tuple, filter_blocks_tuple_for_suggestions, st.session_state.min_frequency, st.session_state.min_quantity)
+        exact_data = st.session_state.exact_suggestions.get(request_key)
+        if exact_data is not None:
+            with suggestions_area:
+                render_suggestion_panel(exact_data)
+        else:
+            sections["suggestions"] = _submit_section(
+                executor, query_tag, cached_get_suggestion_data, selected_lengths_tuple, filter_blocks_tuple_for_suggestions,
+                st.session_state.min_frequency, st.session_state.min_quantity, table_name=_shared_table_name(), sample_percent=SUGGESTIONS_SAMPLE_PERCENT
+            )
+            _start_exact_suggestions(request_key, selected_lengths_tuple, make_mutable(filter_blocks_tuple_for_suggestions), query_tag, _shared_table_name())
+            approximate_request_key = request_key
+
+# --- Автоматическое обновление результатов ---
+current_filters_state = {
+    "lengths": st.session_state.selected_lengths,
+    "blocks": canonical_filter_blocks,
+    "engine": st.session_state.filter_engine
+}
+current_filters_hash = hash(make_hashable(current_filters_state))
+
+if st.session_state.current_filters_hash != current_filters_hash:
+    results_args = (list(st.session_state.selected_lengths), canonical_filter_blocks, st.session_state.min_frequency, st.session_state.filter_engine)
+    session_index_keys = ()
+    if st.session_state.filter_engine not in IN_MEMORY_ENGINES and _session_table_name() != "ngrams":
+        # Таблицы сессии создаются без индексов; планировщик строит индексы под повторяющиеся условия.
+        # Индексы временной таблицы строит задача сессии перед своими запросами
+        with session_connection() as session_conn, query_connection(session_conn) as features_conn:
+            index_features = get_storage_features(features_conn, _session_table_name())
+        session_index_keys = get_index_planner().record(
+            _session_table_name(), predicate_index_keys(canonical_filter_blocks, index_features),
+            deferred=bool(st.session_state.temp_table_name)
+        )
+    # Итоги запускаются первыми и обычно берутся из готовых агрегатов: размер выборки виден до загрузки строк
+    if st.session_state.filter_engine in IN_MEMORY_ENGINES:
+        sections["totals"] = executor.submit(_query_totals, *results_args, _session_table_name())
+        sections["results"] = executor.submit(_query_results, None, *results_args, _session_table_name())
+    elif st.session_state.temp_table_name:
+        sections["totals"], sections["results"] = _submit_session_queries(executor, query_tag, results_args, _session_table_name(), session_index_keys)
+    else:
+        sections["totals"] = executor.submit_query(
+            lambda task_conn: _query_totals(*results_args, _shared_table_name(), _conn=task_conn), query_tag=query_tag
+        )
+        sections["results"] = executor.submit_query(_query_results, *results_args, _shared_table_name(), query_tag=query_tag)
+else:
+    render_results_totals()
+    with results_area:
+        render_results()
+
+def _show_pending_sections(pending):
+    # Вывод статуса заодно дает Streamlit прервать этот rerun, если пользователь уже изменил фильтры
+    loading_status.caption("⏳ Загрузка: " + ", ".join(SECTION_LABELS[name] for name in pending))
+
+# Страница результатов выводится один раз, когда применены и строки, и итоги (от них зависит число страниц).
+# Хэш фиксируется только вместе с ними: прерванный rerun повторит запросы, а не покажет устаревшие итоги
+results_applied = False
+totals_applied = "totals" not in sections
+
+def _finish_results():
+    st.session_state.current_filters_hash = current_filters_hash
+    with results_area:
+        render_results()
+
+def _show_section_error(section, error):
+    # Сбой секции не сохраняется ни в кэше, ни в хэше фильтров: следующий rerun повторит запрос
+    print(f"Ошибка секции {section}: {error}")
+    message = f"Не удалось загрузить {SECTION_LABELS[section]}: {error or 'запрос отменен'}. Повторите попытку."
+    if section == "rule_facets":
+        with blocks_area:
+            st.warning(message)
+            render_filter_blocks({})
+    elif section == "suggestions":
+        with suggestions_area:
+            st.warning(message)
+    elif section == "totals":
+        totals_area.warning(message)
+    else:
+        with results_area:
+            st.warning(message)
+
+for section, result in iter_completed(sections, on_wait=_show_pending_sections, on_error=_show_section_error):
+    if section == "rule_facets":
+        with blocks_area:
+            render_filter_blocks({rule_id: result.get(request_key, []) for rule_id, request_key in rule_request_keys.items()})
+    elif section == "suggestions":
+        with suggestions_area:
+            render_suggestion_panel(result)
+            if approximate_request_key is not None:
+                st.fragment(_poll_exact_suggestions, run_every=SUGGESTIONS_POLL_INTERVAL)(approximate_request_key)
+    elif section == "totals":
+        st.session_state.results_totals = result or (0, 0)
+        totals_applied = True
+        render_results_totals()
+        if results_applied:
+            _finish_results()
+    elif section == "results":
+        _apply_results(result)
+        results_applied = True
+        if totals_applied:
+            _finish_results()
+
+loading_status.empty()
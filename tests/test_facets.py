@@ -0,0 +1,72 @@
+import pytest
+
+from core import database
+from core.database import get_unique_values_for_rules
+
+BLOCKS = [
+    {'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'pos', 'values': ['NOUN']},
+        {'id': 'r1', 'type': 'token', 'values': []},
+    ]},
+    {'id': 'b1', 'position': 1, 'rules': [
+        {'id': 'r2', 'type': 'morph', 'values': ['Case=Nom']},
+    ]},
+]
+RULE_REQUESTS = (('b0', 'r0', 0, 'pos'), (None, 'p0:token', 0, 'token'), ('b1', 'r2', 1, 'morph'))
+
+
+class CaptureConnection:
+    """Подключение-заглушка: запоминает запрос и отдает заранее заданные строки результата."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.queries = []
+        self.connection = self
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchall(self):
+        return self.rows
+
+
+def run_facets(monkeypatch, features, rows=()):
+    monkeypatch.setattr(database, "get_storage_features", lambda conn, table_name="ngrams": frozenset(features))
+    conn = CaptureConnection(rows)
+    facets = get_unique_values_for_rules(conn, RULE_REQUESTS, [2, 3], BLOCKS, 0.5, 2)
+    (query, params), = conn.queries
+    return facets, query, params
+
+
+@pytest.mark.parametrize("features", [
+    {'token_index'}, {'pattern_positions'}, {'token_index', 'pattern_positions', 'encoded', 'morph_bits'},
+])
+def test_rule_flags_do_not_use_subqueries(monkeypatch, features):
+    _, query, params = run_facets(monkeypatch, features)
+    assert "ngram_tokens" not in query and "ngram_pattern_positions" not in query
+    assert query.replace('%%', '').count('%s') == len(params)
+
+
+def test_encoded_rules_group_by_codes(monkeypatch):
+    _, query, params = run_facets(monkeypatch, {'encoded'})
+    assert "ARRAY[ngrams.pos_codes[%s::int + 1]::int]" in query
+    assert "ARRAY[ngrams.token_codes[%s::int + 1]::int]" in query
+    # У morph нет колонки кодов: его значения по-прежнему читаются из JSONB
+    assert "jsonb_array_elements_text(ngrams.morph->%s::int)" in query
+    assert "LEFT JOIN ngram_vocab voc" in query
+    assert params[:3] == [0, 'pos', 0] and params[-3:] == [[2, 3], 0.5, 2]
+
+
+def test_results_are_grouped_by_rule(monkeypatch):
+    rows = [(0, 'NOUN', 5.0, 3), (0, None, 1.0, 2), (2, 'Case=Nom', 2.5, 2)]
+    facets, _, _ = run_facets(monkeypatch, set(), rows)
+    assert facets == {'r0': [('NOUN', 5.0, 3)], 'p0:token': [], 'r2': [('Case=Nom', 2.5, 2)]}
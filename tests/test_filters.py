@@ -0,0 +1,66 @@
+import copy
+
+from core.filters import canonicalize_blocks, canonical_rule_requests, filters_fingerprint
+
+
+def make_blocks():
+    return [
+        {'id': 'uuid-a', 'position': 0, 'rules': [
+            {'id': 'r-1', 'type': 'pos', 'operator': 'include', 'values': ['NOUN', 'ADJ']},
+            {'id': 'r-2', 'type': 'dep', 'operator': 'exclude', 'values': ['punct']},
+            {'id': 'r-3', 'type': 'tag', 'values': []},
+        ]},
+        {'id': 'uuid-b', 'position': 1, 'rules': [
+            {'id': 'r-4', 'type': 'morph', 'values': ['Case=Nom']},
+        ]},
+        {'id': 'uuid-c', 'position': 2, 'rules': [
+            {'id': 'r-5', 'type': 'pos', 'values': []},
+        ]},
+    ]
+
+
+def test_canonical_blocks_ignore_ids_and_order():
+    blocks = make_blocks()
+    shuffled = copy.deepcopy(blocks)[::-1]
+    for block in shuffled:
+        block['id'] = f"other-{block['id']}"
+        block['rules'].reverse()
+        for rule in block['rules']:
+            rule['id'] = f"other-{rule['id']}"
+            rule['values'] = list(reversed(rule['values']))
+
+    canonical, _ = canonicalize_blocks(blocks)
+    canonical_shuffled, _ = canonicalize_blocks(shuffled)
+    assert canonical == canonical_shuffled
+    assert canonical_rule_requests(blocks)[1] == canonical_rule_requests(shuffled)[1]
+    assert filters_fingerprint([3, 2], blocks) == filters_fingerprint([2, 3], shuffled)
+
+
+def test_canonical_blocks_drop_rules_without_values():
+    canonical, rule_ids = canonicalize_blocks(make_blocks())
+    assert [block['position'] for block in canonical] == [0, 1]
+    assert set(rule_ids) == {'r-1', 'r-2', 'r-4'}
+    assert all(rule['values'] for block in canonical for rule in block['rules'])
+    assert [rule['id'] for block in canonical for rule in block['rules']] == sorted(rule_ids.values())
+
+
+def test_canonical_blocks_default_operator_is_include():
+    blocks = make_blocks()
+    explicit = copy.deepcopy(blocks)
+    explicit[1]['rules'][0]['operator'] = 'include'
+    assert canonicalize_blocks(blocks)[0] == canonicalize_blocks(explicit)[0]
+
+
+def test_canonical_blocks_change_with_content():
+    blocks = make_blocks()
+    changed = copy.deepcopy(blocks)
+    changed[0]['rules'][1]['operator'] = 'include'
+    moved = copy.deepcopy(blocks)
+    moved[1]['position'] = 3
+    keys = {
+        filters_fingerprint([2], blocks),
+        filters_fingerprint([2], changed),
+        filters_fingerprint([2], moved),
+        filters_fingerprint([2], blocks, min_frequency=1),
+    }
+    assert len(keys) == 4
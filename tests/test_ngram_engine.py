@@ -0,0 +1,235 @@
+import numpy as np
+import pytest
+
+from core import ngram_engine
+from core.database import COLUMN_MAPPING, build_results_where
+from core.ngram_engine import ENGINE_ATTRIBUTES, NgramBitmapEngine, NgramMatrixEngine
+
+# Строки в формате выборки NgramMatrixEngine.load: id, text, freq_mln, len, deps, pos, tags, tokens, lemmas, morph
+NGRAM_ROWS = [
+    (1, "дом стоит", 5.0, 2, ["nsubj", "ROOT"], ["NOUN", "VERB"], ["NN", "VB"], ["дом", "стоит"], ["дом", "стоять"],
+     [["Case=Nom", "Number=Sing"], ["Number=Sing"]]),
+    (2, "дома стоят", 3.5, 2, ["nsubj", "ROOT"], ["NOUN", "VERB"], ["NN", "VB"], ["дома", "стоят"], ["дом", "стоять"],
+     [["Case=Nom", "Number=Plur"], ["Number=Plur"]]),
+    (3, "большой дом", 2.0, 2, ["amod", None], ["ADJ", "NOUN"], ["JJ", "NN"], ["большой", "дом"], ["большой", "дом"],
+     [["Case=Nom"], []]),
+    (4, "дом", 7.0, 1, ["ROOT"], ["NOUN"], ["NN"], ["дом"], ["дом"], [["Case=Nom", "Number=Sing"]]),
+    (5, "у дома", 1.0, 2, ["case", "ROOT"], ["ADP", "NOUN"], ["IN", "NN"], ["у", "дома"], ["у", "дом"],
+     [[], ["Case=Gen", "Number=Sing"]]),
+    (6, "дом у реки", 0.5, 3, ["ROOT", "case", "nmod"], ["NOUN", "ADP", "NOUN"], ["NN", "IN", "NN"],
+     ["дом", "у", "реки"], ["дом", "у", "река"], [["Case=Nom"], [], ["Case=Gen"]]),
+]
+ROW_FIELDS = {'dep': 4, 'pos': 5, 'tag': 6, 'token': 7, 'lemma': 8, 'morph': 9}
+
+
+def sql_rule(row, rule, position):
+    """
+    Значение условия _compile_rule для строки с трехзначной логикой SQL (None — NULL):
+    jsonb_array_length(col) > pos AND [NOT] (col->>pos = ANY(values) | morph->pos ?| values).
+    """
+    array = row[ROW_FIELDS[rule['type']]]
+    if len(array) <= position:
+        return False
+    element = array[position]
+    if element is None:
+        hit = None
+    elif rule['type'] == 'morph':
+        hit = bool(set(element) & set(rule['values']))
+    else:
+        hit = element in rule['values']
+    if rule.get('operator', 'include') == 'exclude':
+        hit = None if hit is None else not hit
+    return hit is True
+
+
+def sql_selection(blocks, lengths, min_frequency):
+    """id строк, которые отобрал бы WHERE из build_results_where (все условия через AND)."""
+    return {
+        row[0] for row in NGRAM_ROWS
+        if row[3] in lengths and row[2] >= min_frequency
+        and all(sql_rule(row, rule, block['position']) for block in blocks for rule in block['rules'] if rule['values'])
+    }
+
+
+@pytest.fixture(scope="module")
+def engine():
+    lengths = (1, 2, 3)
+    patch = pytest.MonkeyPatch()
+    patch.setattr(ngram_engine, "iter_query_rows", lambda conn, query, params, batch_size: iter([NGRAM_ROWS[:4], NGRAM_ROWS[4:]]))
+    try:
+        yield NgramMatrixEngine.load(None, lengths, batch_size=4)
+    finally:
+        patch.undo()
+
+
+SQL_CASES = {
+    "include": ([{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'pos', 'operator': 'include', 'values': ['NOUN']},
+    ]}], 0),
+    "exclude_skips_short_rows_and_nulls": ([{'id': 'b0', 'position': 1, 'rules': [
+        {'id': 'r0', 'type': 'dep', 'operator': 'exclude', 'values': ['ROOT']},
+    ]}], 0),
+    "morph_include_and_exclude": ([{'id': 'b0', 'position': 1, 'rules': [
+        {'id': 'r0', 'type': 'morph', 'operator': 'exclude', 'values': ['Number=Plur']},
+    ]}, {'id': 'b1', 'position': 0, 'rules': [
+        {'id': 'r1', 'type': 'morph', 'values': ['Case=Nom', 'Case=Gen']},
+    ]}], 0),
+    "lemma_and_min_frequency": ([{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'lemma', 'values': ['дом']},
+        {'id': 'r1', 'type': 'tag', 'values': []},
+    ]}], 1.0),
+    "unknown_value": ([{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'token', 'values': ['кот']},
+    ]}], 0),
+}
+
+
+@pytest.mark.parametrize("case", SQL_CASES)
+def test_matrix_engine_matches_sql_semantics(engine, case):
+    blocks, min_frequency = SQL_CASES[case]
+    # Эталон описывает условия _compile_rule: без готовых производных таблиц build_where_clauses строит именно их
+    where_clauses, _ = build_results_where(blocks, engine.lengths, min_frequency)
+    for block in blocks:
+        for rule in block['rules']:
+            if rule['values']:
+                assert any(f"ngrams.{COLUMN_MAPPING[rule['type']]}" in clause for clause in where_clauses)
+
+    expected = sql_selection(blocks, engine.lengths, min_frequency)
+    mask = engine.filter_mask(blocks, min_frequency)
+    assert set(engine.ids[mask].tolist()) == expected
+    assert engine.get_totals(mask) == (pytest.approx(sum(row[2] for row in NGRAM_ROWS if row[0] in expected)), len(expected))
+
+
+def test_results_page_follows_sql_order(engine):
+    mask = engine.filter_mask([])
+    page = engine.get_results_page(mask, page_size=3)
+    assert [row[3] for row in page] == [4, 1, 2]
+    assert page[0] == ("дом", 7.0, ["дом"], 4)
+    after = (page[-1][1], page[-1][3])
+    assert [row[3] for row in engine.get_results_page(mask, after=after)] == [3, 5, 6]
+
+
+def test_unique_values_exclude_own_rule(engine):
+    blocks = [{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'pos', 'values': ['ADJ']},
+        {'id': 'r1', 'type': 'dep', 'values': ['nsubj', 'amod']},
+    ]}]
+    values = engine.get_unique_values_for_rule(0, 'pos', blocks, 'b0', 'r0', 0, 1)
+    assert [(value, qty) for value, _, qty in values] == [('NOUN', 2), ('ADJ', 1)]
+    assert values[0][1] == pytest.approx(8.5)
+
+
+# --- Совпадение движков: битовый движок должен отбирать то же, что NumPy-движок ---
+VALUES = ['a', 'b', 'c', 'd']
+MORPH_VALUES = ['Case=Nom', 'Case=Gen', 'Number=Sing']
+
+
+def make_engine(cls, rows=150, max_len=3, seed=7):
+    """Движок на детерминированных случайных данных: строк больше 64, чтобы битсеты занимали несколько слов."""
+    rng = np.random.default_rng(seed)
+    row_lengths = rng.integers(1, max_len + 1, size=rows).astype(np.int16)
+    present = np.arange(max_len)[None, :] < row_lengths[:, None]
+    codes = {}
+    for attr in ENGINE_ATTRIBUTES:
+        matrix = rng.integers(-1, len(VALUES), size=(rows, max_len)).astype(np.int32)
+        codes[attr] = np.where(present, matrix, -1)
+    morph_bits = np.zeros((rows, max_len, 1), dtype=np.uint64)
+    morph_bits[present, 0] = rng.integers(0, 1 << len(MORPH_VALUES), size=int(present.sum())).astype(np.uint64)
+    return cls(
+        (1, 2, 3),
+        ids=np.arange(1, rows + 1, dtype=np.int64),
+        texts=np.asarray([f"phrase {i}" for i in range(rows)], dtype=object),
+        freq=np.round(rng.uniform(0, 10, size=rows), 1),
+        row_lengths=row_lengths,
+        codes=codes,
+        values={attr: list(VALUES) for attr in ENGINE_ATTRIBUTES},
+        morph_len=row_lengths.copy(),
+        morph_bits=morph_bits,
+        morph_values=list(MORPH_VALUES),
+    )
+
+
+@pytest.fixture(scope="module")
+def engines():
+    return make_engine(NgramMatrixEngine), make_engine(NgramBitmapEngine)
+
+
+FILTER_CASES = {
+    "no_filters": ([], 0),
+    "include": ([{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'pos', 'operator': 'include', 'values': ['a', 'b']},
+    ]}], 0),
+    "exclude": ([{'id': 'b0', 'position': 1, 'rules': [
+        {'id': 'r0', 'type': 'dep', 'operator': 'exclude', 'values': ['c']},
+    ]}], 0),
+    "morph": ([{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'morph', 'operator': 'include', 'values': ['Case=Nom']},
+        {'id': 'r1', 'type': 'morph', 'operator': 'exclude', 'values': ['Number=Sing']},
+    ]}], 0),
+    "blocks_and_min_frequency": ([
+        {'id': 'b0', 'position': 0, 'rules': [
+            {'id': 'r0', 'type': 'tag', 'operator': 'include', 'values': ['a', 'd']},
+        ]},
+        {'id': 'b1', 'position': 2, 'rules': [
+            {'id': 'r1', 'type': 'lemma', 'operator': 'exclude', 'values': ['b']},
+        ]},
+    ], 4.5),
+    "unknown_value": ([{'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'token', 'operator': 'include', 'values': ['missing']},
+    ]}], 0),
+}
+
+
+@pytest.mark.parametrize("case", FILTER_CASES)
+def test_engines_agree_on_selection(engines, case):
+    blocks, min_frequency = FILTER_CASES[case]
+    matrix, bitmap = engines
+    matrix_mask = matrix.filter_mask(blocks, min_frequency)
+    bitmap_mask = bitmap.filter_mask(blocks, min_frequency)
+
+    assert np.array_equal(matrix_mask, bitmap._as_bool(bitmap_mask))
+    matrix_totals, bitmap_totals = matrix.get_totals(matrix_mask), bitmap.get_totals(bitmap_mask)
+    assert matrix_totals[1] == bitmap_totals[1]
+    assert matrix_totals[0] == pytest.approx(bitmap_totals[0])
+    assert matrix.get_results_page(matrix_mask, page_size=20) == bitmap.get_results_page(bitmap_mask, page_size=20)
+
+
+@pytest.mark.parametrize("case", FILTER_CASES)
+def test_engines_agree_on_facets(engines, case):
+    blocks, min_frequency = FILTER_CASES[case]
+    matrix, bitmap = engines
+    rule_requests = [(None, f"p{position}:{rule_type}", position, rule_type)
+                     for position in range(3) for rule_type in ('dep', 'pos', 'morph', 'token')]
+    rule_requests += [(block['id'], rule['id'], block['position'], rule['type'])
+                      for block in blocks for rule in block['rules']]
+
+    matrix_values = matrix.get_unique_values_for_rules(rule_requests, blocks, min_frequency, 1)
+    bitmap_values = bitmap.get_unique_values_for_rules(rule_requests, blocks, min_frequency, 1)
+    assert matrix_values.keys() == bitmap_values.keys()
+    for rule_id, values in matrix_values.items():
+        assert [(v, q) for v, _, q in values] == [(v, q) for v, _, q in bitmap_values[rule_id]], rule_id
+        assert [f for _, f, _ in values] == pytest.approx([f for _, f, _ in bitmap_values[rule_id]]), rule_id
+
+
+
+@pytest.mark.parametrize("case", SQL_CASES)
+def test_bitmap_engine_matches_sql_semantics(case):
+    blocks, min_frequency = SQL_CASES[case]
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(ngram_engine, "iter_query_rows", lambda conn, query, params, batch_size: iter([NGRAM_ROWS]))
+        bitmap = NgramBitmapEngine.load(None, (1, 2, 3))
+    mask = bitmap._as_bool(bitmap.filter_mask(blocks, min_frequency))
+    assert set(bitmap.ids[mask].tolist()) == sql_selection(blocks, bitmap.lengths, min_frequency)
+
+
+def test_bitmap_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(NgramBitmapEngine, "BITMAP_CACHE_SIZE", 8)
+    bitmap = make_engine(NgramBitmapEngine)
+    reference = make_engine(NgramMatrixEngine)
+    mask = bitmap.filter_mask([])
+    for position in range(3):
+        for attr in ('dep', 'pos', 'morph'):
+            matrix_values = reference._ranked_values(attr, position, reference.filter_mask([]), 1)
+            assert [(v, q) for v, _, q in bitmap._ranked_values(attr, position, mask, 1)] == [(v, q) for v, _, q in matrix_values]
+    assert len(bitmap._bitmaps) == 8
+    assert not any(cached.flags.writeable for cached in bitmap._bitmaps.values())
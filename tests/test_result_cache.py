@@ -0,0 +1,55 @@
+import pickle
+import random
+import time
+import zlib
+
+from core.result_cache import SQLiteResultCache, make_cache_key
+
+
+def test_roundtrip_and_key_depends_on_data_version(tmp_path):
+    cache = SQLiteResultCache(path=str(tmp_path / "results.sqlite3"), max_bytes=1024 * 1024, ttl=60)
+    key = make_cache_key("totals", "v1", [2, 3], {"min_frequency": 0})
+    cache.set(key, (12.5, 3))
+    assert cache.get(key) == (12.5, 3)
+    assert cache.get(make_cache_key("totals", "v2", [2, 3], {"min_frequency": 0})) is None
+
+
+def test_expired_entries_are_dropped(tmp_path, monkeypatch):
+    cache = SQLiteResultCache(path=str(tmp_path / "results.sqlite3"), max_bytes=1024 * 1024, ttl=60)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.set("key", [1, 2, 3])
+    monkeypatch.setattr(time, "time", lambda: now + 59)
+    assert cache.get("key") == [1, 2, 3]
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("key") is None
+    count = cache._connection().execute("SELECT COUNT(*) FROM results;").fetchone()[0]
+    assert count == 0
+
+
+def test_least_recently_read_entries_are_evicted(tmp_path, monkeypatch):
+    # Случайные байты не сжимаются, поэтому каждая запись занимает ~1 КБ, а в бюджет помещаются две
+    rng = random.Random(0)
+    payload = {name: rng.randbytes(1024) for name in ("a", "b", "c")}
+    entry_size = len(zlib.compress(pickle.dumps(payload["a"], protocol=pickle.HIGHEST_PROTOCOL)))
+    cache = SQLiteResultCache(path=str(tmp_path / "results.sqlite3"), max_bytes=entry_size * 2 + entry_size // 2, ttl=3600)
+    clock = [time.time()]
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+
+    for name in ("a", "b"):
+        clock[0] += 1
+        cache.set(name, payload[name])
+    clock[0] += 1
+    assert cache.get("a") == payload["a"]  # "a" прочитана позже "b"
+    clock[0] += 1
+    cache.set("c", payload["c"])
+
+    assert cache.get("b") is None
+    assert cache.get("a") == payload["a"]
+    assert cache.get("c") == payload["c"]
+
+
+def test_entry_larger_than_budget_is_not_stored(tmp_path):
+    cache = SQLiteResultCache(path=str(tmp_path / "results.sqlite3"), max_bytes=16, ttl=3600)
+    cache.set("big", list(range(1000)))
+    assert cache.get("big") is None
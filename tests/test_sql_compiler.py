@@ -0,0 +1,172 @@
+import psycopg2
+import pytest
+
+from core.database import (
+    MAX_PREPARED_STATEMENTS,
+    MORPH_BIT_WORDS,
+    _to_server_placeholders,
+    build_results_where,
+    build_where_clauses,
+    execute_prepared,
+)
+
+BLOCKS = [
+    {'id': 'b0', 'position': 0, 'rules': [
+        {'id': 'r0', 'type': 'pos', 'operator': 'include', 'values': ['NOUN', 'ADJ']},
+        {'id': 'r1', 'type': 'token', 'operator': 'exclude', 'values': ['дом']},
+        {'id': 'r2', 'type': 'tag', 'values': []},
+    ]},
+    {'id': 'b1', 'position': 2, 'rules': [
+        {'id': 'r3', 'type': 'morph', 'values': ['Case=Nom']},
+    ]},
+]
+
+
+def placeholder_count(clauses):
+    return sum(clause.replace('%%', '').count('%s') for clause in clauses)
+
+
+def test_jsonb_rules_are_parameterized():
+    clauses, params = build_where_clauses(BLOCKS)
+    assert clauses == [
+        "((jsonb_array_length(ngrams.pos) > %s AND ngrams.pos->>%s::int = ANY(%s::text[])) AND "
+        "(jsonb_array_length(ngrams.tokens) > %s AND NOT (ngrams.tokens->>%s::int = ANY(%s::text[]))))",
+        "((jsonb_array_length(ngrams.morph) > %s AND ngrams.morph->%s::int ?| %s::text[]))",
+    ]
+    assert params == [0, 0, ['NOUN', 'ADJ'], 0, 0, ['дом'], 2, 2, ['Case=Nom']]
+
+
+def test_same_shape_gives_same_sql():
+    other = [dict(block, rules=[dict(rule, values=['X'] if rule['values'] else []) for rule in block['rules']]) for block in BLOCKS]
+    other[1]['position'] = 1
+    assert build_where_clauses(BLOCKS)[0] == build_where_clauses(other)[0]
+
+
+def test_skipped_block_and_rule():
+    clauses, params = build_where_clauses(BLOCKS, block_id_to_skip='b1')
+    assert len(clauses) == 1 and params[-1] == ['дом']
+    clauses, params = build_where_clauses(BLOCKS, block_id_to_skip='b0', rule_id_to_skip='r1')
+    assert "ngrams.tokens" not in clauses[0]
+    assert params == [0, 0, ['NOUN', 'ADJ'], 2, 2, ['Case=Nom']]
+
+
+def test_encoded_rules_compare_codes():
+    clauses, params = build_where_clauses(BLOCKS, table_name="t", features=frozenset({'encoded'}))
+    assert clauses[0] == (
+        "((array_length(t.pos_codes, 1) > %s AND t.pos_codes[%s::int + 1] = ANY(ARRAY("
+        "SELECT code FROM ngram_vocab WHERE attr = 'pos' AND value = ANY(%s::text[])))) AND "
+        "(array_length(t.token_codes, 1) > %s AND NOT (t.token_codes[%s::int + 1] = ANY(ARRAY("
+        "SELECT code FROM ngram_vocab WHERE attr = 'token' AND value = ANY(%s::text[]))))))"
+    )
+    # У morph нет колонки кодов: без morph_bits правило остается JSONB-условием
+    assert clauses[1] == "((jsonb_array_length(t.morph) > %s AND t.morph->%s::int ?| %s::text[]))"
+    assert placeholder_count(clauses) == len(params)
+
+
+def test_morph_bits_rules_check_every_word():
+    clauses, params = build_where_clauses(BLOCKS[1:], features=frozenset({'morph_bits'}))
+    assert clauses[0].startswith(f"((array_length(ngrams.morph_bits, 1) > %s::int * {MORPH_BIT_WORDS} AND (")
+    assert clauses[0].count("ngram_morph_mask(%s::text[])") == MORPH_BIT_WORDS
+    assert params == [2] + [2, ['Case=Nom']] * MORPH_BIT_WORDS
+    assert placeholder_count(clauses) == len(params)
+
+
+def test_token_index_rules_become_semi_joins():
+    clauses, params = build_where_clauses(BLOCKS, features=frozenset({'token_index', 'encoded'}))
+    assert clauses == [
+        "ngrams.id IN (SELECT tk.ngram_id FROM ngram_tokens tk WHERE tk.position = %s AND "
+        "tk.pos = ANY(%s::text[]) AND NOT (tk.token = ANY(%s::text[])))",
+        "ngrams.id IN (SELECT tk.ngram_id FROM ngram_tokens tk WHERE tk.position = %s AND tk.morph && %s::text[])",
+    ]
+    assert params == [0, ['NOUN', 'ADJ'], ['дом'], 2, ['Case=Nom']]
+
+
+def test_pattern_positions_resolve_structural_rules_first():
+    blocks = BLOCKS + [{'id': 'b2', 'position': 1, 'rules': [
+        {'id': 'r4', 'type': 'dep', 'operator': 'exclude', 'values': ['punct']},
+    ]}]
+    clauses, params = build_where_clauses(blocks, features=frozenset({'pattern_positions'}))
+    assert clauses[0] == (
+        "ngrams.pattern_id IN ("
+        "SELECT pp.pattern_id FROM ngram_pattern_positions pp WHERE pp.position = %s AND pp.pos = ANY(%s::text[]) INTERSECT "
+        "SELECT pp.pattern_id FROM ngram_pattern_positions pp WHERE pp.position = %s AND NOT (pp.dep = ANY(%s::text[])))"
+    )
+    assert params[:4] == [0, ['NOUN', 'ADJ'], 1, ['punct']]
+    # token и morph проверяются на n-граммах отобранных паттернов; блок только из dep отдельного условия не дает
+    assert len(clauses) == 3
+    assert "ngrams.tokens" in clauses[1] and "ngrams.morph" in clauses[2]
+    assert params[4:] == [0, 0, ['дом'], 2, 2, ['Case=Nom']]
+
+
+def test_results_where_adds_lengths_only_for_ngrams():
+    clauses, params = build_results_where(BLOCKS[1:], [3, 2], 1.5)
+    assert clauses[0] == "len = ANY(%s::int[])" and params[0] == [3, 2]
+    assert clauses[-1] == "ngrams.freq_mln >= %s" and params[-1] == 1.5
+    clauses, params = build_results_where(BLOCKS[1:], [3, 2], 0, table_name="ngram_subset_2_3")
+    assert not any(clause.startswith("len") for clause in clauses)
+    assert placeholder_count(clauses) == len(params)
+
+
+def test_server_placeholders_keep_literal_percent():
+    query = "SELECT * FROM ngrams WHERE text LIKE 'до%%' AND len = %s AND freq_mln >= %s"
+    assert _to_server_placeholders(query) == (
+        "SELECT * FROM ngrams WHERE text LIKE 'до%' AND len = $1 AND freq_mln >= $2", 2
+    )
+    assert _to_server_placeholders("SELECT 100%% AS p;") == ("SELECT 100% AS p;", 0)
+
+
+class FakeConnection:
+    def __init__(self, fail_on=None):
+        self.prepared_statements = {}
+        self.executed = []
+        self.fail_on = fail_on
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.connection.executed.append((query, params))
+        if self.connection.fail_on and query.startswith(self.connection.fail_on):
+            raise psycopg2.Error("plan is no longer valid")
+
+
+def test_execute_prepared_reuses_statement():
+    conn = FakeConnection()
+    cur = conn.cursor()
+    query = "SELECT text FROM ngrams WHERE len = %s AND text LIKE 'a%%';"
+    execute_prepared(cur, query, [2])
+    execute_prepared(cur, query, [3])
+    prepares = [q for q, _ in conn.executed if q.startswith("PREPARE")]
+    assert len(prepares) == 1
+    assert prepares[0].endswith("AS SELECT text FROM ngrams WHERE len = $1 AND text LIKE 'a%';")
+    name = next(iter(conn.prepared_statements))
+    assert conn.executed[-1] == (f"EXECUTE {name} (%s);", [3])
+
+
+def test_execute_prepared_deallocates_past_limit_and_after_errors():
+    conn = FakeConnection()
+    conn.prepared_statements = {f"ngq_{i}": 0 for i in range(MAX_PREPARED_STATEMENTS)}
+    execute_prepared(conn.cursor(), "SELECT 1;", [])
+    assert ("DEALLOCATE ALL;", None) in conn.executed
+    assert len(conn.prepared_statements) == 1
+
+    failing = FakeConnection(fail_on="EXECUTE")
+    with pytest.raises(psycopg2.Error):
+        execute_prepared(failing.cursor(), "SELECT %s;", [1])
+    assert failing.prepared_statements == {} and failing.rollbacks == 1
+    assert failing.executed[-1][0].startswith("DEALLOCATE ngq_")